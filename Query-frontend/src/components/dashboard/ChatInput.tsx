@@ -5,6 +5,7 @@ import { Button } from '@/components/ui/button';
 import { Textarea } from '@/components/ui/textarea';
 import { Plus, Send, Loader2 } from 'lucide-react';
 import { sendChatMessage, ChatRequestPayload } from '@/services/api';
+import { useAuth } from '@/contexts/AuthContext';
 
 // Define the shape of a chat message
 export interface ChatMessage {
@@ -19,6 +20,7 @@ interface ChatInputProps {
   isLoading: boolean;
   setIsLoading: (loading: boolean) => void;
   isConnected: boolean;
+  connectionId: string | null;
   chatSessions: any[];
   currentChatId: number | null;
   renameCurrentChat: (title: string) => void;
@@ -30,11 +32,13 @@ const ChatInput = ({
   isLoading, 
   setIsLoading, 
   isConnected, 
+  connectionId, 
   chatSessions, 
   currentChatId, 
   renameCurrentChat 
 }: ChatInputProps) => {
   const [message, setMessage] = useState('');
+  const { user } = useAuth();
 
   const handleSubmit = async () => {
     if (!message.trim() || isLoading || !isConnected) return;
@@ -63,6 +67,8 @@ const ChatInput = ({
           role: msg.role,
           content: msg.content
         })),
+        user_id: user?.id,
+        connection_id: connectionId,
       };
 
       console.log('Sending payload to backend:', payload);
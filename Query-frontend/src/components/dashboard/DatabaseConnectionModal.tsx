@@ -6,13 +6,14 @@ import { Select, SelectContent, SelectItem, SelectTrigger, SelectValue } from '@
 import { Dialog, DialogContent, DialogHeader, DialogTitle, DialogDescription } from '@/components/ui/dialog';
 import { Database, Loader2, CheckCircle } from 'lucide-react';
 import { useToast } from '@/hooks/use-toast';
+import { useAuth } from '@/contexts/AuthContext';
 
 const API_BASE = "http://localhost:8000";
 
 interface DatabaseConnectionModalProps {
   isOpen: boolean;
   onClose: () => void;
-  onConnectSuccess: (databaseName: string) => void;
+  onConnectSuccess: (databaseName: string, connectionId: string) => void;
 }
 
 interface ConnectionFormData {
@@ -36,6 +37,7 @@ const DatabaseConnectionModal = ({ isOpen, onClose, onConnectSuccess }: Database
   
   const [isConnecting, setIsConnecting] = useState(false);
   const { toast } = useToast();
+  const { user } = useAuth();
 
   const handleInputChange = (field: keyof ConnectionFormData, value: string) => {
     setFormData(prev => ({ ...prev, [field]: value }));
@@ -50,6 +52,7 @@ const DatabaseConnectionModal = ({ isOpen, onClose, onConnectSuccess }: Database
       user: formData.user,
       password: formData.password,
       database: formData.database,
+      user_id: user?.id,
     };
 
     try {
@@ -66,7 +69,7 @@ const DatabaseConnectionModal = ({ isOpen, onClose, onConnectSuccess }: Database
           title: "✅ Connection successful!",
           description: `Connected to the ${formData.database} database.`,
         });
-        onConnectSuccess(formData.database);
+        onConnectSuccess(formData.database, result.connection_id);
         onClose();
       } else {
         throw new Error(result.error || 'An unknown error occurred.');
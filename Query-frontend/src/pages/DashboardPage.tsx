@@ -1,6 +1,7 @@
 import React from 'react';
 import { useToast } from '@/hooks/use-toast';
 import { useChatSession } from '@/hooks/useChatSession';
+import { useAuth } from '@/contexts/AuthContext';
 import Sidebar from '@/components/dashboard/Sidebar';
 import ChatInput from '@/components/dashboard/ChatInput';
 import ChatWindow from '@/components/dashboard/ChatWindow';
@@ -10,6 +11,7 @@ import { DatabaseConnectionModal } from '@/components/dashboard/DatabaseConnecti
 
 const DashboardPage = () => {
   const { toast } = useToast();
+  const { user } = useAuth();
   const {
     chatSessions,
     currentChatId,
@@ -25,11 +27,14 @@ const DashboardPage = () => {
   const [isLoading, setIsLoading] = React.useState(false);
   const [isConnected, setIsConnected] = React.useState(false);
   const [connectedDatabase, setConnectedDatabase] = React.useState<string | null>(null);
+  // Every request names this connection, so it never runs against another user's database
+  const [connectionId, setConnectionId] = React.useState<string | null>(null);
   const [isModalOpen, setIsModalOpen] = React.useState(false);
 
-  const handleConnectSuccess = async (databaseName: string) => {
+  const handleConnectSuccess = async (databaseName: string, newConnectionId: string) => {
     setIsConnected(true);
     setConnectedDatabase(databaseName);
+    setConnectionId(newConnectionId);
     // Create a new chat session only after database connection
     await createNewChat();
   };
@@ -94,9 +99,10 @@ const handleConfirmSql = async (sql: string) => {
         "Content-Type": "application/json",
       },
       body: JSON.stringify({
-        user_id: 1,
+        user_id: user?.id,
         confirm: true,
         sql,
+        connection_id: connectionId,
       }),
     });
 
@@ -107,7 +113,8 @@ const handleConfirmSql = async (sql: string) => {
       {
         role: "assistant",
         type: "assistant",
-        content: result.message || "SQL executed successfully",
+        // Confirmed SELECTs come back like /api/chat ("SQL: ...\nOutput: ...") and render as a table
+        content: result.response || result.message || "SQL executed successfully",
         timestamp: new Date().toISOString(),
       },
     ]);
@@ -143,11 +150,16 @@ const handleDeleteConnection = async () => {
       headers: {
         "Content-Type": "application/json",
       },
+      body: JSON.stringify({
+        user_id: user?.id,
+        connection_id: connectionId,
+      }),
     });
 
     if (response.ok) {
       setIsConnected(false);
       setConnectedDatabase(null);
+      setConnectionId(null);
       toast({
         title: "Database Disconnected",
         description: "Successfully disconnected from the database.",
@@ -207,6 +219,7 @@ const handleDeleteConnection = async () => {
             isLoading={isLoading}
             setIsLoading={setIsLoading}
             isConnected={isConnected}
+            connectionId={connectionId}
             chatSessions={chatSessions}
             currentChatId={currentChatId}
             renameCurrentChat={renameCurrentChat}
@@ -16,6 +16,7 @@ export interface DBConfig {
   user: string;
   password?: string; // Optional as it has a default in Python
   database: string;
+  user_id?: number; // Owner of the connection profile; the response carries its connection_id
 }
 
 // Represents a single message in the chat history
@@ -28,6 +29,8 @@ export interface ChatMessage {
 export interface ChatRequestPayload {
   question: string;
   chat_history: ChatMessage[];
+  user_id?: number;
+  connection_id?: string | null; // From /api/connect
 }
 
 // Auth types
@@ -79,7 +82,7 @@ export interface OtpResponse {
 export const connectToDB = async (config: DBConfig) => {
   try {
     const { data } = await api.post('/api/connect', config);
-    return data; // Expected: { success: true } or { success: false, error: "..." }
+    return data; // Expected: { success: true, connection_id: "..." } or { success: false, error: "..." }
   } catch (error) {
     console.error("Failed to connect to the database:", error);
     throw error;
@@ -1,30 +1,62 @@
 import os
-from datetime import datetime, timedelta, timezone
+import secrets
+from datetime import date, datetime, time as dt_time, timedelta, timezone
+from decimal import Decimal
 from dotenv import load_dotenv
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from pydantic import BaseModel, EmailStr
+from typing import Optional
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
 from sqlalchemy.orm import Session
 import random
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
-from passlib.context import CryptContext
+import password_hashing
 from langchain_core.messages import AIMessage, HumanMessage
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 from langchain_community.utilities import SQLDatabase
 from langchain_groq import ChatGroq
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, ForeignKey, text
+import groq
+import httpx
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Float, ForeignKey, text
+from sqlalchemy import inspect, select, event, MetaData, Table, Index, literal
+from sqlalchemy.schema import CreateTable
+from sqlalchemy.types import NullType
 from sqlalchemy.orm import declarative_base
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.engine import make_url
 from sqlalchemy.exc import SQLAlchemyError
+from cryptography.fernet import Fernet, InvalidToken
 import ast
+import asyncio
+import multiprocessing
+import base64
+import contextlib
+import contextvars
+import functools
+import csv
+import hashlib
+import io
 import json
+import logging
 import re
+import math
+import queue
+import threading
+import time
+import uuid
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from langchain.sql_database import SQLDatabase
 
+logger = logging.getLogger("querygenie")
+
 # Load environment variables
 load_dotenv()
 groq_api_key = os.getenv("GROQ_API_KEY")
@@ -39,18 +71,49 @@ if not EMAIL_HOST_USER or not EMAIL_HOST_PASSWORD:
 # ===============================================================
 
 # --- Password Hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = password_hashing.pwd_context
 
 # --- SQLite Database Setup with Connection Pooling ---
-SQLITE_DB_FILE = "users.db"
-engine = create_engine(
-    f"sqlite:///{SQLITE_DB_FILE}", 
-    echo=False,
-    pool_pre_ping=True,      # Test connections before using
-    pool_recycle=3600,       # Recycle connections every hour
-    pool_size=5,             # Limit connection pool size
-    max_overflow=10          # Maximum overflow connections
-)
+# "wal" (default): WAL journal, tuned synchronous level and busy timeout, one
+# writer connection fed by a batching write queue, and a separate read pool.
+# "legacy": the previous single shared pool in rollback-journal mode.
+SQLITE_DB_FILE = os.getenv("SQLITE_DB_FILE", "users.db")
+SQLITE_STORAGE_MODE = os.getenv("SQLITE_STORAGE_MODE", "wal").lower()
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").upper()
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_READ_POOL_SIZE = int(os.getenv("SQLITE_READ_POOL_SIZE", "8"))
+SQLITE_WRITE_BATCH_MS = float(os.getenv("SQLITE_WRITE_BATCH_MS", "5"))
+SQLITE_WRITE_BATCH_MAX = int(os.getenv("SQLITE_WRITE_BATCH_MAX", "64"))
+
+if SQLITE_SYNCHRONOUS not in ("OFF", "NORMAL", "FULL", "EXTRA"):
+    raise RuntimeError(f"Invalid SQLITE_SYNCHRONOUS value: {SQLITE_SYNCHRONOUS}")
+
+def create_sqlite_engine(pool_size, max_overflow):
+    sqlite_engine = create_engine(
+        f"sqlite:///{SQLITE_DB_FILE}", 
+        echo=False,
+        pool_pre_ping=True,      # Test connections before using
+        pool_recycle=3600,       # Recycle connections every hour
+        pool_size=pool_size,     # Limit connection pool size
+        max_overflow=max_overflow,  # Maximum overflow connections
+        connect_args={"timeout": SQLITE_BUSY_TIMEOUT_MS / 1000},
+    )
+    if SQLITE_STORAGE_MODE == "wal":
+        @event.listens_for(sqlite_engine, "connect")
+        def set_sqlite_pragmas(dbapi_connection, _):
+            cursor = dbapi_connection.cursor()
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+            cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            cursor.close()
+    return sqlite_engine
+
+if SQLITE_STORAGE_MODE == "wal":
+    engine = create_sqlite_engine(pool_size=1, max_overflow=0)  # the single writer
+    read_engine = create_sqlite_engine(pool_size=SQLITE_READ_POOL_SIZE, max_overflow=0)
+else:
+    engine = create_sqlite_engine(pool_size=5, max_overflow=10)
+    read_engine = engine
 Base = declarative_base()
 
 class User(Base):
@@ -68,6 +131,7 @@ Base.metadata.create_all(engine)
 
 # Create a session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=read_engine)
 
 app = FastAPI()
 
@@ -84,21 +148,36 @@ app.add_middleware(
 
 chat_history = [AIMessage(content="Hello! I'm your database assistant.")]
 
-otp_storage = {}  
 pending_sql_actions = {}
 
 
 
+class ReplicaConfig(BaseModel):
+    host: str
+    port: Optional[int] = None  # Defaults to the primary's port and credentials
+    user: Optional[str] = None
+    password: Optional[str] = None
+
 class DBConfig(BaseModel):
     host: str
     port: int
     user: str
     password: str = ""
     database: str
+    user_id: Optional[int] = None  # Owner of the connection profile
+    replicas: list[ReplicaConfig] = []  # Read replicas for generated SELECTs
+
+class DisconnectRequest(BaseModel):
+    connection_id: Optional[str] = None
+    user_id: Optional[int] = None
 
 class ChatRequest(BaseModel):
     question: str
     chat_history: list = []  # Make it optional with default empty list
+    use_sql_cache: bool = True  # Set False to force a fresh LLM generation
+    use_result_cache: bool = True  # Set False to always run SELECTs against the database
+    user_id: Optional[int] = None  # Owner of any result handle created for this request
+    connection_id: Optional[str] = None  # From /api/connect; falls back to the last connected database
 
 # --- Auth Models ---
 class UserCreate(BaseModel):
@@ -118,36 +197,510 @@ class UserLogin(BaseModel):
 class ChatSession(Base):
     __tablename__ = "chat_sessions"
     id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
     title = Column(String, nullable=False)
-    messages = Column(Text, nullable=False)
+    messages = Column(Text, nullable=False, default="[]")  # Legacy JSON blob; rows now live in chat_messages
+    message_count = Column(Integer, nullable=False, default=0)
+    messages_digest = Column(String)  # Running SHA-1 over the stored payloads; see chain_messages_digest()
+    created_at = Column(DateTime)
+    updated_at = Column(DateTime)
+
+# One row per chat message, appended in seq order
+class ChatMessage(Base):
+    __tablename__ = "chat_messages"
+    id = Column(Integer, primary_key=True)
+    session_id = Column(Integer, ForeignKey('chat_sessions.id'), nullable=False)
+    seq = Column(Integer, nullable=False)
+    role = Column(String)
+    payload = Column(Text, nullable=False)  # The message object exactly as the client sent it
+    created_at = Column(DateTime, nullable=False)
+    __table_args__ = (Index("ix_chat_messages_session_seq", "session_id", "seq", unique=True),)
+
+# Persistent tier of the NL-to-SQL generation cache
+class GeneratedSQL(Base):
+    __tablename__ = "sql_generation_cache"
+    cache_key = Column(String, primary_key=True)
+    sql = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+# A connected target database, shared by every worker process through users.db
+class ConnectionProfile(Base):
+    __tablename__ = "connection_profiles"
+    id = Column(String, primary_key=True)  # Opaque connection_id handed to the client
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=True, index=True)  # Owner; only they can resolve it
+    db_uri = Column(Text, nullable=False)  # Password masked; the real URI is in secret
+    replica_uris = Column(Text, nullable=False, default="[]")  # JSON list of masked read replica URIs
+    secret = Column(Text)  # Fernet token of {"db_uri", "replica_uris"}
+    database = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False)
+
+# A confirmed DELETE/UPDATE executed in primary-key chunks; progress survives restarts
+class WriteJob(Base):
+    __tablename__ = "write_jobs"
+    id = Column(String, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=True, index=True)
+    connection_id = Column(String, ForeignKey('connection_profiles.id'))  # Target database; credentials stay in the profile
+    sql = Column(Text, nullable=False)
+    plan = Column(Text, nullable=False)  # JSON: action, table, set, where, key_column
+    state = Column(String, nullable=False)  # running | interrupted | cancelled | completed | failed
+    batch_size = Column(Integer, nullable=False)
+    pause_ms = Column(Float, nullable=False, default=0)
+    estimated_rows = Column(Integer)
+    max_key = Column(Text)  # JSON; the job stops at the highest key present when it was created
+    last_key = Column(Text)  # JSON; upper bound of the last committed chunk
+    rows_affected = Column(Integer, nullable=False, default=0)
+    batches = Column(Integer, nullable=False, default=0)
+    error = Column(Text)
+    created_at = Column(DateTime, nullable=False)
+    updated_at = Column(DateTime, nullable=False)
 
 # Create the chat_sessions table if not exists
 Base.metadata.create_all(engine)
 
+def migrate_chat_storage():
+    """Add the new chat_sessions columns/index and move legacy message blobs into chat_messages."""
+    with engine.begin() as connection:
+        existing = {row[1] for row in connection.execute(text("PRAGMA table_info(chat_sessions)"))}
+        for column, ddl in (
+            ("message_count", "INTEGER NOT NULL DEFAULT 0"),
+            ("messages_digest", "VARCHAR"),
+            ("created_at", "DATETIME"),
+            ("updated_at", "DATETIME"),
+        ):
+            if column not in existing:
+                connection.execute(text(f"ALTER TABLE chat_sessions ADD COLUMN {column} {ddl}"))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS ix_chat_sessions_user_id ON chat_sessions (user_id)"))
+
+        legacy = connection.execute(text(
+            "SELECT id, messages FROM chat_sessions WHERE messages IS NOT NULL AND messages NOT IN ('', '[]')"
+        )).fetchall()
+        now = datetime.utcnow()
+        for session_id, blob in legacy:
+            try:
+                messages = json.loads(blob)
+            except ValueError:
+                print(f"Skipping chat session {session_id}: messages blob is not valid JSON")
+                continue
+            rows = [message_row(session_id, seq, message, now) for seq, message in enumerate(messages)]
+            if rows:
+                connection.execute(ChatMessage.__table__.insert(), rows)
+            connection.execute(
+                text(
+                    "UPDATE chat_sessions SET messages = '[]', message_count = :count, messages_digest = :digest, "
+                    "updated_at = COALESCE(updated_at, :now), created_at = COALESCE(created_at, :now) WHERE id = :id"
+                ),
+                {
+                    "count": len(rows), "digest": chain_messages_digest("", [row["payload"] for row in rows]),
+                    "now": now, "id": session_id,
+                },
+            )
+        if legacy:
+            print(f"Migrated {len(legacy)} chat session(s) to chat_messages")
+
+def message_row(session_id, seq, message, created_at):
+    return {
+        "session_id": session_id,
+        "seq": seq,
+        "role": message.get("role") if isinstance(message, dict) else None,
+        "payload": json.dumps(message),
+        "created_at": created_at,
+    }
+
+def chain_messages_digest(digest, payloads):
+    """Extend a running SHA-1 over stored message payloads; an unknown (None) digest stays unknown."""
+    if digest is None:
+        return None
+    for payload in payloads:
+        digest = hashlib.sha1((digest + payload).encode("utf-8")).hexdigest()
+    return digest
+
+migrate_chat_storage()
+
+# --- Connection Secrets ---
+# Target database URIs carry passwords, so connection profiles keep them
+# Fernet-encrypted. The key comes from CONNECTION_SECRET_KEY or, failing that,
+# a key file created on first start next to (never inside) users.db; every
+# worker process sharing users.db must see the same key.
+CONNECTION_SECRET_KEY = os.getenv("CONNECTION_SECRET_KEY")
+CONNECTION_SECRET_KEY_FILE = os.getenv("CONNECTION_SECRET_KEY_FILE", "connection_secret.key")
+
+def load_connection_secret_key():
+    if CONNECTION_SECRET_KEY:
+        return CONNECTION_SECRET_KEY.encode("ascii")
+    try:
+        fd = os.open(CONNECTION_SECRET_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        for _ in range(50):  # Another worker may be writing it right now
+            with open(CONNECTION_SECRET_KEY_FILE, "rb") as f:
+                key = f.read().strip()
+            if key:
+                return key
+            time.sleep(0.1)
+        raise RuntimeError(f"{CONNECTION_SECRET_KEY_FILE} is empty")
+    key = Fernet.generate_key()
+    with os.fdopen(fd, "wb") as f:
+        f.write(key)
+    print(f"Generated connection secret key in {CONNECTION_SECRET_KEY_FILE}")
+    return key
+
+connection_cipher = Fernet(load_connection_secret_key())
+
+def mask_db_uri(uri):
+    return make_url(uri).render_as_string(hide_password=True)
+
+def encrypt_connection_secret(db_uri, replica_uris):
+    payload = json.dumps({"db_uri": db_uri, "replica_uris": list(replica_uris)})
+    return connection_cipher.encrypt(payload.encode("utf-8")).decode("ascii")
+
+def decrypt_connection_secret(token):
+    """(db_uri, replica_uris) from a profile's secret column."""
+    try:
+        payload = json.loads(connection_cipher.decrypt(token.encode("ascii")))
+    except InvalidToken:
+        raise RuntimeError("Connection profile can't be decrypted; was CONNECTION_SECRET_KEY changed?")
+    return payload["db_uri"], tuple(payload["replica_uris"])
+
+def migrate_connection_profiles():
+    """Add new columns, drop ownerless profiles and encrypt URIs stored in plaintext by older versions."""
+    with engine.begin() as connection:
+        existing = {row[1] for row in connection.execute(text("PRAGMA table_info(connection_profiles)"))}
+        if "replica_uris" not in existing:
+            connection.execute(text("ALTER TABLE connection_profiles ADD COLUMN replica_uris TEXT NOT NULL DEFAULT '[]'"))
+        if "secret" not in existing:
+            connection.execute(text("ALTER TABLE connection_profiles ADD COLUMN secret TEXT"))
+        connection.execute(text("DELETE FROM connection_profiles WHERE user_id IS NULL"))
+        plaintext = connection.execute(text(
+            "SELECT id, db_uri, replica_uris FROM connection_profiles WHERE secret IS NULL"
+        )).fetchall()
+        for profile_id, db_uri, replica_uris in plaintext:
+            replica_uris = json.loads(replica_uris or "[]")
+            connection.execute(
+                text("UPDATE connection_profiles SET secret = :secret, db_uri = :db_uri, replica_uris = :replicas WHERE id = :id"),
+                {
+                    "secret": encrypt_connection_secret(db_uri, replica_uris),
+                    "db_uri": mask_db_uri(db_uri),
+                    "replicas": json.dumps([mask_db_uri(uri) for uri in replica_uris]),
+                    "id": profile_id,
+                },
+            )
+        if plaintext:
+            print(f"Encrypted {len(plaintext)} connection profile(s)")
+
+migrate_connection_profiles()
+
+def migrate_write_jobs():
+    """Move the target URI of older write jobs into an owned connection profile and drop the db_uri column."""
+    with engine.begin() as connection:
+        existing = {row[1] for row in connection.execute(text("PRAGMA table_info(write_jobs)"))}
+        if "db_uri" not in existing:
+            return
+        if "connection_id" not in existing:
+            connection.execute(text("ALTER TABLE write_jobs ADD COLUMN connection_id VARCHAR REFERENCES connection_profiles (id)"))
+        legacy = connection.execute(text("SELECT id, user_id, db_uri FROM write_jobs WHERE connection_id IS NULL")).fetchall()
+        for job_id, user_id, db_uri in legacy:
+            connection_id = None
+            if user_id is not None:
+                connection_id = secrets.token_urlsafe(24)
+                connection.execute(ConnectionProfile.__table__.insert(), {
+                    "id": connection_id, "user_id": user_id, "db_uri": mask_db_uri(db_uri), "replica_uris": "[]",
+                    "secret": encrypt_connection_secret(db_uri, ()), "database": make_url(db_uri).database or "",
+                    "created_at": datetime.utcnow(),
+                })
+            connection.execute(
+                text("UPDATE write_jobs SET connection_id = :connection_id WHERE id = :id"),
+                {"connection_id": connection_id, "id": job_id},
+            )
+        connection.execute(text("ALTER TABLE write_jobs DROP COLUMN db_uri"))
+        if legacy:
+            print(f"Moved {len(legacy)} write job target(s) into connection profiles")
+
+migrate_write_jobs()
+
 class OtpRequest(BaseModel):
     email: EmailStr
     
 # --- Database Session Dependency ---
-def get_db():
-    db = SessionLocal()
+# Request handlers only get read sessions; writes go through session_writer,
+# which owns the single writer connection in WAL mode.
+def get_read_db():
+    db = ReadSessionLocal()
     try:
         yield db
     finally:
         db.close()
 
+# --- SQLite Write Queue ---
+class SQLiteWriteQueue:
+    """Single writer thread that commits queued writes together in one transaction.
+
+    A write that finds the queue empty commits at once. When writes are
+    already queued behind it, the batch stays open for up to the batch window
+    to collect more.
+
+    Each submitted function receives the shared session and must return plain
+    data (ORM objects expire on commit). Raising HTTPException is treated as a
+    rejection and only allowed before the function has touched the session.
+    Any other error rolls the batch back and replays its writes one by one.
+    """
+
+    def __init__(self, session_factory, batch_window_ms, max_batch, batching=True):
+        self.session_factory = session_factory
+        self.batch_window = batch_window_ms / 1000
+        self.max_batch = max_batch
+        self.batching = batching
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batches = 0
+        self.writes = 0
+
+    def submit(self, func):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="qg-sqlite-writer", daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((func, future))
+        return future
+
+    async def run(self, func):
+        if not self.batching:
+            # Legacy mode: every write is its own transaction on a worker thread
+            future = Future()
+            await run_blocking(self._execute, [(func, future)], stage="session write")
+            return future.result()
+        return await asyncio.wrap_future(self.submit(func))
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            # A lone write commits at once; the window only holds a batch open when writes are already queued
+            deadline = time.monotonic() + self.batch_window if not self._queue.empty() else 0
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            if not self._execute(batch) and len(batch) > 1:
+                for single in batch:
+                    if not single[1].done():
+                        self._execute([single])
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError("Write was not applied"))
+            if stopping:
+                return
+
+    def _execute(self, batch):
+        db_session = self.session_factory()
+        outcomes = []
+        try:
+            for func, future in batch:
+                try:
+                    outcomes.append((future, True, func(db_session)))
+                except HTTPException as e:
+                    outcomes.append((future, False, e))
+            db_session.commit()
+        except Exception as e:
+            db_session.rollback()
+            if len(batch) == 1:
+                batch[0][1].set_exception(e)
+            else:
+                print(f"SQLite write batch of {len(batch)} failed, retrying individually: {e}")
+            return False
+        finally:
+            db_session.close()
+
+        self.batches += 1
+        self.writes += len(batch)
+        for future, ok, value in outcomes:
+            if ok:
+                future.set_result(value)
+            else:
+                future.set_exception(value)
+        return True
+
+session_writer = SQLiteWriteQueue(
+    SessionLocal, SQLITE_WRITE_BATCH_MS, SQLITE_WRITE_BATCH_MAX, batching=SQLITE_STORAGE_MODE == "wal"
+)
+
 
 def generate_otp():
     return str(random.randint(100000, 999999))
 
-def send_otp_email(recipient_email: str, otp: str):
-    if not EMAIL_HOST_USER or not EMAIL_HOST_PASSWORD:
-        print(f"Skipping email send. OTP for {recipient_email} is {otp}")
-        return
+# --- Email Dispatch ---
+# OTP emails are queued and sent by a background thread that keeps one SMTP
+# connection open between messages, so the endpoint returns immediately.
+# EMAIL_BACKEND: "smtp" (default with credentials), "console" (default without)
+# or "memory" (keeps messages in an outbox, for tests).
+EMAIL_BACKEND = os.getenv("EMAIL_BACKEND", "smtp" if EMAIL_HOST_USER and EMAIL_HOST_PASSWORD else "console").lower()
+EMAIL_SMTP_HOST = os.getenv("EMAIL_SMTP_HOST", "smtp.gmail.com")
+EMAIL_SMTP_PORT = int(os.getenv("EMAIL_SMTP_PORT", "465"))
+EMAIL_SMTP_SSL = os.getenv("EMAIL_SMTP_SSL", "true").lower() in ("1", "true", "yes")
+EMAIL_BATCH_SIZE = int(os.getenv("EMAIL_BATCH_SIZE", "20"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "3"))
+EMAIL_IDLE_DISCONNECT_SECONDS = float(os.getenv("EMAIL_IDLE_DISCONNECT_SECONDS", "60"))
+
+class SMTPEmailBackend:
+    """Sends over a reusable SMTP connection, reconnecting when the server drops it."""
+
+    def __init__(self, host, port, use_ssl, username, password):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.username = username
+        self.password = password
+        self._server = None
+
+    def send(self, message):
+        server = self._connection()
+        server.sendmail(message["From"], [message["To"]], message.as_string())
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except smtplib.SMTPException:
+                pass
+            except OSError:
+                pass
+            self._server = None
+
+    def _connection(self):
+        if self._server is not None:
+            try:
+                self._server.noop()
+                return self._server
+            except (smtplib.SMTPException, OSError):
+                self._server = None
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, timeout=EMAIL_TIMEOUT_SECONDS)
+        else:
+            server = smtplib.SMTP(self.host, self.port, timeout=EMAIL_TIMEOUT_SECONDS)
+        if self.username and self.password:
+            server.login(self.username, self.password)
+        self._server = server
+        return server
+
+class ConsoleEmailBackend:
+    def send(self, message):
+        print(f"Skipping email send (console backend). To: {message['To']} Subject: {message['Subject']}")
+
+    def close(self):
+        pass
+
+class MemoryEmailBackend:
+    """Local stand-in for SMTP: keeps sent messages in self.outbox."""
+
+    def __init__(self):
+        self.outbox = []
+
+    def send(self, message):
+        self.outbox.append(message)
 
+    def close(self):
+        pass
+
+def create_email_backend(name):
+    if name == "smtp":
+        return SMTPEmailBackend(EMAIL_SMTP_HOST, EMAIL_SMTP_PORT, EMAIL_SMTP_SSL, EMAIL_HOST_USER, EMAIL_HOST_PASSWORD)
+    if name == "console":
+        return ConsoleEmailBackend()
+    if name == "memory":
+        return MemoryEmailBackend()
+    raise RuntimeError(f"Unknown EMAIL_BACKEND: {name}")
+
+class EmailDispatcher:
+    """Background queue that sends messages in batches with retry and backoff."""
+
+    def __init__(self, backend, batch_size, max_attempts, idle_disconnect_seconds):
+        self.backend = backend
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.idle_disconnect_seconds = idle_disconnect_seconds
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def enqueue(self, message):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="qg-email", daemon=True)
+                self._thread.start()
+        self._queue.put(message)
+
+    def stop(self):
+        with self._lock:
+            if self._thread is None:
+                return
+            self._queue.put(None)
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def _run(self):
+        while True:
+            try:
+                message = self._queue.get(timeout=self.idle_disconnect_seconds)
+            except queue.Empty:
+                self.backend.close()  # providers drop idle connections anyway
+                continue
+            if message is None:
+                break
+            batch = [message]
+            while len(batch) < self.batch_size:
+                try:
+                    message = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if message is None:
+                    self._queue.put(None)
+                    break
+                batch.append(message)
+            for message in batch:
+                self._send_with_retry(message)
+        self.backend.close()
+
+    def _send_with_retry(self, message):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                self.backend.send(message)
+                self.sent += 1
+                return
+            except Exception as e:
+                print(f"Failed to send email to {message['To']} (attempt {attempt}/{self.max_attempts}): {e}")
+                self.backend.close()
+                if attempt < self.max_attempts:
+                    time.sleep(min(2 ** (attempt - 1), 10))
+        self.failed += 1
+
+email_dispatcher = EmailDispatcher(
+    create_email_backend(EMAIL_BACKEND), EMAIL_BATCH_SIZE, EMAIL_MAX_ATTEMPTS, EMAIL_IDLE_DISCONNECT_SECONDS
+)
+
+def build_otp_message(recipient_email: str, otp: str):
     message = MIMEMultipart("alternative")
     message["Subject"] = "Your Verification Code"
-    message["From"] = EMAIL_HOST_USER
+    message["From"] = EMAIL_HOST_USER or "no-reply@querygenie.local"
     message["To"] = recipient_email
 
     html = f"""
@@ -157,28 +710,143 @@ def send_otp_email(recipient_email: str, otp: str):
             <h2>Welcome to Query Genie!</h2>
             <p>Your one-time verification code is:</p>
             <p style="font-size: 24px; font-weight: bold; letter-spacing: 2px; color: #007BFF;">{otp}</p>
-            <p>This code will expire in 5 minutes.</p>
+            <p>This code will expire in {OTP_TTL_SECONDS // 60} minutes.</p>
         </div>
     </body>
     </html>
     """
     message.attach(MIMEText(html, "html"))
+    return message
 
-    try:
-        with smtplib.SMTP_SSL("smtp.gmail.com", 465) as server:
-            server.login(EMAIL_HOST_USER, EMAIL_HOST_PASSWORD)
-            server.sendmail(EMAIL_HOST_USER, recipient_email, message.as_string())
-    except Exception as e:
-        print(f"Failed to send email: {e}")
-        raise HTTPException(status_code=500, detail="Failed to send OTP email.")
+def send_otp_email(recipient_email: str, otp: str):
+    """Queue the OTP email; delivery happens on the dispatcher thread."""
+    email_dispatcher.enqueue(build_otp_message(recipient_email, otp))
+
+# --- OTP Store ---
+OTP_TTL_SECONDS = int(os.getenv("OTP_TTL_SECONDS", "300"))
+OTP_MAX_ENTRIES = int(os.getenv("OTP_MAX_ENTRIES", "10000"))
+OTP_SWEEP_SECONDS = float(os.getenv("OTP_SWEEP_SECONDS", "60"))
+
+class OTPStore:
+    """Pending OTPs by email with TTL expiry, a size cap and a periodic sweeper thread."""
+
+    def __init__(self, ttl_seconds, max_entries, sweep_seconds):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.sweep_seconds = sweep_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sweeper = None
+
+    def put(self, email, otp):
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=self.ttl_seconds)
+        with self._lock:
+            self._entries.pop(email, None)
+            self._entries[email] = {"otp": otp, "expires_at": expires_at}
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return expires_at
+
+    def get(self, email):
+        with self._lock:
+            return self._entries.get(email)
+
+    def discard(self, email):
+        with self._lock:
+            self._entries.pop(email, None)
+
+    def sweep(self):
+        now = datetime.now(timezone.utc)
+        with self._lock:
+            expired = [email for email, entry in self._entries.items() if entry["expires_at"] <= now]
+            for email in expired:
+                del self._entries[email]
+        return len(expired)
+
+    def start_sweeper(self):
+        if self._sweeper is None:
+            self._stop.clear()
+            self._sweeper = threading.Thread(target=self._sweep_loop, name="qg-otp-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def stop_sweeper(self):
+        if self._sweeper is not None:
+            self._stop.set()
+            self._sweeper.join(timeout=5)
+            self._sweeper = None
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self.sweep_seconds):
+            self.sweep()
+
+    def __len__(self):
+        return len(self._entries)
+
+otp_storage = OTPStore(OTP_TTL_SECONDS, OTP_MAX_ENTRIES, OTP_SWEEP_SECONDS)
 # ===============================================================
 # ---------------- SQL SAFETY HELPERS ----------------
 
 DANGEROUS_KEYWORDS = ["DROP", "TRUNCATE", "DELETE", "ALTER", "UPDATE"]
 
+# sqlglot is optional: with it, statements are classified from the parse tree
+# (so a column named updated_at isn't an UPDATE) and generated SQL is checked
+# against the schema catalog before it runs. Without it, keyword matching is
+# used and validation is skipped.
+try:
+    import sqlglot
+    from sqlglot import exp
+    from sqlglot.errors import ParseError
+except ImportError:
+    sqlglot = None
+    logger.warning(
+        "sqlglot is not installed: generated SQL will NOT be validated or repaired before it runs, and "
+        "statements are classified by keyword matching. Install it with: pip install -r requirements.txt"
+    )
+
+SQLGLOT_DIALECTS = {"mysql": "mysql", "postgresql": "postgres", "sqlite": "sqlite"}
+
+@functools.lru_cache(maxsize=512)
+def parse_sql(sql: str, dialect: str = "mysql"):
+    """Tuple of parsed statements; raises ParseError. Callers must not mutate the trees."""
+    return tuple(statement for statement in sqlglot.parse(sql, read=dialect) if statement is not None)
+
+def is_query(statement):
+    """True for a SELECT, a UNION/INTERSECT/EXCEPT, or either one in parentheses."""
+    while isinstance(statement, exp.Subquery):
+        statement = statement.this
+    return isinstance(statement, (exp.Select, getattr(exp, "SetOperation", exp.Union)))  # older sqlglot: Union is the base
+
+def statement_keywords(statement):
+    """Leading keyword of a parsed statement: SELECT, UPDATE, DROP, ..."""
+    if isinstance(statement, exp.Command):
+        return str(statement.this).upper()
+    if is_query(statement):
+        return "SELECT"
+    keyword = type(statement).__name__.upper()
+    return {"TRUNCATETABLE": "TRUNCATE", "ALTERTABLE": "ALTER"}.get(keyword, keyword)
+
+def classify_sql(sql: str):
+    """Statement keywords from the parse tree, or None when it can't be parsed."""
+    if sqlglot is None:
+        return None
+    try:
+        return [statement_keywords(statement) for statement in parse_sql(sql)]
+    except ParseError:
+        return None
+
+def is_select_sql(sql: str) -> bool:
+    kinds = classify_sql(sql)
+    if kinds is None:
+        return sql.strip().upper().startswith("SELECT")
+    return bool(kinds) and all(kind == "SELECT" for kind in kinds)
+
 def detect_dangerous_sql(sql: str):
+    kinds = classify_sql(sql)
+    if kinds is not None:
+        return [kw for kw in DANGEROUS_KEYWORDS if kw in kinds]
     sql_upper = sql.upper()
-    return [kw for kw in DANGEROUS_KEYWORDS if kw in sql_upper]
+    return [kw for kw in DANGEROUS_KEYWORDS if re.search(rf"\b{kw}\b", sql_upper)]
 
 def explain_sql_impact(sql: str, keywords: list[str]) -> str:
     explanations = {
@@ -204,7 +872,24 @@ def explain_sql_impact(sql: str, keywords: list[str]) -> str:
 
     return message
 
-def sql_to_table_preview(sql: str):
+def sql_to_table_preview(sql: str, plan=None):
+    """Confirmation table for a destructive statement; plan comes from plan_batched_write()."""
+    if plan is not None:
+        impact = "Removes record(s) permanently" if plan["action"] == "DELETE" else "Modifies record(s)"
+        if plan["batched"]:
+            impact += f" in batches of {WRITE_JOB_BATCH_SIZE:,} rows"
+        estimated = plan["estimated_rows"]
+        return {
+            "columns": ["Action", "Table", "Condition", "Estimated rows", "Impact"],
+            "data": [[
+                plan["action"],
+                plan["table"],
+                plan["where"] or "-",
+                f"{estimated:,}" if estimated is not None else "-",
+                impact,
+            ]]
+        }
+
     sql_upper = sql.upper()
 
     action = "UNKNOWN"
@@ -233,100 +918,2778 @@ def sql_to_table_preview(sql: str):
         ]
     }
 
+# --- Blocking Work Offload ---
+# mysql-connector, SQLite, bcrypt and SMTP all block. They run on a bounded
+# thread pool so one slow call can't stall every request on the event loop.
+DB_WORKER_THREADS = int(os.getenv("DB_WORKER_THREADS", "16"))
+DB_TIMEOUT_SECONDS = float(os.getenv("DB_TIMEOUT_SECONDS", "120"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "60"))
+EMAIL_TIMEOUT_SECONDS = float(os.getenv("EMAIL_TIMEOUT_SECONDS", "30"))
+
+db_executor = ThreadPoolExecutor(max_workers=DB_WORKER_THREADS, thread_name_prefix="qg-db")
+
+async def run_blocking(func, *args, timeout=DB_TIMEOUT_SECONDS, stage="database", **kwargs):
+    """Run func on the worker pool and await it, raising 504 after timeout seconds.
+
+    The current context is copied so contextvars set by the request stay visible.
+    A timed-out call keeps running in its thread; only the request gives up.
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    future = loop.run_in_executor(db_executor, functools.partial(context.run, func, *args, **kwargs))
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail=f"{stage.capitalize()} timed out after {timeout}s")
+
+# --- Metrics & Stage Timing ---
+# Prometheus text exposition without an extra dependency. Each chat request
+# records how long it spends in every stage (schema, prompt, llm, postprocess,
+# db, rows, encode); the totals go into a histogram and, per request, into the
+# Server-Timing response header. Prompt sizes are reported the same way, in
+# the X-Prompt-Tokens header.
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+METRICS_TOKEN_BUCKETS = (250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+def format_metric_labels(labelnames, values):
+    if not labelnames:
+        return ""
+    pairs = []
+    for name, value in zip(labelnames, values):
+        escaped = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{escaped}"')
+    return "{" + ",".join(pairs) + "}"
+
+class MetricCounter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{format_metric_labels(self.labelnames, key)} {value}")
+        return lines
+
+class MetricHistogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [per-bucket cumulative counts, sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        labelnames = self.labelnames + ("le",)
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{format_metric_labels(labelnames, key + (bound,))} {bucket_count}")
+                lines.append(f"{self.name}_bucket{format_metric_labels(labelnames, key + ('+Inf',))} {count}")
+                lines.append(f"{self.name}_sum{format_metric_labels(self.labelnames, key)} {total}")
+                lines.append(f"{self.name}_count{format_metric_labels(self.labelnames, key)} {count}")
+        return lines
+
+class MetricsRegistry:
+    """Holds metrics plus collectors, callables that report other components' stats at scrape time."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, name, documentation, labelnames=()):
+        metric = MetricCounter(name, documentation, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(), buckets=METRICS_LATENCY_BUCKETS):
+        metric = MetricHistogram(name, documentation, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            for name, kind, documentation, samples in collector():
+                lines.append(f"# HELP {name} {documentation}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    if value is not None:
+                        lines.append(f"{name}{format_metric_labels(tuple(labels), tuple(labels.values()))} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry()
+STAGE_SECONDS = metrics.histogram(
+    "querygenie_stage_duration_seconds", "Time spent in each chat pipeline stage.", ("stage",)
+)
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    "querygenie_http_request_duration_seconds", "HTTP request latency.", ("method", "route", "status")
+)
+PROMPT_TOKENS = metrics.histogram(
+    "querygenie_prompt_tokens", "Estimated tokens per SQL generation prompt.", (), METRICS_TOKEN_BUCKETS
+)
+PROMPT_PART_TOKENS = metrics.histogram(
+    "querygenie_prompt_part_tokens", "Estimated tokens per prompt section.", ("part",), METRICS_TOKEN_BUCKETS
+)
+CHAT_ERRORS = metrics.counter("querygenie_chat_errors_total", "Chat pipeline errors by type.", ("type",))
+ROWS_RETURNED = metrics.counter("querygenie_rows_returned_total", "Result rows returned to clients.")
+
+# Per-request {stage: seconds}; the dict is shared with worker threads through run_blocking's copied context
+request_timings = contextvars.ContextVar("request_timings", default=None)
+
+@contextlib.contextmanager
+def timed_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        timings = request_timings.get()
+        if timings is not None:
+            timings[stage] = timings.get(stage, 0.0) + elapsed
+
+# Per-request {part: tokens} summed over every LLM prompt the request built
+request_prompt_tokens = contextvars.ContextVar("request_prompt_tokens", default=None)
+
+def record_prompt_tokens(total, **parts):
+    PROMPT_TOKENS.observe(total)
+    for part, tokens in parts.items():
+        PROMPT_PART_TOKENS.observe(tokens, part=part)
+    sizes = request_prompt_tokens.get()
+    if sizes is not None:
+        sizes["prompts"] = sizes.get("prompts", 0) + 1
+        for part, tokens in (("total", total), *parts.items()):
+            sizes[part] = sizes.get(part, 0) + tokens
+
+def prompt_tokens_header(sizes):
+    return ", ".join(f"{part}={tokens}" for part, tokens in sizes.items())
+
+def server_timing_header(timings, total_seconds):
+    entries = [f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()]
+    entries.append(f"total;dur={total_seconds * 1000:.1f}")
+    return ", ".join(entries)
+
+# --- Target Database Engine Registry ---
+# Building an SQLDatabase creates a fresh engine + connection pool and reflects
+# the schema, so we keep one per connection URI and reuse it across requests.
+DB_REGISTRY_MAX_ENTRIES = int(os.getenv("DB_REGISTRY_MAX_ENTRIES", "8"))
+DB_REGISTRY_IDLE_SECONDS = int(os.getenv("DB_REGISTRY_IDLE_SECONDS", "1800"))
+DB_HEALTH_CHECK_SECONDS = int(os.getenv("DB_HEALTH_CHECK_SECONDS", "30"))
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+QUERY_MAX_EXECUTION_MS = int(os.getenv("QUERY_MAX_EXECUTION_MS", "30000"))  # Per-statement timeout; 0 disables
+
+class EngineRegistry:
+    """Process-wide LRU cache of engines and SQLDatabase objects keyed by URI."""
+
+    def __init__(self, max_entries, idle_seconds, health_check_seconds):
+        self.max_entries = max_entries
+        self.idle_seconds = idle_seconds
+        self.health_check_seconds = health_check_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.on_dispose = []  # callbacks(db) run when an entry is dropped
+
+    def get(self, uri, pool_size=None, max_overflow=None):
+        """Return the cached SQLDatabase for uri, creating it on first use."""
+        now = time.monotonic()
+        with self._lock:
+            stale = self._pop_idle(now)
+            entry = self._entries.get(uri)
+            if entry is not None:
+                self._entries.move_to_end(uri)
+                entry["last_used"] = now
+        self._dispose_entries(stale)
+
+        if entry is not None and now - entry["last_checked"] >= self.health_check_seconds:
+            if self._is_healthy(entry):
+                entry["last_checked"] = now
+            else:
+                print("Cached engine failed health check, reconnecting")
+                self.dispose(uri)
+                entry = None
+
+        if entry is None:
+            entry = self._create(uri, pool_size, max_overflow)
+            with self._lock:
+                existing = self._entries.get(uri)
+                if existing is not None:
+                    # Another request built the same entry while we were reflecting
+                    discarded, entry = [entry], existing
+                else:
+                    self._entries[uri] = entry
+                    discarded = self._pop_overflow()
+            self._dispose_entries(discarded)
+        return entry["db"]
+
+    def dispose(self, uri):
+        with self._lock:
+            entry = self._entries.pop(uri, None)
+        if entry is not None:
+            self._dispose_entries([entry])
+
+    def dispose_all(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        self._dispose_entries(entries)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "pools": [entry["engine"].pool.status() for entry in self._entries.values()],
+            }
+
+    def _create(self, uri, pool_size, max_overflow):
+        target_engine = create_engine(
+            uri,
+            pool_pre_ping=True,
+            pool_recycle=3600,
+            pool_size=pool_size or DB_POOL_SIZE,
+            max_overflow=DB_MAX_OVERFLOW if max_overflow is None else max_overflow,
+        )
+        if QUERY_MAX_EXECUTION_MS and target_engine.dialect.name in ("mysql", "postgresql"):
+            @event.listens_for(target_engine, "connect")
+            def set_statement_timeout(dbapi_connection, _):
+                cursor = dbapi_connection.cursor()
+                if target_engine.dialect.name == "mysql":
+                    # Applies to SELECTs only; MySQL has no timeout for DML
+                    cursor.execute(f"SET SESSION max_execution_time = {QUERY_MAX_EXECUTION_MS}")
+                else:
+                    cursor.execute(f"SET statement_timeout = {QUERY_MAX_EXECUTION_MS}")
+                cursor.close()
+        try:
+            db = SQLDatabase(target_engine)
+        except Exception:
+            target_engine.dispose()
+            raise
+        now = time.monotonic()
+        return {"engine": target_engine, "db": db, "last_used": now, "last_checked": now}
+
+    def _is_healthy(self, entry):
+        try:
+            with entry["engine"].connect() as connection:
+                connection.execute(text("SELECT 1"))
+            return True
+        except Exception as e:
+            print(f"Engine health check failed: {e}")
+            return False
+
+    def _pop_idle(self, now):
+        idle = [uri for uri, entry in self._entries.items() if now - entry["last_used"] > self.idle_seconds]
+        return [self._entries.pop(uri) for uri in idle]
+
+    def _pop_overflow(self):
+        evicted = []
+        while len(self._entries) > self.max_entries:
+            _, entry = self._entries.popitem(last=False)
+            evicted.append(entry)
+        return evicted
+
+    def _dispose_entries(self, entries):
+        for entry in entries:
+            for callback in self.on_dispose:
+                callback(entry["db"])
+            try:
+                entry["engine"].dispose()
+            except Exception as e:
+                print(f"Error disposing engine: {e}")
+
+db_registry = EngineRegistry(DB_REGISTRY_MAX_ENTRIES, DB_REGISTRY_IDLE_SECONDS, DB_HEALTH_CHECK_SECONDS)
+
+# --- Schema Catalog Cache ---
+# db.get_table_info() reflects every table and samples rows on each call. The
+# catalog keeps the rendered info per table together with a fingerprint built
+# from information_schema, and only re-renders tables whose fingerprint moved.
+SCHEMA_CHECK_SECONDS = int(os.getenv("SCHEMA_CHECK_SECONDS", "30"))
+SCHEMA_SAMPLE_ROWS = int(os.getenv("SCHEMA_SAMPLE_ROWS", "3"))
+
+MYSQL_TABLES_QUERY = text(
+    "SELECT TABLE_NAME, CREATE_TIME, UPDATE_TIME, TABLE_COMMENT FROM information_schema.TABLES "
+    "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_TYPE = 'BASE TABLE'"
+)
+MYSQL_COLUMNS_QUERY = text(
+    "SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, IS_NULLABLE, COLUMN_KEY, COLUMN_DEFAULT, COLUMN_COMMENT "
+    "FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() ORDER BY TABLE_NAME, ORDINAL_POSITION"
+)
+MYSQL_FOREIGN_KEYS_QUERY = text(
+    "SELECT TABLE_NAME, COLUMN_NAME, REFERENCED_TABLE_NAME FROM information_schema.KEY_COLUMN_USAGE "
+    "WHERE TABLE_SCHEMA = DATABASE() AND REFERENCED_TABLE_NAME IS NOT NULL"
+)
+
+def db_identity(db):
+    """Cache key for a target database: its full URL, credentials included."""
+    return db._engine.url.render_as_string(hide_password=False)
+
+def _hash_parts(*parts):
+    return hashlib.sha1("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+
+class SchemaCatalog:
+    """Per-database cache of rendered table info, refreshed incrementally."""
+
+    def __init__(self, check_seconds, sample_rows):
+        self.check_seconds = check_seconds
+        self.sample_rows = sample_rows
+        self._entries = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def get_table_info(self, db, table_names=None):
+        tables = self.tables(db)
+        names = sorted(tables) if table_names is None else [t for t in table_names if t in tables]
+        return "\n\n".join(tables[name]["info"] for name in names)
+
+    def tables(self, db):
+        """Return {table_name: {"fingerprint", "columns", "primary_key", "foreign_keys", "comment", "info"}}."""
+        return self._refresh(db)["tables"]
+
+    def fingerprint(self, db):
+        return self._refresh(db)["fingerprint"]
+
+    def structure_fingerprint(self, db):
+        """Like fingerprint(), but ignores data changes (UPDATE_TIME / sample rows)."""
+        return self._refresh(db)["structure"]
+
+    def index(self, db):
+        """Lexical index over the current schema version, built once per fingerprint."""
+        entry = self._refresh(db)
+        if entry.get("index") is None:
+            entry["index"] = SchemaIndex(entry["tables"])
+        return entry["index"]
+
+    def snapshot(self, db):
+        """Tables, index and structure fingerprint from a single refresh, shared by a batch of questions."""
+        entry = self._refresh(db)
+        if entry.get("index") is None and len(entry["tables"]) > SCHEMA_PRUNE_TOP_K:
+            entry["index"] = SchemaIndex(entry["tables"])
+        return {"tables": entry["tables"], "index": entry.get("index"), "structure": entry["structure"]}
+
+    def invalidate(self, db):
+        """Force a fingerprint check on next use, e.g. after DDL/DML ran."""
+        with self._lock:
+            entry = self._entries.get(db_identity(db))
+            if entry is not None:
+                entry["checked_at"] = None
+
+    def forget(self, db):
+        with self._lock:
+            key = db_identity(db)
+            self._entries.pop(key, None)
+            self._locks.pop(key, None)
+
+    def _refresh(self, db):
+        key = db_identity(db)
+        with self._lock:
+            entry = self._entries.get(key)
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        if self._is_fresh(entry):
+            return entry
+
+        with key_lock:
+            entry = self._entries.get(key)
+            if self._is_fresh(entry):
+                return entry
+
+            snapshot = self._snapshot(db._engine)
+            previous = entry["tables"] if entry else {}
+            tables = {}
+            changed = []
+            for name, meta in snapshot.items():
+                old = previous.get(name)
+                if old is not None and old["fingerprint"] == meta["fingerprint"]:
+                    tables[name] = old
+                else:
+                    changed.append(name)
+                    tables[name] = dict(meta, info=self._render_table_info(db._engine, name))
+            if changed and previous:
+                print(f"Schema catalog refreshed {len(changed)} of {len(snapshot)} tables")
+
+            structure = _hash_parts(*sorted(f"{n}:{t['structure']}" for n, t in tables.items()))
+            same_structure = entry is not None and entry["structure"] == structure
+            entry = {
+                "fingerprint": _hash_parts(*sorted(f"{n}:{t['fingerprint']}" for n, t in tables.items())),
+                "structure": structure,
+                "tables": tables,
+                "checked_at": time.monotonic(),
+                "index": entry.get("index") if same_structure else None,
+            }
+            with self._lock:
+                self._entries[key] = entry
+            return entry
+
+    def _is_fresh(self, entry):
+        return (
+            entry is not None
+            and entry["checked_at"] is not None
+            and time.monotonic() - entry["checked_at"] < self.check_seconds
+        )
+
+    def _snapshot(self, target_engine):
+        if target_engine.dialect.name == "mysql":
+            return self._mysql_snapshot(target_engine)
+        return self._inspector_snapshot(target_engine)
+
+    def _mysql_snapshot(self, target_engine):
+        with target_engine.connect() as connection:
+            table_rows = connection.execute(MYSQL_TABLES_QUERY).fetchall()
+            column_rows = connection.execute(MYSQL_COLUMNS_QUERY).fetchall()
+            foreign_key_rows = connection.execute(MYSQL_FOREIGN_KEYS_QUERY).fetchall()
+
+        foreign_keys = {}
+        for table_name, column_name, referenced_table in foreign_key_rows:
+            foreign_keys.setdefault(table_name, []).append({"column": column_name, "references": referenced_table})
+
+        columns = {}
+        for table_name, column_name, column_type, nullable, column_key, default, comment in column_rows:
+            columns.setdefault(table_name, []).append({
+                "name": column_name,
+                "type": column_type,
+                "nullable": nullable == "YES",
+                "primary_key": column_key == "PRI",
+                "default": default,
+                "comment": comment or "",
+            })
+
+        snapshot = {}
+        for table_name, create_time, update_time, comment in table_rows:
+            table_columns = columns.get(table_name, [])
+            table_foreign_keys = foreign_keys.get(table_name, [])
+            structure = _hash_parts(comment, table_foreign_keys, *(sorted(c.items()) for c in table_columns))
+            snapshot[table_name] = {
+                "fingerprint": _hash_parts(create_time, update_time, structure),
+                "structure": structure,
+                "columns": table_columns,
+                "primary_key": [c["name"] for c in table_columns if c["primary_key"]],
+                "foreign_keys": table_foreign_keys,
+                "comment": comment or "",
+            }
+        return snapshot
+
+    def _inspector_snapshot(self, target_engine):
+        # Other dialects have no reliable UPDATE_TIME, so only structure is fingerprinted
+        inspector = inspect(target_engine)
+        snapshot = {}
+        for table_name in inspector.get_table_names():
+            primary_key = inspector.get_pk_constraint(table_name).get("constrained_columns") or []
+            table_columns = [{
+                "name": column["name"],
+                "type": str(column["type"]),
+                "nullable": bool(column.get("nullable", True)),
+                "primary_key": column["name"] in primary_key,
+                "default": column.get("default"),
+                "comment": column.get("comment") or "",
+            } for column in inspector.get_columns(table_name)]
+            table_foreign_keys = [
+                {"column": column, "references": fk["referred_table"]}
+                for fk in inspector.get_foreign_keys(table_name)
+                for column in fk["constrained_columns"]
+            ]
+            structure = _hash_parts(table_foreign_keys, *(sorted(c.items()) for c in table_columns))
+            snapshot[table_name] = {
+                "fingerprint": structure,
+                "structure": structure,
+                "columns": table_columns,
+                "primary_key": primary_key,
+                "foreign_keys": table_foreign_keys,
+                "comment": "",
+            }
+        return snapshot
+
+    def _render_table_info(self, target_engine, table_name):
+        # Same layout SQLDatabase.get_table_info() produces: CREATE TABLE plus sample rows
+        table = Table(table_name, MetaData(), autoload_with=target_engine)
+        for column in list(table.columns):
+            if isinstance(column.type, NullType):
+                table._columns.remove(column)
+        info = str(CreateTable(table).compile(target_engine)).rstrip()
+        if self.sample_rows <= 0:
+            return info
+
+        columns_str = "\t".join(column.name for column in table.columns)
+        try:
+            with target_engine.connect() as connection:
+                rows = connection.execute(select(table).limit(self.sample_rows)).fetchall()
+            sample_rows_str = "\n".join(
+                "\t".join(str(cell)[:100] for cell in row) for row in rows
+            )
+        except SQLAlchemyError:
+            sample_rows_str = ""
+        return (
+            f"{info}\n\n/*\n{self.sample_rows} rows from {table_name} table:\n"
+            f"{columns_str}\n{sample_rows_str}\n*/"
+        )
+
+schema_catalog = SchemaCatalog(SCHEMA_CHECK_SECONDS, SCHEMA_SAMPLE_ROWS)
+db_registry.on_dispose.append(schema_catalog.forget)
+
+# --- Schema Pruning ---
+# Large databases blow up the prompt, so only the tables most relevant to the
+# question (plus their foreign-key neighbours) are sent to the LLM.
+SCHEMA_PRUNE_TOP_K = int(os.getenv("SCHEMA_PRUNE_TOP_K", "8"))
+
+SCHEMA_STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "for", "to", "by", "and", "or", "is", "are", "was", "me", "show",
+    "list", "get", "give", "all", "what", "which", "who", "how", "many", "much", "with", "from", "each",
+    "per", "top", "find", "i", "my", "their", "there", "have", "has", "that", "this", "do", "does",
+}
+
+def estimate_tokens(text_value: str) -> int:
+    """Rough token count (~4 characters per token for English and SQL)."""
+    return (len(text_value) + 3) // 4
+
+def schema_tokens(value: str):
+    value = re.sub(r"([a-z0-9])([A-Z])", r"\1 \2", value or "")
+    tokens = []
+    for token in re.findall(r"[a-z0-9]+", value.lower()):
+        if token in SCHEMA_STOPWORDS:
+            continue
+        if token.endswith("ies") and len(token) > 4:
+            token = token[:-3] + "y"
+        elif token.endswith("s") and not token.endswith("ss") and len(token) > 3:
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+class SchemaIndex:
+    """BM25 index over table names, column names, comments and FK neighbours."""
+
+    def __init__(self, tables, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.neighbours = {name: set() for name in tables}
+        for name, meta in tables.items():
+            for fk in meta.get("foreign_keys", []):
+                if fk["references"] in self.neighbours and fk["references"] != name:
+                    self.neighbours[name].add(fk["references"])
+                    self.neighbours[fk["references"]].add(name)
+
+        self.documents = {}
+        for name, meta in tables.items():
+            tokens = schema_tokens(name) * 3 + schema_tokens(meta.get("comment", ""))
+            for column in meta["columns"]:
+                tokens += schema_tokens(column["name"]) + schema_tokens(column["comment"])
+            for neighbour in self.neighbours[name]:
+                tokens += schema_tokens(neighbour)
+            self.documents[name] = Counter(tokens)
+
+        self.doc_lengths = {name: sum(doc.values()) for name, doc in self.documents.items()}
+        self.avg_length = (sum(self.doc_lengths.values()) / len(self.documents)) if self.documents else 0
+        document_frequency = Counter()
+        for doc in self.documents.values():
+            document_frequency.update(doc.keys())
+        total = len(self.documents)
+        self.idf = {
+            token: math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for token, df in document_frequency.items()
+        }
+
+    def search(self, query: str, top_k: int):
+        """Return the top_k table names for query, expanded with their FK neighbours."""
+        query_tokens = set(schema_tokens(query))
+        scores = {}
+        for name, doc in self.documents.items():
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[name] / (self.avg_length or 1))
+            for token in query_tokens:
+                tf = doc.get(token)
+                if tf:
+                    score += self.idf[token] * tf * (self.k1 + 1) / (tf + norm)
+            if score > 0:
+                scores[name] = score
+
+        ranked = sorted(scores, key=lambda name: (-scores[name], name))[:top_k]
+        selected = set(ranked)
+        for name in ranked:
+            selected |= self.neighbours[name]
+        return selected
+
+def prune_schema(db, question: str, chat_history: str = "", snapshot=None):
+    """Return (schema_text, stats) restricted to tables relevant to the question.
+
+    With a snapshot from schema_catalog.snapshot() the catalog isn't consulted again.
+    """
+    tables = snapshot["tables"] if snapshot is not None else schema_catalog.tables(db)
+    full_tokens = sum(estimate_tokens(meta["info"]) for meta in tables.values())
+    selected = set(tables)
+    if len(tables) > SCHEMA_PRUNE_TOP_K:
+        index = snapshot["index"] if snapshot is not None else schema_catalog.index(db)
+        # The question is repeated so it outweighs incidental words in the history
+        matches = index.search(f"{question} {question} {chat_history}", SCHEMA_PRUNE_TOP_K)
+        if matches:
+            selected = matches
+
+    schema_text = "\n\n".join(tables[name]["info"] for name in sorted(selected))
+    stats = {
+        "tables_total": len(tables),
+        "tables_selected": len(selected),
+        "schema_tokens_full": full_tokens,
+        "schema_tokens_sent": estimate_tokens(schema_text),
+    }
+    # Separators can make a schema that wasn't pruned estimate a token over the full one
+    stats["schema_tokens_saved"] = max(0, stats["schema_tokens_full"] - stats["schema_tokens_sent"])
+    return schema_text, stats
+
+# --- NL-to-SQL Generation Cache ---
+# Analysts repeat the same questions; a hit skips the LLM round-trip entirely.
+SQL_CACHE_MAX_ENTRIES = int(os.getenv("SQL_CACHE_MAX_ENTRIES", "1000"))
+SQL_CACHE_TTL_SECONDS = int(os.getenv("SQL_CACHE_TTL_SECONDS", "86400"))
+SQL_CACHE_PERSIST = os.getenv("SQL_CACHE_PERSIST", "false").lower() in ("1", "true", "yes")
+
+class TTLCache:
+    """Thread-safe LRU cache whose entries expire ttl_seconds after insertion."""
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if time.monotonic() >= expires_at:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+def normalize_question(question: str) -> str:
+    return re.sub(r"\s+", " ", question).strip().rstrip("?.!;").strip().lower()
+
+class SQLGenerationCache:
+    """Generated SQL keyed on question, recent history, database and schema version."""
+
+    def __init__(self, max_entries, ttl_seconds, persist):
+        self.memory = TTLCache(max_entries, ttl_seconds)
+        self.ttl_seconds = ttl_seconds
+        self.persist = persist
+        self.hits = 0
+        self.persistent_hits = 0
+        self.misses = 0
+
+    def make_key(self, question, formatted_chat_history, db, structure=None):
+        return _hash_parts(
+            normalize_question(question),
+            _hash_parts(formatted_chat_history.strip()),
+            _hash_parts(db_identity(db)),  # never store credentials in the key
+            structure or schema_catalog.structure_fingerprint(db),
+        )
+
+    def get(self, key):
+        sql = self.memory.get(key)
+        if sql is not None:
+            self.hits += 1
+            return sql
+        if self.persist:
+            sql = self._load(key)
+            if sql is not None:
+                self.persistent_hits += 1
+                self.memory.set(key, sql)
+                return sql
+        self.misses += 1
+        return None
+
+    def set(self, key, sql):
+        self.memory.set(key, sql)
+        if self.persist:
+            self._store(key, sql)
+
+    def stats(self):
+        lookups = self.hits + self.persistent_hits + self.misses
+        return {
+            "entries": len(self.memory),
+            "hits": self.hits,
+            "persistent_hits": self.persistent_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.persistent_hits) / lookups, 4) if lookups else 0.0,
+            "persistent": self.persist,
+        }
+
+    def _load(self, key):
+        db_session = ReadSessionLocal()
+        try:
+            row = db_session.get(GeneratedSQL, key)
+            if row is None:
+                return None
+            if datetime.utcnow() - row.created_at > timedelta(seconds=self.ttl_seconds):
+                def expire(writer_session):
+                    writer_session.query(GeneratedSQL).filter(GeneratedSQL.cache_key == key).delete()
+
+                self._write(expire)
+                return None
+            return row.sql
+        except SQLAlchemyError as e:
+            print(f"SQL cache read failed: {e}")
+            return None
+        finally:
+            db_session.close()
+
+    def _store(self, key, sql):
+        def write(db_session):
+            db_session.merge(GeneratedSQL(cache_key=key, sql=sql, created_at=datetime.utcnow()))
+
+        self._write(write)
+
+    @staticmethod
+    def _write(func):
+        """Queue a cache write on the single writer without waiting for it; failures are only logged."""
+        def report(future):
+            if future.exception() is not None:
+                print(f"SQL cache write failed: {future.exception()}")
+        session_writer.submit(func).add_done_callback(report)
+
+sql_generation_cache = SQLGenerationCache(SQL_CACHE_MAX_ENTRIES, SQL_CACHE_TTL_SECONDS, SQL_CACHE_PERSIST)
+
 # --- Auth Helpers ---
 def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+    return password_hashing.verify_password(plain_password, hashed_password)
 
 def get_password_hash(password):
-    return pwd_context.hash(password)
+    return password_hashing.hash_password(password)
+
+# --- Password Hashing Pool ---
+# bcrypt is CPU-bound and holds the GIL for ~250 ms, so it runs in worker
+# processes. Past BCRYPT_MAX_PENDING queued calls we shed load with a 503
+# instead of letting a login burst queue up without bound.
+BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", str(os.cpu_count() or 2)))
+BCRYPT_MAX_PENDING = int(os.getenv("BCRYPT_MAX_PENDING", str(BCRYPT_WORKERS * 4)))
+BCRYPT_RETRY_AFTER_SECONDS = int(os.getenv("BCRYPT_RETRY_AFTER_SECONDS", "1"))
+
+class HashingPool:
+    """Bounded process pool for password hashing; used only from the event loop thread."""
+
+    def __init__(self, workers, max_pending, retry_after_seconds):
+        self.workers = workers
+        self.max_pending = max_pending
+        self.retry_after_seconds = retry_after_seconds
+        self._executor = None
+        self.pending = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0  # Successful calls only
+
+    async def run(self, func, *args):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HTTPException(
+                status_code=503,
+                detail="Authentication is busy, please retry shortly.",
+                headers={"Retry-After": str(self.retry_after_seconds)},
+            )
+        self.pending += 1
+        started = time.perf_counter()
+        try:
+            loop = asyncio.get_running_loop()
+            try:
+                result = await loop.run_in_executor(self._get_executor(), func, *args)
+            except BrokenProcessPool:
+                # A worker died; start a fresh pool and retry once
+                self.shutdown()
+                result = await loop.run_in_executor(self._get_executor(), func, *args)
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+        self.completed += 1
+        self.total_seconds += time.perf_counter() - started
+        return result
+
+    def stats(self):
+        return {
+            "workers": self.workers,
+            "max_pending": self.max_pending,
+            "pending": self.pending,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "avg_ms": round(self.total_seconds / self.completed * 1000, 1) if self.completed else None,
+        }
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+hashing_pool = HashingPool(BCRYPT_WORKERS, BCRYPT_MAX_PENDING, BCRYPT_RETRY_AFTER_SECONDS)
+
+def get_user(identifier: str, db):
+    return db.query(User).filter(User.email == identifier).first()
+
+# Removed get_current_user function as JWT auth is removed
+
+# --- Read Replica Routing ---
+# A connection profile may list read replicas. Generated SELECTs (chat, result
+# pages, streams, exports) go to the healthy replica with the fewest queries in
+# flight whose replication lag is within REPLICA_MAX_LAG_SECONDS; everything
+# else, and any SELECT when no replica qualifies, runs on the primary.
+REPLICA_MAX_LAG_SECONDS = float(os.getenv("REPLICA_MAX_LAG_SECONDS", "30"))
+REPLICA_CHECK_SECONDS = float(os.getenv("REPLICA_CHECK_SECONDS", "10"))
+
+# Replica URIs for the current request, set by resolve_db()
+read_replicas = contextvars.ContextVar("read_replicas", default=())
+
+def pool_label(uri):
+    """host:port/database, without credentials, for metrics and logs."""
+    url = make_url(uri)
+    return f"{url.host}:{url.port or ''}/{url.database}" if url.host else str(url.database)
+
+class ReplicaRouter:
+    """Per-pool outstanding-query counts, replica lag checks and routing counters."""
+
+    def __init__(self, max_lag_seconds, check_seconds):
+        self.max_lag_seconds = max_lag_seconds
+        self.check_seconds = check_seconds
+        self._pools = {}
+        self._lock = threading.Lock()
+        self.failovers = 0
+
+    def _pool(self, uri, role):
+        pool = self._pools.get(uri)
+        if pool is None:
+            pool = self._pools[uri] = {
+                "label": pool_label(uri), "role": role, "outstanding": 0, "queries": 0, "errors": 0,
+                "lag_seconds": None, "healthy": True, "checked_at": None,
+            }
+        return pool
+
+    def candidates(self, replica_uris):
+        """Usable replicas, least outstanding queries first."""
+        usable = []
+        for uri in replica_uris:
+            with self._lock:
+                pool = self._pool(uri, "replica")
+                stale = pool["checked_at"] is None or time.monotonic() - pool["checked_at"] >= self.check_seconds
+            if stale:
+                self.check(uri)
+            with self._lock:
+                if pool["healthy"] and pool["lag_seconds"] is not None and pool["lag_seconds"] <= self.max_lag_seconds:
+                    usable.append((pool["outstanding"], pool["queries"], uri))
+        return [uri for _, _, uri in sorted(usable)]
+
+    def check(self, uri):
+        try:
+            lag = replica_lag_seconds(db_registry.get(uri))
+            healthy = lag is not None
+        except Exception as e:
+            print(f"Replica check failed for {pool_label(uri)}: {e}")
+            lag, healthy = None, False
+        with self._lock:
+            pool = self._pool(uri, "replica")
+            pool.update(lag_seconds=lag, healthy=healthy, checked_at=time.monotonic())
+
+    def mark_unhealthy(self, uri, error):
+        print(f"Replica {pool_label(uri)} unavailable: {error}")
+        with self._lock:
+            pool = self._pool(uri, "replica")
+            pool.update(healthy=False, checked_at=time.monotonic())
+            pool["errors"] += 1
+
+    def begin(self, uri, role):
+        with self._lock:
+            pool = self._pool(uri, role)
+            pool["outstanding"] += 1
+            pool["queries"] += 1
+
+    def end(self, uri):
+        with self._lock:
+            self._pools[uri]["outstanding"] -= 1
+
+    def record_failover(self):
+        with self._lock:
+            self.failovers += 1
+
+    def stats(self):
+        with self._lock:
+            return {"failovers": self.failovers, "pools": [dict(pool) for pool in self._pools.values()]}
+
+def replica_lag_seconds(db):
+    """Seconds behind the source; None when replication is broken. Non-replicas count as current."""
+    if db.dialect != "mysql":
+        return 0.0
+    with db._engine.connect() as connection:
+        try:
+            status = connection.exec_driver_sql("SHOW REPLICA STATUS").mappings().first()
+            lag_column = "Seconds_Behind_Source"
+        except SQLAlchemyError:
+            # MySQL before 8.0.22
+            status = connection.exec_driver_sql("SHOW SLAVE STATUS").mappings().first()
+            lag_column = "Seconds_Behind_Master"
+    if status is None:
+        return 0.0
+    lag = status.get(lag_column)
+    return None if lag is None else float(lag)
+
+replica_router = ReplicaRouter(REPLICA_MAX_LAG_SECONDS, REPLICA_CHECK_SECONDS)
+
+def open_read_connection(db, replica_uris=None):
+    """(connection, pool_uri) for a SELECT; release with replica_router.end(pool_uri) after closing."""
+    if replica_uris is None:
+        replica_uris = read_replicas.get()
+    for uri in replica_router.candidates(replica_uris) if replica_uris else ():
+        try:
+            connection = db_registry.get(uri)._engine.connect()
+        except Exception as e:
+            replica_router.mark_unhealthy(uri, e)
+            continue
+        replica_router.begin(uri, "replica")
+        return connection, uri
+    if replica_uris:
+        replica_router.record_failover()
+    primary_uri = db_identity(db)
+    connection = db._engine.connect()
+    replica_router.begin(primary_uri, "primary")
+    return connection, primary_uri
+
+def collect_pool_metrics():
+    stats = replica_router.stats()
+    pools = stats["pools"]
+    return [
+        ("querygenie_db_pool_outstanding", "gauge", "Queries in flight per database pool.", [
+            ({"pool": pool["label"], "role": pool["role"]}, pool["outstanding"]) for pool in pools
+        ]),
+        ("querygenie_db_pool_queries_total", "counter", "Read queries routed to each pool.", [
+            ({"pool": pool["label"], "role": pool["role"]}, pool["queries"]) for pool in pools
+        ]),
+        ("querygenie_db_pool_errors_total", "counter", "Connection failures per replica.", [
+            ({"pool": pool["label"], "role": pool["role"]}, pool["errors"]) for pool in pools
+        ]),
+        ("querygenie_replica_lag_seconds", "gauge", "Last measured replication lag.", [
+            ({"pool": pool["label"]}, pool["lag_seconds"]) for pool in pools if pool["role"] == "replica"
+        ]),
+        ("querygenie_replica_healthy", "gauge", "1 when the replica passed its last check.", [
+            ({"pool": pool["label"]}, int(pool["healthy"])) for pool in pools if pool["role"] == "replica"
+        ]),
+        ("querygenie_replica_failovers_total", "counter", "Reads sent to the primary because no replica qualified.", [
+            ({}, stats["failovers"])
+        ]),
+    ]
+
+# --- Connection Profiles ---
+# /api/connect stores the target database in users.db and returns a
+# connection_id, so any worker process can serve the follow-up requests.
+# Profiles belong to the user_id that created them and resolve only for that
+# user; URIs are stored encrypted (see Connection Secrets).
+# Each process keeps a short-lived local copy of resolved profiles; engines
+# are cached per URI by db_registry.
+CONNECTION_PROFILE_CACHE_SECONDS = float(os.getenv("CONNECTION_PROFILE_CACHE_SECONDS", "30"))
+
+class ConnectionProfileStore:
+    def __init__(self, cache_seconds):
+        self.cache = TTLCache(max_entries=1024, ttl_seconds=cache_seconds)
+
+    async def create(self, db_uri, database, user_id, replica_uris=()):
+        connection_id = secrets.token_urlsafe(24)
+
+        def write(db_session):
+            db_session.add(ConnectionProfile(
+                id=connection_id, user_id=user_id, db_uri=mask_db_uri(db_uri),
+                replica_uris=json.dumps([mask_db_uri(uri) for uri in replica_uris]),
+                secret=encrypt_connection_secret(db_uri, replica_uris),
+                database=database, created_at=datetime.utcnow()
+            ))
+            return connection_id
+
+        await session_writer.run(write)
+        self.cache.set(connection_id, (db_uri, tuple(replica_uris), user_id))
+        return connection_id
+
+    def load(self, connection_id, user_id):
+        """(db_uri, replica_uris) for a profile owned by user_id, or None."""
+        entry = self.cache.get(connection_id)
+        if entry is None:
+            db_session = ReadSessionLocal()
+            try:
+                profile = db_session.query(ConnectionProfile).filter(ConnectionProfile.id == connection_id).first()
+                if profile is not None and profile.secret:
+                    entry = (*decrypt_connection_secret(profile.secret), profile.user_id)
+            finally:
+                db_session.close()
+            if entry is not None:
+                self.cache.set(connection_id, entry)
+        if entry is None or user_id is None or entry[2] != user_id:
+            return None
+        return entry[0], entry[1]
+
+    async def delete(self, connection_id, user_id):
+        """Delete a profile owned by user_id; returns its db_uri, or None if there was none."""
+        def write(db_session):
+            profile = (
+                db_session.query(ConnectionProfile)
+                .filter(ConnectionProfile.id == connection_id, ConnectionProfile.user_id == user_id)
+                .first()
+            )
+            if profile is None or not profile.secret:
+                return None
+            db_uri, _ = decrypt_connection_secret(profile.secret)
+            db_session.delete(profile)
+            return db_uri
+
+        db_uri = await session_writer.run(write)
+        self.cache.clear()
+        return db_uri
+
+connection_profiles = ConnectionProfileStore(CONNECTION_PROFILE_CACHE_SECONDS)
+
+async def resolve_db_uris(connection_id=None, user_id=None):
+    """(primary URI, replica URIs) for user_id's connection_id, or the process-wide connection for older clients."""
+    if connection_id:
+        target = await run_blocking(connection_profiles.load, connection_id, user_id, stage="connection lookup")
+        if target is None:
+            # Same answer for a missing profile and someone else's, so IDs can't be probed
+            raise HTTPException(status_code=404, detail="Unknown connection_id")
+        return target
+    if not hasattr(app.state, "db_uri"):
+        raise HTTPException(status_code=400, detail="Database not connected")
+    return app.state.db_uri, getattr(app.state, "replica_uris", ())
+
+async def resolve_db(connection_id=None, route_reads=True, user_id=None):
+    """Primary SQLDatabase; with route_reads, this request's SELECTs may go to the profile's replicas."""
+    db_uri, replica_uris = await resolve_db_uris(connection_id, user_id)
+    read_replicas.set(replica_uris if route_reads else ())
+    return await run_blocking(db_registry.get, db_uri, stage="database connect")
+
+# --- DB & LangChain Helpers ---
+def init_database(user, password, host, port, database):
+    try:
+        db_uri = f"mysql+mysqlconnector://{user}:{password}@{host}:{port}/{database}"
+        return db_registry.get(db_uri)
+    except SQLAlchemyError as e:
+        raise HTTPException(status_code=400, detail=f"DB connection failed: {e}")
+
+# --- Shared LLM Client & Chain ---
+# The prompt, the Groq client (with its HTTP connection pool) and the runnable
+# pipeline are built once and shared; only the schema varies per request.
+GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.1-8b-instant")
+GROQ_MAX_RETRIES = int(os.getenv("GROQ_MAX_RETRIES", "3"))
+GROQ_TIMEOUT_SECONDS = float(os.getenv("GROQ_TIMEOUT_SECONDS", "30"))
+GROQ_MAX_CONNECTIONS = int(os.getenv("GROQ_MAX_CONNECTIONS", "20"))
+GROQ_MAX_KEEPALIVE = int(os.getenv("GROQ_MAX_KEEPALIVE", "10"))
+GROQ_KEEPALIVE_SECONDS = float(os.getenv("GROQ_KEEPALIVE_SECONDS", "60"))
+# Plan limits for batch generation (Groq free tier for llama-3.1-8b-instant); 0 disables
+GROQ_REQUESTS_PER_MINUTE = int(os.getenv("GROQ_REQUESTS_PER_MINUTE", "30"))
+GROQ_TOKENS_PER_MINUTE = int(os.getenv("GROQ_TOKENS_PER_MINUTE", "6000"))
+GROQ_COMPLETION_TOKENS = int(os.getenv("GROQ_COMPLETION_TOKENS", "200"))  # Budgeted per call for the answer
+
+SQL_PROMPT_TEMPLATE = """
+    You are a MySQL expert. Given the schema and chat history,
+    generate a SINGLE valid MySQL statement (DDL, DML, DCL, TCL, or queries with JOINS/CONSTRAINTS/TRIGGERS).
+    
+    IMPORTANT RULES:
+    1. When using aggregate functions (AVG, SUM, COUNT, MAX, MIN), you MUST include a GROUP BY clause for any non-aggregated columns in SELECT
+    2. If you select both aggregated and non-aggregated columns, GROUP BY the non-aggregated ones
+    3. Include only the SQL; no explanations, markdown, or extra text
+    4. Ensure the query is compatible with sql_mode=only_full_group_by
+    5. For aggregate queries, structure should be: SELECT column, AGG_FUNC(column) FROM table GROUP BY column
+
+    Schema:
+    {schema}
+
+    Chat History (recent context):
+    {chat_history}
+
+    User Question:
+    {question}
+
+    Your response must contain ONLY the SQL statement. Do NOT add any extra text, commentary, or code formatting like ```sql.
+    """
+
+SQL_PROMPT = ChatPromptTemplate.from_template(SQL_PROMPT_TEMPLATE)
+
+_sql_generation_chain = None
+_sql_completion_chain = None  # llm | parser, for callers that format the prompt themselves
+_sql_chain_lock = threading.Lock()
+groq_http_clients = []
+
+def build_groq_llm():
+    """ChatGroq backed by keep-alive HTTP pools; the groq SDK retries with exponential backoff."""
+    llm = ChatGroq(
+        api_key=groq_api_key,
+        model=GROQ_MODEL,
+        temperature=0,
+        max_retries=GROQ_MAX_RETRIES,
+        timeout=GROQ_TIMEOUT_SECONDS,
+    )
+    limits = httpx.Limits(
+        max_connections=GROQ_MAX_CONNECTIONS,
+        max_keepalive_connections=GROQ_MAX_KEEPALIVE,
+        keepalive_expiry=GROQ_KEEPALIVE_SECONDS,
+    )
+    http_client = httpx.Client(limits=limits)
+    http_async_client = httpx.AsyncClient(limits=limits)
+    client_options = {"api_key": groq_api_key, "max_retries": GROQ_MAX_RETRIES, "timeout": GROQ_TIMEOUT_SECONDS}
+    # ChatGroq builds both SDK clients from a single http_client option, so we
+    # install our own sync/async clients with explicit pool limits instead
+    llm.client = groq.Groq(http_client=http_client, **client_options).chat.completions
+    llm.async_client = groq.AsyncGroq(http_client=http_async_client, **client_options).chat.completions
+    groq_http_clients.extend([http_client, http_async_client])
+    return llm
+
+def get_sql_generation_chain():
+    """Shared prompt | llm | parser; expects schema, chat_history and question inputs."""
+    if _sql_generation_chain is None:
+        with _sql_chain_lock:
+            if _sql_generation_chain is None:
+                install_sql_llm(build_groq_llm())
+    return _sql_generation_chain
+
+def get_sql_completion_chain():
+    """The llm | parser half of the SQL chain; takes an already formatted prompt."""
+    get_sql_generation_chain()
+    return _sql_completion_chain
+
+def install_sql_llm(llm):
+    global _sql_generation_chain, _sql_completion_chain
+    _sql_completion_chain = llm | StrOutputParser()
+    _sql_generation_chain = SQL_PROMPT | _sql_completion_chain
+
+def build_sql_prompt(schema, question, formatted_chat_history):
+    with timed_stage("prompt"):
+        prompt_value = SQL_PROMPT.format_prompt(
+            schema=schema, question=question, chat_history=formatted_chat_history
+        )
+        record_prompt_tokens(
+            estimate_tokens(prompt_value.to_string()),
+            schema=estimate_tokens(schema), history=estimate_tokens(formatted_chat_history),
+        )
+    return prompt_value
+
+def set_sql_llm(llm):
+    """Swap the chat model behind the shared SQL chain, e.g. a fake model for benchmarks."""
+    with _sql_chain_lock:
+        install_sql_llm(llm)
+
+class TokenBucket:
+    """Refills per_minute units a minute, holding at most one minute's worth; 0 means unlimited."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, amount=1):
+        """Wait until amount units are available and take them; returns the seconds waited."""
+        if not self.capacity:
+            return 0.0
+        amount = min(amount, self.capacity)  # A single oversized call must not wait forever
+        started = time.monotonic()
+        async with self._lock:  # Waiters are served in arrival order
+            while True:
+                now = time.monotonic()
+                self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.available >= amount:
+                    self.available -= amount
+                    return now - started
+                await asyncio.sleep((amount - self.available) / self.rate)
+
+class LLMRateLimiter:
+    """Request and token budgets every rate-limited LLM call must draw from before it is sent."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.waited_seconds = 0.0
+
+    async def acquire(self, prompt_value):
+        with timed_stage("rate_limit"):
+            waited = await self.requests.acquire(1)
+            waited += await self.tokens.acquire(estimate_tokens(prompt_value.to_string()) + GROQ_COMPLETION_TOKENS)
+        self.waited_seconds += waited
+
+llm_rate_limiter = LLMRateLimiter(GROQ_REQUESTS_PER_MINUTE, GROQ_TOKENS_PER_MINUTE)
+
+async def close_groq_http_clients():
+    while groq_http_clients:
+        client = groq_http_clients.pop()
+        if isinstance(client, httpx.AsyncClient):
+            await client.aclose()
+        else:
+            client.close()
+
+def get_prompt_schema(db, question, formatted_chat_history, snapshot=None):
+    with timed_stage("schema"):
+        schema_text, stats = prune_schema(db, question, formatted_chat_history, snapshot)
+    logger.debug(
+        "Schema pruning: %d/%d tables, ~%d of ~%d tokens (saved ~%d)",
+        stats["tables_selected"], stats["tables_total"], stats["schema_tokens_sent"],
+        stats["schema_tokens_full"], stats["schema_tokens_saved"],
+    )
+    return schema_text
+
+def get_sql_chain(db):
+    def get_schema(inputs):
+        return get_prompt_schema(db, inputs["question"], inputs.get("chat_history", ""))
+    return RunnablePassthrough.assign(schema=get_schema) | get_sql_generation_chain()
+
+# --- Result Handles & Pagination ---
+# SELECT responses carry only the first page. When there is more, a handle
+# remembers the SQL and how to page it: keyset on the primary key for simple
+# single-table queries, bounded OFFSET for everything else. OFFSET pages need
+# a fixed row order, so a query without ORDER BY is paged in the order of all
+# its columns.
+RESULT_PAGE_SIZE = int(os.getenv("RESULT_PAGE_SIZE", "500"))
+RESULT_HANDLE_TTL_SECONDS = int(os.getenv("RESULT_HANDLE_TTL_SECONDS", "900"))
+RESULT_HANDLES_PER_USER = int(os.getenv("RESULT_HANDLES_PER_USER", "20"))
+RESULT_MAX_OFFSET = int(os.getenv("RESULT_MAX_OFFSET", "100000"))
+
+KEYSET_BLOCKERS = re.compile(r"\b(JOIN|GROUP\s+BY|ORDER\s+BY|LIMIT|UNION|DISTINCT|HAVING)\b|\(\s*SELECT", re.IGNORECASE)
+SINGLE_TABLE_SELECT = re.compile(
+    r"^\s*SELECT\s+(?P<select_list>.+?)\s+FROM\s+`?(?P<table>\w+)`?"
+    r"(?:\s+(?:AS\s+)?(?!WHERE\b)\w+)?\s*(?:WHERE\s+.*)?$",
+    re.IGNORECASE | re.DOTALL,
+)
+
+def strip_statement_terminator(sql_query: str) -> str:
+    return sql_query.strip().rstrip(";").rstrip()
+
+def query_shape(sql_query, dialect):
+    """(has ORDER BY, has LIMIT, column count or None when a * hides it) for the top-level query."""
+    if sqlglot is not None:
+        try:
+            statements = parse_sql(sql_query, SQLGLOT_DIALECTS.get(dialect, "mysql"))
+        except ParseError:
+            statements = ()
+        if len(statements) == 1 and is_query(statements[0]):
+            statement = statements[0]
+            selects = getattr(statement, "selects", None) or []
+            width = None if not selects or any(select.is_star for select in selects) else len(selects)
+            return statement.args.get("order") is not None, statement.args.get("limit") is not None, width
+    # Without a parse tree a keyword anywhere counts, even in a subquery
+    return (
+        re.search(r"\bORDER\s+BY\b", sql_query, re.IGNORECASE) is not None,
+        re.search(r"\bLIMIT\b", sql_query, re.IGNORECASE) is not None,
+        None,
+    )
+
+def query_limit(sql_query):
+    """(row count, rows skipped) from the query's own trailing LIMIT, or None."""
+    match = TRAILING_LIMIT.search(sql_query)
+    if match is None:
+        return None
+    first, second = int(match.group("first")), match.group("second")
+    if second is None:
+        return [first, 0]
+    if match.group("separator") == ",":  # LIMIT skip, count
+        return [int(second), first]
+    return [first, int(second)]  # LIMIT count OFFSET skip
+
+def plan_pagination(sql_query, db):
+    """Pick a paging strategy: {"strategy": "keyset", "key_columns": [...]} or {"strategy": "offset", ...}.
+
+    An OFFSET plan records whether the query orders its rows, how many columns
+    it selects (None until known) and its own LIMIT, which pages are cut from.
+    A LIMIT that can't be read that way is kept by paging the query as a
+    derived table ("wrap").
+    """
+    sql_query = strip_statement_terminator(sql_query)
+    match = SINGLE_TABLE_SELECT.match(sql_query)
+    if match and not KEYSET_BLOCKERS.search(sql_query):
+        table = schema_catalog.tables(db).get(match.group("table"))
+        primary_key = table["primary_key"] if table else []
+        select_list = match.group("select_list").strip()
+        selected = {item.strip().strip("`").split(".")[-1].strip("`") for item in select_list.split(",")}
+        if primary_key and (select_list == "*" or all(column in selected for column in primary_key)):
+            return {"strategy": "keyset", "key_columns": primary_key}
+    ordered, limited, width = query_shape(sql_query, db.dialect)
+    limit = query_limit(sql_query)
+    return {
+        "strategy": "offset", "ordered": ordered, "order_columns": width,
+        "limit": limit, "wrap": limited and limit is None,
+    }
+
+def encode_page_cursor(value) -> str:
+    return base64.urlsafe_b64encode(json.dumps(value, default=str).encode("utf-8")).decode("ascii")
+
+CURSOR_KEY_TYPES = (str, int, float)
+
+def decode_page_cursor(cursor: str, plan):
+    """Decode a client cursor and check it has the shape plan's strategy produces."""
+    try:
+        value = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeError):
+        raise HTTPException(status_code=400, detail="Invalid page cursor")
+    if plan["strategy"] == "keyset":
+        keys = value.get("k") if isinstance(value, dict) else None
+        valid = (
+            isinstance(keys, list) and len(keys) == len(plan["key_columns"])
+            and all(isinstance(key, CURSOR_KEY_TYPES) and not isinstance(key, bool) for key in keys)
+        )
+    else:
+        offset = value.get("o") if isinstance(value, dict) else None
+        valid = isinstance(offset, int) and not isinstance(offset, bool) and offset >= 0
+    if not valid:
+        raise HTTPException(status_code=400, detail="Invalid page cursor")
+    return value
+
+def build_page_query(connection, sql_query, plan, cursor, page_size):
+    """Return (statement, params) for the page after cursor (None for the first page)."""
+    sql_query = strip_statement_terminator(sql_query)
+    params = {"_qg_limit": page_size + 1}
+
+    if plan["strategy"] == "keyset":
+        quote = connection.dialect.identifier_preparer.quote
+        keys = [quote(column) for column in plan["key_columns"]]
+        where = ""
+        if cursor is not None:
+            # (a, b) > (x, y) expanded so MySQL can use the primary key range
+            clauses = []
+            for i, key in enumerate(keys):
+                equal = [f"{keys[j]} = :_qg_k{j}" for j in range(i)]
+                clauses.append("(" + " AND ".join(equal + [f"{key} > :_qg_k{i}"]) + ")")
+            where = " WHERE " + " OR ".join(clauses)
+            params.update({f"_qg_k{i}": value for i, value in enumerate(cursor["k"])})
+        statement = f"SELECT * FROM ({sql_query}) AS _qg_page{where} ORDER BY {', '.join(keys)} LIMIT :_qg_limit"
+        return text(statement), params
+
+    offset = cursor["o"] if cursor is not None else 0
+    if offset > RESULT_MAX_OFFSET:
+        raise HTTPException(
+            status_code=400,
+            detail="Result is too large to page this far; refine the question or export the results.",
+        )
+    ordered = plan["ordered"]
+    if plan["limit"] is not None:
+        # Cut the page out of the query's own LIMIT rather than wrapping it, which would drop its ORDER BY
+        count, skip = plan["limit"]
+        sql_query = sql_query[:TRAILING_LIMIT.search(sql_query).start()].rstrip()
+        params["_qg_limit"] = max(0, min(page_size + 1, count - offset))
+        offset += skip
+    elif plan["wrap"]:
+        # The derived table keeps no row order, so its pages are ordered by every column
+        sql_query, ordered = f"SELECT * FROM ({sql_query}) AS _qg_page", False
+    if not ordered:
+        if plan["order_columns"] is None:
+            plan["order_columns"] = len(connection.execute(text(f"{sql_query} LIMIT 0")).keys())
+        sql_query += " ORDER BY " + ", ".join(str(position) for position in range(1, plan["order_columns"] + 1))
+    params["_qg_offset"] = offset
+    return text(f"{sql_query} LIMIT :_qg_limit OFFSET :_qg_offset"), params
+
+def fetch_page(connection, sql_query, plan, cursor, page_size):
+    """Return (columns, rows, next_cursor); rows hold native values, next_cursor is None on the last page."""
+    with timed_stage("db"), track_running_query(connection):
+        statement, params = build_page_query(connection, sql_query, plan, cursor, page_size)
+        result_proxy = connection.execute(statement, params)
+        columns = list(result_proxy.keys())
+        rows = result_proxy.fetchmany(page_size + 1)
+        result_proxy.close()
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        if plan["strategy"] == "keyset":
+            last = rows[-1]._mapping
+            next_cursor = encode_page_cursor({"k": [last[column] for column in plan["key_columns"]]})
+        else:
+            offset = cursor["o"] if cursor is not None else 0
+            next_cursor = encode_page_cursor({"o": offset + page_size})
+    with timed_stage("rows"):
+        data = [list(row) for row in rows]
+    return columns, data, next_cursor
+
+class ResultHandleStore:
+    """In-memory result handles with a TTL and a per-user cap (oldest evicted first)."""
+
+    def __init__(self, ttl_seconds, per_user):
+        self.ttl_seconds = ttl_seconds
+        self.per_user = per_user
+        self._handles = OrderedDict()
+        self._lock = threading.Lock()
+
+    def register(self, user_id, db, sql_query, columns, plan):
+        result_id = uuid.uuid4().hex
+        with self._lock:
+            self._purge_expired()
+            self._handles[result_id] = {
+                "user_id": user_id,
+                "db_key": _hash_parts(db_identity(db)),
+                "sql": sql_query,
+                "columns": columns,
+                "plan": plan,
+                "expires_at": time.monotonic() + self.ttl_seconds,
+            }
+            owned = [rid for rid, handle in self._handles.items() if handle["user_id"] == user_id]
+            for rid in owned[:-self.per_user]:
+                del self._handles[rid]
+        return result_id
+
+    def get(self, result_id, user_id, db):
+        with self._lock:
+            self._purge_expired()
+            handle = self._handles.get(result_id)
+            if handle is None:
+                raise HTTPException(status_code=404, detail="Result not found or expired")
+            if handle["user_id"] != user_id:
+                raise HTTPException(status_code=403, detail="Unauthorized to read this result")
+            if handle["db_key"] != _hash_parts(db_identity(db)):
+                raise HTTPException(status_code=409, detail="Result belongs to a different database connection")
+            handle["expires_at"] = time.monotonic() + self.ttl_seconds
+            return handle
+
+    def _purge_expired(self):
+        now = time.monotonic()
+        for rid in [rid for rid, handle in self._handles.items() if handle["expires_at"] <= now]:
+            del self._handles[rid]
+
+result_handles = ResultHandleStore(RESULT_HANDLE_TTL_SECONDS, RESULT_HANDLES_PER_USER)
+
+def fetch_handle_page(db, handle, cursor, page_size):
+    connection, pool_uri = open_read_connection(db)
+    try:
+        return fetch_page(connection, handle["sql"], handle["plan"], cursor, page_size)
+    finally:
+        connection.close()
+        replica_router.end(pool_uri)
+
+# --- Query Result Cache ---
+# Dashboards re-run the same SELECTs constantly. First pages are cached per
+# database + normalized SQL within a byte budget, and each entry records the
+# tables it reads so writes through this app evict exactly what they touch.
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESULT_CACHE_MAX_ENTRY_BYTES", str(4 * 1024 * 1024)))
+RESULT_CACHE_TTL_SECONDS = int(os.getenv("RESULT_CACHE_TTL_SECONDS", "60"))
+
+def normalize_sql(sql_query: str) -> str:
+    return re.sub(r"\s+", " ", strip_statement_terminator(sql_query))
+
+def referenced_tables(db, sql_query):
+    """Known tables whose names appear in sql_query (conservative: over-matching only over-invalidates)."""
+    known = {name.lower(): name for name in schema_catalog.tables(db)}
+    identifiers = {token.lower() for token in re.findall(r"\w+", sql_query)}
+    return {known[token] for token in identifiers & known.keys()}
+
+class ResultCache:
+    """Byte-budgeted LRU cache of SELECT first pages with per-table invalidation."""
+
+    def __init__(self, max_bytes, max_entry_bytes, ttl_seconds):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()  # key -> {"value", "size", "tables", "db_key", "expires_at"}
+        self._by_table = {}  # (db_key, table) -> set(keys)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _key(self, db, sql_query):
+        db_key = _hash_parts(db_identity(db))
+        return db_key, _hash_parts(db_key, normalize_sql(sql_query))
+
+    def get(self, db, sql_query):
+        _, key = self._key(db, sql_query)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["expires_at"] <= time.monotonic():
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["value"]
+
+    def put(self, db, sql_query, value):
+        size = len(json.dumps(value, default=str))
+        if size > self.max_entry_bytes:
+            return
+        db_key, key = self._key(db, sql_query)
+        tables = referenced_tables(db, sql_query)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = {
+                "value": value,
+                "size": size,
+                "tables": tables,
+                "db_key": db_key,
+                "expires_at": time.monotonic() + self.ttl_seconds,
+            }
+            self._bytes += size
+            for table in tables:
+                self._by_table.setdefault((db_key, table), set()).add(key)
+            while self._bytes > self.max_bytes and self._entries:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_for_write(self, db, sql_query):
+        """Drop entries reading any table the write mentions, or the whole database if none are known."""
+        db_key = _hash_parts(db_identity(db))
+        tables = referenced_tables(db, sql_query)
+        with self._lock:
+            if tables:
+                keys = set()
+                for table in tables:
+                    keys |= self._by_table.get((db_key, table), set())
+            else:
+                keys = {key for key, entry in self._entries.items() if entry["db_key"] == db_key}
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._bytes -= entry["size"]
+        for table in entry["tables"]:
+            keys = self._by_table.get((entry["db_key"], table))
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[(entry["db_key"], table)]
+
+result_cache = ResultCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_MAX_ENTRY_BYTES, RESULT_CACHE_TTL_SECONDS)
+
+# --- Local SQL Validation ---
+# Generated SQL is parsed and bound against the schema catalog before it is
+# sent to the database: tables and columns must exist and SELECT lists must
+# satisfy only_full_group_by. A failure goes back to the LLM with the exact
+# error, up to SQL_REPAIR_MAX_ATTEMPTS times; if it still fails, the last SQL
+# runs anyway and the database has the final word.
+SQL_VALIDATION = os.getenv("SQL_VALIDATION", "true").lower() in ("1", "true", "yes")
+SQL_REPAIR_MAX_ATTEMPTS = int(os.getenv("SQL_REPAIR_MAX_ATTEMPTS", "2"))
+
+SQL_REPAIR_PROMPT_TEMPLATE = """
+    You are a MySQL expert. The SQL below was generated for the user's question
+    but fails validation against the schema.
+
+    Schema:
+    {schema}
+
+    User Question:
+    {question}
+
+    SQL:
+    {sql}
+
+    Error:
+    {error}
+
+    Fix the error and return ONLY the corrected SQL statement. Do NOT add any extra text, commentary, or code formatting like ```sql.
+    """
+
+SQL_REPAIR_PROMPT = ChatPromptTemplate.from_template(SQL_REPAIR_PROMPT_TEMPLATE)
+SQL_VALIDATIONS = metrics.counter(
+    "querygenie_sql_validation_total", "Generated SQL validation outcomes.", ("outcome",)
+)
+
+def iter_child_selects(node):
+    """SELECTs directly below node (not nested inside another SELECT)."""
+    for child in node.iter_expressions():
+        if isinstance(child, exp.Select):
+            yield child
+        else:
+            yield from iter_child_selects(child)
+
+def iter_scope_columns(node, skip=()):
+    """Column references in node's own scope, skipping nested SELECTs and `skip` node types."""
+    for child in node.iter_expressions():
+        if isinstance(child, exp.Select) or isinstance(child, skip):
+            continue
+        if isinstance(child, exp.Column):
+            yield child
+        else:
+            yield from iter_scope_columns(child, skip)
+
+def contains_aggregate(node):
+    if isinstance(node, exp.AggFunc):
+        return True
+    if isinstance(node, (exp.Window, exp.Select)):
+        return False  # window aggregates don't make the query an aggregate query
+    return any(contains_aggregate(child) for child in node.iter_expressions())
+
+class SQLBinder:
+    """Resolves one parsed statement against catalog tables and collects errors."""
+
+    def __init__(self, tables, dialect):
+        self.dialect = dialect
+        # table name (lowercased) -> {"name", "columns": {lower: name}, "primary_key": set of lower}
+        self.tables = {
+            name.lower(): {
+                "name": name,
+                "columns": {column["name"].lower(): column["name"] for column in meta["columns"]},
+                "primary_key": {column.lower() for column in meta["primary_key"]},
+            }
+            for name, meta in tables.items()
+        }
+        self.errors = []
+
+    def bind(self, statement):
+        cte_names = {cte.alias_or_name.lower() for cte in statement.find_all(exp.CTE)}
+        new_tables = {id(table) for table in self.new_tables(statement)}
+        for table in statement.find_all(exp.Table):
+            name = table.name.lower()
+            if (
+                name and not table.args.get("db") and id(table) not in new_tables
+                and name not in cte_names and name not in self.tables
+            ):
+                self.errors.append(f"Unknown table '{table.name}'. Available tables: {self.table_list()}")
+        if self.errors or not is_query(statement):
+            return
+        roots = [statement] if isinstance(statement, exp.Select) else list(iter_child_selects(statement))
+        for select_node in roots:
+            self.bind_select(select_node, {}, cte_names)
+
+    @staticmethod
+    def new_tables(statement):
+        """Table nodes that needn't exist yet: CREATE and RENAME targets, DROP ... IF EXISTS."""
+        tables = []
+        if isinstance(statement, exp.Create):
+            target = statement.this
+            tables.append(target.this if isinstance(target, exp.Schema) else target)
+        elif isinstance(statement, exp.Drop) and statement.args.get("exists"):
+            tables.extend(statement.find_all(exp.Table))
+        rename = getattr(exp, "AlterRename", None) or getattr(exp, "RenameTable", None)
+        if rename is not None:
+            tables.extend(node.this for node in statement.find_all(rename))
+        return tables
+
+    def table_list(self, limit=30):
+        names = sorted(table["name"] for table in self.tables.values())
+        return ", ".join(names[:limit]) + (", ..." if len(names) > limit else "")
+
+    def sources(self, select_node, cte_names):
+        """alias (lowercased) -> catalog table entry, or None for derived tables and CTEs."""
+        nodes = []
+        from_ = select_node.args.get("from") or select_node.args.get("from_")  # renamed in newer sqlglot
+        if from_ is not None:
+            nodes.extend([from_.this] if from_.this is not None else from_.expressions)
+        nodes.extend(join.this for join in select_node.args.get("joins") or [])
+        sources = {}
+        for node in nodes:
+            alias = node.alias_or_name.lower()
+            if isinstance(node, exp.Table) and not node.args.get("db") and node.name.lower() not in cte_names:
+                sources[alias] = self.tables.get(node.name.lower())
+            else:
+                sources[alias] = None
+        return sources
+
+    def bind_select(self, select_node, outer_sources, cte_names):
+        local = self.sources(select_node, cte_names)
+        visible = {**outer_sources, **local}
+        aliases = {
+            expression.alias.lower(): expression.this
+            for expression in select_node.expressions if isinstance(expression, exp.Alias)
+        }
+        for column in iter_scope_columns(select_node):
+            if isinstance(column.this, exp.Star):
+                continue
+            self.resolve(column, visible, aliases)
+        if not self.errors:
+            self.check_group_by(select_node, visible, aliases)
+        for nested in iter_child_selects(select_node):
+            self.bind_select(nested, visible, cte_names)
+
+    def resolve(self, column, visible, aliases, report=True):
+        """(source alias, column) for a column reference, or None when it can't be pinned down."""
+        name = column.name.lower()
+        qualifier = column.table.lower()
+        if qualifier:
+            if qualifier not in visible:
+                if report:
+                    self.errors.append(f"Unknown table or alias '{column.table}' in column '{column.sql(self.dialect)}'")
+                return None
+            table = visible[qualifier]
+            if table is not None and name not in table["columns"]:
+                if report:
+                    self.errors.append(
+                        f"Unknown column '{column.sql(self.dialect)}': table {table['name']} has columns "
+                        f"{', '.join(table['columns'].values())}"
+                    )
+                return None
+            return qualifier, name
+        owners = [alias for alias, table in visible.items() if table is not None and name in table["columns"]]
+        if len(owners) == 1:
+            return owners[0], name
+        if owners or name in aliases or any(table is None for table in visible.values()):
+            return None  # ambiguous, a select alias, or possibly from a derived table
+        if report:
+            tables = ", ".join(table["name"] for table in visible.values() if table is not None)
+            self.errors.append(f"Unknown column '{column.name}' in tables {tables or '(none)'}")
+        return None
+
+    def check_group_by(self, select_node, visible, aliases):
+        group = select_node.args.get("group")
+        group_expressions = list(group.expressions) if group is not None else []
+        expressions = list(select_node.expressions)
+        if not group_expressions and not any(contains_aggregate(expression) for expression in expressions):
+            return
+
+        keys, key_columns = set(), set()
+        for expression in group_expressions:
+            target = expression
+            if isinstance(expression, exp.Literal) and expression.is_int:
+                position = int(expression.name)
+                if 1 <= position <= len(expressions):
+                    target = expressions[position - 1].unalias()
+            elif isinstance(expression, exp.Column) and not expression.table and expression.name.lower() in aliases:
+                target = aliases[expression.name.lower()]
+            keys.add(target.sql(self.dialect).lower())
+            columns = [target] if isinstance(target, exp.Column) else iter_scope_columns(target)
+            for column in columns:
+                resolved = self.resolve(column, visible, aliases, report=False)
+                if resolved is not None:
+                    key_columns.add(resolved)
+
+        # Columns of a table whose whole primary key is grouped are functionally dependent on it
+        dependent = {
+            alias for alias, table in visible.items()
+            if table is not None and table["primary_key"]
+            and all((alias, column) in key_columns for column in table["primary_key"])
+        }
+        for position, expression in enumerate(expressions, 1):
+            inner = expression.unalias()
+            if isinstance(inner, (exp.Star, exp.AggFunc, exp.Window)) or inner.sql(self.dialect).lower() in keys:
+                continue
+            columns = [inner] if isinstance(inner, exp.Column) else iter_scope_columns(inner, (exp.AggFunc, exp.Window))
+            for column in columns:
+                if isinstance(column.this, exp.Star):
+                    continue
+                resolved = self.resolve(column, visible, aliases, report=False)
+                if resolved is None or resolved in key_columns or resolved[0] in dependent:
+                    continue
+                if group_expressions:
+                    self.errors.append(
+                        f"Expression #{position} of SELECT list is not in GROUP BY clause and contains "
+                        f"nonaggregated column '{column.sql(self.dialect)}' which is not functionally dependent "
+                        "on columns in GROUP BY clause; this is incompatible with sql_mode=only_full_group_by"
+                    )
+                else:
+                    self.errors.append(
+                        f"In aggregated query without GROUP BY, expression #{position} of SELECT list contains "
+                        f"nonaggregated column '{column.sql(self.dialect)}'; this is incompatible with "
+                        "sql_mode=only_full_group_by"
+                    )
+                return
+
+def validate_sql(db, sql_query):
+    """Problems found in sql_query, as a list of MySQL-style messages; empty when it looks valid or can't be checked."""
+    dialect = SQLGLOT_DIALECTS.get(db.dialect)
+    if not SQL_VALIDATION or sqlglot is None or dialect is None:
+        return []
+    with timed_stage("validate"):
+        try:
+            statements = parse_sql(sql_query, dialect)
+        except ParseError as e:
+            return [f"Syntax error: {e}"]
+        if not statements:
+            return ["Empty statement"]
+        binder = SQLBinder(schema_catalog.tables(db), dialect)
+        for statement in statements:
+            binder.bind(statement)
+        return binder.errors
+
+def build_repair_prompt(schema, question, sql_query, errors):
+    with timed_stage("prompt"):
+        prompt_value = SQL_REPAIR_PROMPT.format_prompt(
+            schema=schema, question=question, sql=sql_query, error="\n".join(errors)
+        )
+        record_prompt_tokens(estimate_tokens(prompt_value.to_string()), schema=estimate_tokens(schema))
+    return prompt_value
+
+def repair_sql(db, question, schema, sql_query):
+    """Validate sql_query and let the LLM fix it, at most SQL_REPAIR_MAX_ATTEMPTS times."""
+    errors = validate_sql(db, sql_query)
+    attempts = 0
+    while errors and attempts < SQL_REPAIR_MAX_ATTEMPTS:
+        attempts += 1
+        print(f"Generated SQL failed validation (attempt {attempts}): {errors[0]}")
+        with timed_stage("llm"):
+            response_text = get_sql_completion_chain().invoke(build_repair_prompt(schema, question, sql_query, errors))
+        sql_query = clean_generated_sql(response_text)
+        errors = validate_sql(db, sql_query)
+    SQL_VALIDATIONS.inc(outcome=validation_outcome(errors, attempts))
+    return sql_query
+
+async def arepair_sql(db, question, schema, sql_query, rate_limiter=None):
+    """Async repair_sql(): validation on the worker pool, repairs through ainvoke."""
+    errors = await run_blocking(validate_sql, db, sql_query, stage="SQL validation")
+    attempts = 0
+    while errors and attempts < SQL_REPAIR_MAX_ATTEMPTS:
+        attempts += 1
+        print(f"Generated SQL failed validation (attempt {attempts}): {errors[0]}")
+        prompt_value = build_repair_prompt(schema, question, sql_query, errors)
+        if rate_limiter is not None:
+            await rate_limiter.acquire(prompt_value)
+        try:
+            with timed_stage("llm"):
+                response_text = await asyncio.wait_for(
+                    get_sql_completion_chain().ainvoke(prompt_value), LLM_TIMEOUT_SECONDS
+                )
+        except asyncio.TimeoutError:
+            break  # Keep the last SQL; the database reports the real error
+        sql_query = clean_generated_sql(response_text)
+        errors = await run_blocking(validate_sql, db, sql_query, stage="SQL validation")
+    SQL_VALIDATIONS.inc(outcome=validation_outcome(errors, attempts))
+    return sql_query
+
+def validation_outcome(errors, attempts):
+    if errors:
+        return "unrepaired"
+    return "repaired" if attempts else "valid"
+
+# --- Query Cost Guard ---
+# Generated SELECTs are EXPLAINed before they run (MySQL only; other dialects
+# don't report row estimates). Above QUERY_CONFIRM_ROWS estimated rows examined
+# the user has to confirm; above QUERY_REJECT_ROWS the query is refused.
+# Streamed results get a LIMIT when the query has none, and every target
+# connection carries a statement timeout (see QUERY_MAX_EXECUTION_MS).
+QUERY_COST_GUARD = os.getenv("QUERY_COST_GUARD", "true").lower() in ("1", "true", "yes")
+QUERY_CONFIRM_ROWS = int(os.getenv("QUERY_CONFIRM_ROWS", "1000000"))
+QUERY_REJECT_ROWS = int(os.getenv("QUERY_REJECT_ROWS", "100000000"))
+QUERY_AUTO_LIMIT = int(os.getenv("QUERY_AUTO_LIMIT", "100000"))  # 0 disables
+QUERY_CANCEL_POLL_SECONDS = float(os.getenv("QUERY_CANCEL_POLL_SECONDS", "0.5"))
+
+TRAILING_LIMIT = re.compile(
+    r"\bLIMIT\s+(?P<first>\d+)(\s*(?P<separator>,|OFFSET)\s*(?P<second>\d+))?\s*$", re.IGNORECASE
+)
+
+def estimate_rows_examined(plan_rows):
+    """Nested-loop estimate from EXPLAIN rows: each table is read once per row surviving the tables before it."""
+    examined = 0
+    fanout_by_select = {}
+    for row in plan_rows:
+        rows = row.get("rows") or 0
+        filtered = row.get("filtered")
+        fanout = fanout_by_select.get(row.get("id"), 1)
+        examined += fanout * rows
+        selectivity = float(filtered) / 100 if filtered is not None else 1.0
+        fanout_by_select[row.get("id")] = fanout * max(1.0, rows * selectivity)
+    return int(examined)
+
+def check_query_cost(connection, sql_query):
+    """Return None when the query may run, else {"action": "confirm" | "reject", ...}."""
+    if not QUERY_COST_GUARD or connection.dialect.name != "mysql":
+        return None
+    with timed_stage("explain"):
+        result = connection.exec_driver_sql(f"EXPLAIN {strip_statement_terminator(sql_query)}")
+        plan_rows = [dict(row._mapping) for row in result]
+    estimated = estimate_rows_examined(plan_rows)
+    full_scans = sorted({row["table"] for row in plan_rows if row.get("type") == "ALL" and row.get("table")})
+    if estimated > QUERY_REJECT_ROWS:
+        action = "reject"
+        message = (
+            f"⚠️ Query rejected: it would examine about {estimated:,} rows "
+            f"(limit {QUERY_REJECT_ROWS:,}). Add filters or ask a narrower question."
+        )
+    elif estimated > QUERY_CONFIRM_ROWS:
+        action = "confirm"
+        message = f"This query will examine about {estimated:,} rows. Run it anyway?"
+    else:
+        return None
+    return {"action": action, "estimated_rows": estimated, "full_scans": full_scans, "message": message}
+
+def check_db_query_cost(db, sql_query, replica_uris=None):
+    """check_query_cost() on the connection the SELECT will be routed to, so EXPLAIN sees that server."""
+    connection, pool_uri = open_read_connection(db, replica_uris)
+    try:
+        return check_query_cost(connection, sql_query)
+    finally:
+        connection.close()
+        replica_router.end(pool_uri)
+
+def cost_guard_output(sql_query, verdict):
+    return encode_legacy_result(sql_query, cost_guard_result(sql_query, verdict))
+
+def cost_guard_result(sql_query, verdict):
+    """Chat output for a guarded query, shaped like errors and dangerous-SQL confirmations."""
+    if verdict["action"] == "reject":
+        CHAT_ERRORS.inc(type="cost_rejected")
+        return {"type": "error", "message": verdict["message"]}
+    return {
+        "type": "confirmation_required",
+        "reason": "cost",
+        "sql": sql_query,
+        "message": verdict["message"],
+        "estimated_rows": verdict["estimated_rows"],
+        "table": {
+            "columns": ["Action", "Full scans", "Estimated rows examined", "Impact"],
+            "data": [["SELECT", ", ".join(verdict["full_scans"]) or "-", f"{verdict['estimated_rows']:,}", "Expensive query"]],
+        },
+    }
+
+def apply_auto_limit(sql_query, limit=QUERY_AUTO_LIMIT):
+    """Append LIMIT to a SELECT that has none at the end; returns (sql, applied)."""
+    sql_query = strip_statement_terminator(sql_query)
+    if not limit or TRAILING_LIMIT.search(sql_query):
+        return sql_query, False
+    return f"{sql_query} LIMIT {limit}", True
+
+# The MySQL thread id of the statement a request is running, so a disconnect can KILL it
+running_query = contextvars.ContextVar("running_query", default=None)
+
+@contextlib.contextmanager
+def track_running_query(connection):
+    slot = running_query.get()
+    if slot is not None:
+        slot["thread_id"] = getattr(connection.connection.dbapi_connection, "connection_id", None)
+        slot["engine"] = connection.engine  # A replica's statement must be killed on the replica
+    try:
+        yield
+    finally:
+        if slot is not None:
+            slot["thread_id"] = None
+
+def kill_query(target_engine, thread_id):
+    if thread_id is None or target_engine.dialect.name != "mysql":
+        return
+    with target_engine.connect() as connection:
+        connection.exec_driver_sql(f"KILL QUERY {int(thread_id)}")
+
+class ClientDisconnected(Exception):
+    """The client went away while its query was running; nobody is left to read a response."""
+
+async def run_cancellable(http_request, db, coroutine):
+    """Await coroutine, killing its running statement if the client disconnects first."""
+    slot = {"thread_id": None, "engine": db._engine}
+    token = running_query.set(slot)
+    task = asyncio.ensure_future(coroutine)  # the task's context carries the slot
+    running_query.reset(token)
+    while True:
+        done, _ = await asyncio.wait({task}, timeout=QUERY_CANCEL_POLL_SECONDS)
+        if done:
+            return task.result()
+        if await http_request.is_disconnected():
+            task.cancel()
+            if slot["thread_id"] is not None:
+                await run_blocking(kill_query, slot["engine"], slot["thread_id"], stage="query cancel")
+            CHAT_ERRORS.inc(type="client_disconnected")
+            raise ClientDisconnected()
+
+@app.exception_handler(ClientDisconnected)
+async def client_disconnected_handler(request: Request, exc: ClientDisconnected):
+    # Recorded as "client_closed" rather than a status code, so it isn't counted as a server error
+    request.state.client_disconnected = True
+    return Response(status_code=204)
+
+# --- Batched Writes ---
+# Confirmed single-table DELETE/UPDATE statements are planned before they
+# run. The planner estimates affected rows with EXPLAIN on MySQL/PostgreSQL
+# and COUNT(*) on SQLite. A statement becomes a write job when its table has
+# a single-column primary key and more rows than one batch would change. A
+# job runs one primary-key range per transaction, pausing between chunks, so
+# locks and undo stay small and replicas keep up. Jobs are stored in users.db
+# and point at their owner's connection profile, never at a URI. An
+# interrupted, cancelled or failed job resumes after its last committed
+# chunk. A crash between a chunk's commit and its checkpoint re-runs that
+# chunk, which is harmless for deletes and for updates that assign constants.
+WRITE_JOB_BATCH_SIZE = int(os.getenv("WRITE_JOB_BATCH_SIZE", "5000"))
+WRITE_JOB_PAUSE_MS = float(os.getenv("WRITE_JOB_PAUSE_MS", "100"))
+WRITE_JOB_STALE_SECONDS = float(os.getenv("WRITE_JOB_STALE_SECONDS", "300"))  # No checkpoint for this long = interrupted
+
+DELETE_STATEMENT = re.compile(r"^DELETE\s+FROM\s+(?P<table>[\w`\"]+)(?:\s+WHERE\s+(?P<where>.+))?$", re.IGNORECASE | re.DOTALL)
+UPDATE_STATEMENT = re.compile(
+    r"^UPDATE\s+(?P<table>[\w`\"]+)\s+SET\s+(?P<set>.+?)(?:\s+WHERE\s+(?P<where>.+))?$", re.IGNORECASE | re.DOTALL
+)
+UNBATCHABLE_CLAUSES = re.compile(r"\b(JOIN|ORDER\s+BY|LIMIT|RETURNING)\b|;", re.IGNORECASE)
+WRITE_JOB_ROWS = metrics.counter("querygenie_write_job_rows_total", "Rows changed by batched write jobs.")
+
+def split_write_statement(sql_query, dialect):
+    """{"action", "table", "set", "where"} for a single-table DELETE/UPDATE, else None."""
+    sql_query = strip_statement_terminator(sql_query).strip()
+    if sqlglot is not None:
+        glot_dialect = SQLGLOT_DIALECTS.get(dialect, "mysql")
+        try:
+            statements = parse_sql(sql_query, glot_dialect)
+        except ParseError:
+            return None
+        if len(statements) != 1 or not isinstance(statements[0], (exp.Delete, exp.Update)):
+            return None
+        statement = statements[0]
+        table = statement.this
+        blockers = ("using", "from", "from_", "joins", "order", "limit", "returning", "with", "with_")
+        if (
+            not isinstance(table, exp.Table) or table.alias or table.args.get("db") or table.args.get("joins")
+            or any(statement.args.get(arg) for arg in blockers)
+        ):
+            return None
+        where = statement.args.get("where")
+        is_update = isinstance(statement, exp.Update)
+        return {
+            "action": "UPDATE" if is_update else "DELETE",
+            "table": table.name,
+            "set": ", ".join(assignment.sql(glot_dialect) for assignment in statement.expressions) if is_update else None,
+            "where": where.this.sql(glot_dialect) if where is not None else None,
+        }
+    if UNBATCHABLE_CLAUSES.search(sql_query):
+        return None
+    for action, pattern in (("DELETE", DELETE_STATEMENT), ("UPDATE", UPDATE_STATEMENT)):
+        match = pattern.match(sql_query)
+        if match:
+            return {
+                "action": action,
+                "table": match.group("table").strip('`"'),
+                "set": match.groupdict().get("set"),
+                "where": match.group("where"),
+            }
+    return None
+
+def quote_identifier(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+def sql_literal(connection, value):
+    return str(literal(value).compile(dialect=connection.dialect, compile_kwargs={"literal_binds": True}))
+
+def key_value(value):
+    """A primary-key value as it round-trips through the job's JSON columns."""
+    return json.loads(json.dumps(value, default=str))
+
+def where_clause(conditions):
+    conditions = [condition for condition in conditions if condition]
+    return f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+def estimate_affected_rows(connection, parts):
+    table = quote_identifier(connection, parts["table"])
+    where = where_clause([parts["where"]])
+    dialect = connection.dialect.name
+    if dialect == "mysql":
+        plan_rows = [dict(row._mapping) for row in connection.exec_driver_sql(f"EXPLAIN SELECT 1 FROM {table}{where}")]
+        if not plan_rows:
+            return 0
+        filtered = plan_rows[0].get("filtered")
+        selectivity = float(filtered) / 100 if filtered is not None else 1.0
+        return int((plan_rows[0].get("rows") or 0) * selectivity)
+    if dialect == "postgresql":
+        plan = connection.exec_driver_sql(f"EXPLAIN (FORMAT JSON) SELECT 1 FROM {table}{where}").scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]["Plan"]["Plan Rows"])
+    return int(connection.exec_driver_sql(f"SELECT COUNT(*) FROM {table}{where}").scalar() or 0)
+
+def plan_batched_write(db, sql_query):
+    """Statement parts plus key_column, estimated_rows and batched; None if sql_query isn't a plain DELETE/UPDATE."""
+    parts = split_write_statement(sql_query, db.dialect)
+    if parts is None:
+        return None
+    tables = {name.lower(): meta for name, meta in schema_catalog.tables(db).items()}
+    meta = tables.get(parts["table"].lower())
+    if meta is None:
+        return None
+    key_column = meta["primary_key"][0] if len(meta["primary_key"]) == 1 else None
+    with db._engine.connect() as connection, timed_stage("explain"):
+        estimated = estimate_affected_rows(connection, parts)
+    return {
+        **parts,
+        "key_column": key_column,
+        "estimated_rows": estimated,
+        "batched": key_column is not None and estimated > WRITE_JOB_BATCH_SIZE,
+    }
+
+def safe_plan_batched_write(db, sql_query):
+    """plan_batched_write() for previews: a failed estimate must not fail the chat response."""
+    try:
+        return plan_batched_write(db, sql_query)
+    except Exception as e:
+        print(f"Write planning failed: {e}")
+        return None
+
+def fetch_max_key(db, plan):
+    with db._engine.connect() as connection:
+        key = quote_identifier(connection, plan["key_column"])
+        table = quote_identifier(connection, plan["table"])
+        return connection.exec_driver_sql(f"SELECT MAX({key}) FROM {table}").scalar()
+
+def next_chunk_bound(connection, plan, last_key, max_key, batch_size):
+    """Upper key of the chunk after last_key: batch_size keys further on, capped at max_key."""
+    key = quote_identifier(connection, plan["key_column"])
+    table = quote_identifier(connection, plan["table"])
+    bounds = where_clause([
+        f"{key} > {sql_literal(connection, last_key)}" if last_key is not None else None,
+        f"{key} <= {sql_literal(connection, max_key)}",
+    ])
+    row = connection.exec_driver_sql(
+        f"SELECT {key} FROM {table}{bounds} ORDER BY {key} LIMIT 1 OFFSET {int(batch_size) - 1}"
+    ).first()
+    return row[0] if row is not None else max_key
+
+def chunk_statement(connection, plan, lower_key, upper_key):
+    key = quote_identifier(connection, plan["key_column"])
+    table = quote_identifier(connection, plan["table"])
+    where = where_clause([
+        f"({plan['where']})" if plan["where"] else None,
+        f"{key} > {sql_literal(connection, lower_key)}" if lower_key is not None else None,
+        f"{key} <= {sql_literal(connection, upper_key)}",
+    ])
+    if plan["action"] == "DELETE":
+        return f"DELETE FROM {table}{where}"
+    return f"UPDATE {table} SET {plan['set']}{where}"
+
+class WriteJobRunner:
+    """Runs write jobs on background threads and tracks the ones owned by this process."""
+
+    def __init__(self, stale_seconds):
+        self.stale_seconds = stale_seconds
+        self._threads = {}  # job_id -> (thread, stop event)
+        self._lock = threading.Lock()
+
+    async def create(self, connection_id, db, sql_query, plan, user_id, batch_size, pause_ms):
+        max_key = await run_blocking(fetch_max_key, db, plan, stage="write planning")
+        job_id = secrets.token_urlsafe(16)
+        stored_plan = {name: plan[name] for name in ("action", "table", "set", "where", "key_column")}
+
+        def write(db_session):
+            now = datetime.utcnow()
+            job = WriteJob(
+                id=job_id, user_id=user_id, connection_id=connection_id, sql=sql_query, plan=json.dumps(stored_plan),
+                state="running", batch_size=batch_size, pause_ms=pause_ms, estimated_rows=plan["estimated_rows"],
+                max_key=json.dumps(max_key, default=str) if max_key is not None else None,
+                rows_affected=0, batches=0, created_at=now, updated_at=now,
+            )
+            db_session.add(job)
+            return self.view(job)
+
+        view = await session_writer.run(write)
+        self.start(job_id)
+        return view
+
+    def start(self, job_id):
+        with self._lock:
+            if job_id in self._threads:
+                return
+            stop = threading.Event()
+            thread = threading.Thread(target=self._run, args=(job_id, stop), name=f"qg-write-job-{job_id[:8]}", daemon=True)
+            self._threads[job_id] = (thread, stop)
+        thread.start()
+
+    def stop(self, timeout=5):
+        """Interrupt this process's jobs after their current chunk; they can be resumed later."""
+        with self._lock:
+            running = list(self._threads.values())
+        for _, stop in running:
+            stop.set()
+        for thread, _ in running:
+            thread.join(timeout=timeout)
+
+    def is_local(self, job_id):
+        with self._lock:
+            return job_id in self._threads
+
+    def state(self, job):
+        """Stored state, reporting running jobs with no recent checkpoint and no local thread as interrupted."""
+        if (
+            job.state == "running" and not self.is_local(job.id)
+            and (datetime.utcnow() - job.updated_at).total_seconds() > self.stale_seconds
+        ):
+            return "interrupted"
+        return job.state
+
+    def view(self, job):
+        plan = json.loads(job.plan)
+        if job.state == "completed":
+            progress = 1.0
+        elif job.estimated_rows:
+            progress = round(min(1.0, job.rows_affected / job.estimated_rows), 4)
+        else:
+            progress = None
+        return {
+            "job_id": job.id,
+            "state": self.state(job),
+            "action": plan["action"],
+            "table": plan["table"],
+            "sql": job.sql,
+            "batch_size": job.batch_size,
+            "pause_ms": job.pause_ms,
+            "estimated_rows": job.estimated_rows,
+            "rows_affected": job.rows_affected,
+            "batches": job.batches,
+            "progress": progress,
+            "error": job.error,
+            "created_at": job.created_at.isoformat(),
+            "updated_at": job.updated_at.isoformat(),
+        }
+
+    def get(self, job_id, user_id):
+        db_session = ReadSessionLocal()
+        try:
+            job = db_session.query(WriteJob).filter(WriteJob.id == job_id, WriteJob.user_id == user_id).first()
+            return self.view(job) if job is not None else None
+        finally:
+            db_session.close()
+
+    def for_user(self, user_id, limit=50):
+        db_session = ReadSessionLocal()
+        try:
+            jobs = (
+                db_session.query(WriteJob).filter(WriteJob.user_id == user_id)
+                .order_by(WriteJob.created_at.desc()).limit(limit)
+            )
+            return [self.view(job) for job in jobs]
+        finally:
+            db_session.close()
+
+    async def cancel(self, job_id, user_id):
+        def write(db_session):
+            job = db_session.query(WriteJob).filter(WriteJob.id == job_id, WriteJob.user_id == user_id).first()
+            if job is None:
+                raise HTTPException(status_code=404, detail="Write job not found")
+            if job.state != "running":
+                raise HTTPException(status_code=409, detail=f"Write job is already {job.state}")
+            job.state = "cancelled"
+            job.updated_at = datetime.utcnow()
+            return self.view(job)
+
+        view = await session_writer.run(write)
+        with self._lock:
+            running = self._threads.get(job_id)
+        if running is not None:
+            running[1].set()  # Skip the pause; the thread stops at its next checkpoint
+        return view
+
+    async def resume(self, job_id, user_id):
+        def write(db_session):
+            job = db_session.query(WriteJob).filter(WriteJob.id == job_id, WriteJob.user_id == user_id).first()
+            if job is None:
+                raise HTTPException(status_code=404, detail="Write job not found")
+            if self.is_local(job_id):
+                raise HTTPException(status_code=409, detail="Write job is still running in this process")
+            state = self.state(job)
+            if state not in ("interrupted", "cancelled", "failed"):
+                raise HTTPException(status_code=409, detail=f"Write job is {state}")
+            job.state = "running"
+            job.error = None
+            job.updated_at = datetime.utcnow()
+            return self.view(job)
+
+        view = await session_writer.run(write)
+        self.start(job_id)
+        return view
+
+    def stats(self):
+        with self._lock:
+            return {"running": len(self._threads)}
+
+    def _run(self, job_id, stop):
+        try:
+            self._run_chunks(job_id, stop)
+        except Exception as e:
+            print(f"Write job {job_id} failed: {e}")
+            self._finish(job_id, "failed", str(e))
+        finally:
+            with self._lock:
+                self._threads.pop(job_id, None)
+
+    def _run_chunks(self, job_id, stop):
+        db_session = ReadSessionLocal()
+        try:
+            job = db_session.query(WriteJob).filter(WriteJob.id == job_id).one()
+            sql_query, batch_size, pause_ms = job.sql, job.batch_size, job.pause_ms
+            connection_id, user_id = job.connection_id, job.user_id
+            plan = json.loads(job.plan)
+            max_key = json.loads(job.max_key) if job.max_key is not None else None
+            last_key = json.loads(job.last_key) if job.last_key is not None else None
+        finally:
+            db_session.close()
+
+        target = connection_profiles.load(connection_id, user_id) if connection_id else None
+        if target is None:
+            raise RuntimeError("The job's connection no longer exists; reconnect and run the statement again")
+        db = db_registry.get(target[0])
+        while max_key is not None and last_key != max_key:
+            if stop.is_set():
+                self._finish(job_id, "interrupted")
+                return
+            with db._engine.begin() as connection:
+                upper_key = key_value(next_chunk_bound(connection, plan, last_key, max_key, batch_size))
+                affected = max(connection.exec_driver_sql(chunk_statement(connection, plan, last_key, upper_key)).rowcount, 0)
+            last_key = upper_key
+            WRITE_JOB_ROWS.inc(affected)
+            result_cache.invalidate_for_write(db, sql_query)
+            if self._checkpoint(job_id, last_key, affected) != "running":
+                return  # Cancelled, possibly from another process
+            if last_key != max_key and pause_ms:
+                stop.wait(pause_ms / 1000)
+        schema_catalog.invalidate(db)
+        self._finish(job_id, "completed")
+
+    def _checkpoint(self, job_id, last_key, affected):
+        def write(db_session):
+            job = db_session.query(WriteJob).filter(WriteJob.id == job_id).one()
+            job.last_key = json.dumps(last_key)
+            job.rows_affected += affected
+            job.batches += 1
+            job.updated_at = datetime.utcnow()
+            return job.state
+
+        return session_writer.submit(write).result()
+
+    def _finish(self, job_id, state, error=None):
+        def write(db_session):
+            job = db_session.query(WriteJob).filter(WriteJob.id == job_id).first()
+            if job is not None and job.state == "running":
+                job.state = state
+                job.error = error
+                job.updated_at = datetime.utcnow()
+
+        session_writer.submit(write).result()
+
+write_jobs = WriteJobRunner(WRITE_JOB_STALE_SECONDS)
+
+def clean_generated_sql(response_text: str) -> str:
+    sql_query = response_text.strip()
+
+    # Remove any markdown formatting if present
+    if sql_query.startswith("```"):
+        sql_query = re.sub(r'^```[\w]*\n?', '', sql_query)
+        sql_query = re.sub(r'\n?```$', '', sql_query)
+        sql_query = sql_query.strip()
+    return sql_query
+
+def generate_sql(question, db, formatted_chat_history, use_cache=True):
+    cache_key = None
+    if use_cache:
+        cache_key = sql_generation_cache.make_key(question, formatted_chat_history, db)
+        cached_sql = sql_generation_cache.get(cache_key)
+        if cached_sql is not None:
+            return cached_sql
+
+    schema = get_prompt_schema(db, question, formatted_chat_history)
+    prompt_value = build_sql_prompt(schema, question, formatted_chat_history)
+    with timed_stage("llm"):
+        response_text = get_sql_completion_chain().invoke(prompt_value)
+    with timed_stage("postprocess"):
+        sql_query = clean_generated_sql(response_text)
+    sql_query = repair_sql(db, question, schema, sql_query)
+    if cache_key and sql_query:
+        sql_generation_cache.set(cache_key, sql_query)
+    return sql_query
+
+async def alookup_generated_sql(question, db, formatted_chat_history, use_cache, snapshot=None):
+    """Return (cache_key, cached_sql); both None when the cache is bypassed."""
+    if not use_cache:
+        return None, None
+    structure = snapshot["structure"] if snapshot is not None else None
+    cache_key = await run_blocking(
+        sql_generation_cache.make_key, question, formatted_chat_history, db, structure, stage="schema check"
+    )
+    cached_sql = await run_blocking(sql_generation_cache.get, cache_key, stage="SQL cache lookup")
+    return cache_key, cached_sql
+
+async def agenerate_sql(question, db, formatted_chat_history, use_cache=True, snapshot=None, rate_limiter=None):
+    """Async generate_sql(): DB work goes to the worker pool, the LLM call uses ainvoke.
+
+    Batches pass the schema snapshot shared by their questions and the rate limiter LLM calls wait on.
+    """
+    cache_key, cached_sql = await alookup_generated_sql(question, db, formatted_chat_history, use_cache, snapshot)
+    if cached_sql is not None:
+        return cached_sql
+
+    schema = await run_blocking(
+        get_prompt_schema, db, question, formatted_chat_history, snapshot, stage="schema fetch"
+    )
+    prompt_value = build_sql_prompt(schema, question, formatted_chat_history)
+    if rate_limiter is not None:
+        await rate_limiter.acquire(prompt_value)
+    try:
+        with timed_stage("llm"):
+            response_text = await asyncio.wait_for(
+                get_sql_completion_chain().ainvoke(prompt_value), LLM_TIMEOUT_SECONDS
+            )
+    except asyncio.TimeoutError:
+        CHAT_ERRORS.inc(type="llm_timeout")
+        raise HTTPException(status_code=504, detail=f"SQL generation timed out after {LLM_TIMEOUT_SECONDS}s")
+
+    with timed_stage("postprocess"):
+        sql_query = clean_generated_sql(response_text)
+    sql_query = await arepair_sql(db, question, schema, sql_query, rate_limiter)
+    if cache_key and sql_query:
+        await run_blocking(sql_generation_cache.set, cache_key, sql_query, stage="SQL cache store")
+    return sql_query
+
+def format_cell(cell):
+    return '' if cell is None else str(cell)
+
+# --- Result Encoding ---
+# SELECT results are kept as native Python rows internally. /api/chat encodes
+# them once, in the format the client asks for with Accept:
+# - the legacy "SQL: `...`\nOutput: {json}" string (default);
+# - RESULT_JSON_MEDIA_TYPE: structured JSON with typed columns and columnar data;
+# - msgpack or Arrow IPC, the same structure in binary (when installed).
+RESULT_JSON_MEDIA_TYPE = "application/vnd.querygenie.result+json"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack", "application/vnd.msgpack")
+ARROW_MEDIA_TYPE = "application/vnd.apache.arrow.stream"
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+def column_type(values):
+    """Logical type of a column from its first non-null value."""
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            return "boolean"
+        if isinstance(value, int):
+            return "integer"
+        if isinstance(value, float):
+            return "float"
+        if isinstance(value, Decimal):
+            return "decimal"
+        if isinstance(value, datetime):
+            return "datetime"
+        if isinstance(value, date):
+            return "date"
+        if isinstance(value, (dt_time, timedelta)):
+            return "time"
+        if isinstance(value, (bytes, bytearray)):
+            return "binary"
+        return "string"
+    return "null"
+
+def wire_value(value, binary=False):
+    """A cell as a JSON/msgpack-native value; numbers stay numbers."""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, Decimal):
+        # Keep full precision when a double can't hold it
+        return float(value) if len(value.as_tuple().digits) <= 15 else str(value)
+    if isinstance(value, (datetime, date, dt_time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray)):
+        return bytes(value) if binary else base64.b64encode(value).decode("ascii")
+    return str(value)
+
+def columnar_result(columns, rows, binary=False):
+    """(column metadata, one value array per column) from native rows."""
+    arrays = [list(values) for values in zip(*rows)] if rows else [[] for _ in columns]
+    meta = [{"name": name, "type": column_type(values)} for name, values in zip(columns, arrays)]
+    return meta, [[wire_value(value, binary) for value in values] for values in arrays]
+
+def structured_output(output_data, binary=False):
+    """Output dict with native rows replaced by typed columnar data."""
+    if output_data.get("type") != "select":
+        return output_data
+    output = {key: value for key, value in output_data.items() if key not in ("rows", "columns")}
+    output["columns"], output["data"] = columnar_result(output_data["columns"], output_data["rows"], binary)
+    return output
+
+def legacy_output(output_data):
+    """Output dict in the original shape: column names plus rows of strings."""
+    if output_data.get("type") != "select":
+        return output_data
+    output = {"type": "select", "data": [[format_cell(cell) for cell in row] for row in output_data["rows"]]}
+    output.update((key, value) for key, value in output_data.items() if key not in ("type", "rows"))
+    return output
+
+def encode_legacy_result(sql_query, output_data):
+    with timed_stage("encode"):
+        if output_data.get("type") == "confirmation_required":
+            return json.dumps(output_data)
+        return f"SQL: `{sql_query or 'N/A'}`\nOutput: {json.dumps(legacy_output(output_data))}"
+
+def negotiate_result_media_type(accept_header):
+    """Best structured media type the client accepts, or None for the legacy response."""
+    offered = []
+    for position, part in enumerate((accept_header or "").split(",")):
+        fields = [field.strip() for field in part.split(";")]
+        quality = 1.0
+        for field in fields[1:]:
+            if field.startswith("q="):
+                try:
+                    quality = float(field[2:])
+                except ValueError:
+                    quality = 0.0
+        if fields[0] and quality > 0:
+            offered.append((-quality, position, fields[0].lower()))
+    for _, _, media_type in sorted(offered):
+        if media_type == RESULT_JSON_MEDIA_TYPE:
+            return media_type
+        if media_type in MSGPACK_MEDIA_TYPES and msgpack is not None:
+            return media_type
+        if media_type == ARROW_MEDIA_TYPE and pyarrow is not None:
+            return media_type
+    return None
+
+def arrow_column(values):
+    try:
+        return pyarrow.array(values)
+    except (pyarrow.ArrowInvalid, pyarrow.ArrowTypeError, TypeError):
+        return pyarrow.array([None if value is None else str(value) for value in values])
+
+def encode_arrow_result(sql_query, output_data):
+    """Arrow IPC stream of the rows; everything else rides along as schema metadata."""
+    columns = output_data["columns"]
+    arrays = [list(values) for values in zip(*output_data["rows"])] if output_data["rows"] else [[] for _ in columns]
+    table = pyarrow.Table.from_arrays([arrow_column(values) for values in arrays], names=columns)
+    details = {key: value for key, value in output_data.items() if key not in ("rows", "columns")}
+    table = table.replace_schema_metadata({"querygenie": json.dumps({"sql": sql_query, **details})})
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def encode_result_response(sql_query, output_data, accept_header):
+    """HTTP response for a chat result; Vary: Accept since the body depends on it."""
+    media_type = negotiate_result_media_type(accept_header)
+    if media_type is None:
+        response = encode_legacy_result(sql_query, output_data)
+        return JSONResponse({"success": True, "response": response}, headers={"Vary": "Accept"})
+    return encode_structured_response(sql_query, output_data, media_type)
+
+def encode_structured_response(sql_query, output_data, media_type):
+    headers = {"Vary": "Accept"}
+    with timed_stage("encode"):
+        if media_type == ARROW_MEDIA_TYPE and output_data.get("type") == "select":
+            return Response(encode_arrow_result(sql_query, output_data), media_type=media_type, headers=headers)
+        binary = media_type in MSGPACK_MEDIA_TYPES
+        body = {"success": True, "sql": sql_query, "result": structured_output(output_data, binary)}
+        if binary:
+            return Response(msgpack.packb(body), media_type=media_type, headers=headers)
+        # Non-SELECT results requested as Arrow fall back to structured JSON
+        return Response(json.dumps(body), media_type=RESULT_JSON_MEDIA_TYPE, headers=headers)
+
+# --- Chat History Compaction ---
+# The frontend sends earlier AI turns with their whole "SQL: `...`\nOutput:
+# {json}" payload, rows included. Only the SQL, column names and row count
+# help the model write the next query, so results are compacted, repeated
+# turns are dropped, and the most recent turns are kept until
+# HISTORY_TOKEN_BUDGET is spent.
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1200"))
+HISTORY_MESSAGE_MAX_TOKENS = int(os.getenv("HISTORY_MESSAGE_MAX_TOKENS", "300"))  # Longer messages are truncated
+
+LEGACY_RESULT = re.compile(r"^SQL:\s*`(?P<sql>.*?)`\s*\nOutput:\s*(?P<output>\{.*\})\s*$", re.DOTALL)
+HISTORY_MESSAGES_DROPPED = metrics.counter(
+    "querygenie_history_messages_dropped_total", "Chat history messages left out of the SQL prompt.", ("reason",)
+)
+
+# Keyed by a hash of the message, so multi-MB result payloads aren't kept alive by the cache
+compacted_results = TTLCache(max_entries=256, ttl_seconds=3600)
+
+def compact_result_content(content):
+    """An AI message with its result payload reduced to the SQL, column names and row count."""
+    key = hashlib.sha1(content.encode("utf-8")).hexdigest()
+    compacted = compacted_results.get(key)
+    if compacted is None:
+        compacted = _compact_result_content(content)
+        if compacted is not content:  # Messages left as they are aren't worth a copy
+            compacted_results.set(key, compacted)
+    return compacted
+
+def _compact_result_content(content):
+    stripped = content.strip()
+    match = LEGACY_RESULT.match(stripped)
+    try:
+        if match:
+            sql_query, output = match.group("sql"), json.loads(match.group("output"))
+        elif stripped.startswith("{"):
+            output = json.loads(stripped)
+            sql_query = output.get("sql") if isinstance(output, dict) else None
+        else:
+            return content
+    except ValueError:
+        return content if not match else f"SQL: `{match.group('sql')}`"
+    if not isinstance(output, dict):
+        return content
+
+    kind = output.get("type")
+    if kind == "confirmation_required":
+        return f"Asked to confirm before running: `{sql_query}`"
+    if kind == "select":
+        names = [column["name"] if isinstance(column, dict) else str(column) for column in output.get("columns") or []]
+        row_count = output.get("row_count", len(output.get("data") or []))
+        more = "+" if output.get("has_more") else ""
+        return f"SQL: `{sql_query}`\nResult: {row_count}{more} row(s); columns: {', '.join(names) or '-'}"
+    if kind in ("error", "status"):
+        return f"SQL: `{sql_query}`\n{kind.capitalize()}: {output.get('message', '')}"
+    return f"SQL: `{sql_query}`"
+
+def truncate_to_tokens(text_value, max_tokens):
+    max_chars = max_tokens * 4  # Inverse of estimate_tokens()
+    return text_value if len(text_value) <= max_chars else text_value[:max_chars] + " ..."
 
-def get_user(identifier: str, db):
-    return db.query(User).filter(User.email == identifier).first()
+def render_history_message(msg):
+    content = msg.content if isinstance(msg.content, str) else json.dumps(msg.content)
+    if isinstance(msg, HumanMessage):
+        return truncate_to_tokens(f"Human: {content}", HISTORY_MESSAGE_MAX_TOKENS)
+    return truncate_to_tokens(f"AI: {compact_result_content(content)}", HISTORY_MESSAGE_MAX_TOKENS)
 
-# Removed get_current_user function as JWT auth is removed
+def chat_turns(chat_history):
+    """Messages grouped into turns: a human message and the AI replies that follow it."""
+    turns = []
+    for msg in chat_history:
+        if isinstance(msg, HumanMessage) or not turns:
+            turns.append([])
+        turns[-1].append(msg)
+    return turns
 
-# --- DB & LangChain Helpers ---
-def init_database(user, password, host, port, database):
-    try:
-        db_uri = f"mysql+mysqlconnector://{user}:{password}@{host}:{port}/{database}"
-        return SQLDatabase.from_uri(db_uri)
-    except SQLAlchemyError as e:
-        raise HTTPException(status_code=400, detail=f"DB connection failed: {e}")
+def format_chat_history(chat_history, token_budget=HISTORY_TOKEN_BUDGET):
+    """The most recent distinct turns that fit token_budget, oldest first."""
+    turns = chat_turns(chat_history)
+    kept, seen, used = [], set(), 0
+    for position, turn in enumerate(reversed(turns)):
+        turn_text = "\n".join(render_history_message(msg) for msg in turn)
+        if turn_text in seen:
+            HISTORY_MESSAGES_DROPPED.inc(len(turn), reason="duplicate")
+            continue
+        tokens = estimate_tokens(turn_text) + 1
+        if used + tokens > token_budget:
+            HISTORY_MESSAGES_DROPPED.inc(sum(len(older) for older in turns[:len(turns) - position]), reason="budget")
+            break
+        seen.add(turn_text)
+        kept.append(turn_text)
+        used += tokens
+    return "\n".join(reversed(kept))
 
-def get_sql_chain(db):
-    template = """
-    You are a MySQL expert. Given the schema and chat history,
-    generate a SINGLE valid MySQL statement (DDL, DML, DCL, TCL, or queries with JOINS/CONSTRAINTS/TRIGGERS).
-    
-    IMPORTANT RULES:
-    1. When using aggregate functions (AVG, SUM, COUNT, MAX, MIN), you MUST include a GROUP BY clause for any non-aggregated columns in SELECT
-    2. If you select both aggregated and non-aggregated columns, GROUP BY the non-aggregated ones
-    3. Include only the SQL; no explanations, markdown, or extra text
-    4. Ensure the query is compatible with sql_mode=only_full_group_by
-    5. For aggregate queries, structure should be: SELECT column, AGG_FUNC(column) FROM table GROUP BY column
+def parse_chat_history(raw_history):
+    """Convert the frontend's [{role, content}] list to LangChain message objects."""
+    chat_history = []
+    for msg in raw_history:
+        if isinstance(msg, dict):
+            role = msg.get("role", "").lower()
+            content = msg.get("content", "")
 
-    Schema:
-    {schema}
+            if role == "ai" or role == "assistant":
+                chat_history.append(AIMessage(content=content))
+            elif role == "human" or role == "user":
+                chat_history.append(HumanMessage(content=content))
+        else:
+            print(f"Warning: Skipping invalid message format: {msg}")
+    return chat_history
 
-    Chat History (recent context):
-    {chat_history}
+def get_response(question, db, chat_history, use_sql_cache=True, user_id=None, use_result_cache=True):
+    formatted_chat_history = format_chat_history(chat_history)
+    try:
+        sql_query = generate_sql(question, db, formatted_chat_history, use_cache=use_sql_cache)
+    except Exception as e:
+        CHAT_ERRORS.inc(type="generation_failed")
+        error_data = {
+            "type": "error",
+            "message": str(e)
+        }
+        return f"SQL: `N/A`\nOutput: {json.dumps(error_data)}"
+    return execute_generated_sql(sql_query, db, user_id=user_id, use_result_cache=use_result_cache)
 
-    User Question:
-    {question}
+async def aget_result(question, db, chat_history, use_sql_cache=True, user_id=None, use_result_cache=True):
+    """(sql, output) for a question; keeps the event loop free during LLM and DB work."""
+    formatted_chat_history = format_chat_history(chat_history)
+    try:
+        sql_query = await agenerate_sql(question, db, formatted_chat_history, use_cache=use_sql_cache)
+    except HTTPException:
+        raise
+    except Exception as e:
+        CHAT_ERRORS.inc(type="generation_failed")
+        error_data = {
+            "type": "error",
+            "message": str(e)
+        }
+        return None, error_data
+    return await run_blocking(
+        run_generated_sql, sql_query, db,
+        user_id=user_id, use_result_cache=use_result_cache, stage="query execution"
+    )
 
-    Your response must contain ONLY the SQL statement. Do NOT add any extra text, commentary, or code formatting like ```sql.
-    """
-    prompt = ChatPromptTemplate.from_template(template)
-    llm = ChatGroq(api_key=groq_api_key, model="llama-3.1-8b-instant", temperature=0)
-    def get_schema(_):
-        return db.get_table_info()
-    return (
-        RunnablePassthrough.assign(schema=get_schema)
-        | prompt
-        | llm
-        | StrOutputParser()
+async def aget_response(question, db, chat_history, use_sql_cache=True, user_id=None, use_result_cache=True):
+    """Async get_response(), in the legacy string format."""
+    sql_query, output_data = await aget_result(
+        question, db, chat_history,
+        use_sql_cache=use_sql_cache, user_id=user_id, use_result_cache=use_result_cache
     )
+    return encode_legacy_result(sql_query, output_data)
 
-def get_response(question, db, chat_history):
-    chain = get_sql_chain(db)
-    
-    # ✅ TOKEN LIMIT FIX: Only use last 5 messages (increased from 3 for better context)
-    # This prevents token exhaustion after multiple queries while maintaining context
-    recent_history = chat_history[-5:] if len(chat_history) > 5 else chat_history
-    
-    formatted_chat_history = "\n".join([
-        f"{'Human' if isinstance(msg, HumanMessage) else 'AI'}: {msg.content}"
-        for msg in recent_history
-    ])
-    
+def execute_generated_sql(sql_query, db, user_id=None, use_result_cache=True, cost_check=True):
+    """run_generated_sql() encoded as the legacy "SQL: `...`\\nOutput: {json}" string."""
+    return encode_legacy_result(*run_generated_sql(
+        sql_query, db, user_id=user_id, use_result_cache=use_result_cache, cost_check=cost_check
+    ))
+
+def run_generated_sql(sql_query, db, user_id=None, use_result_cache=True, cost_check=True):
+    """Execute generated SQL and return (sql, output); SELECT output carries native rows."""
     connection = None  # Track connection for proper cleanup
+    pool_uri = None
     
     try:
-        response_text = chain.invoke({
-            "question": question,
-            "chat_history": formatted_chat_history
-        })
-        sql_query = response_text.strip()
-        
-        # Remove any markdown formatting if present
-        if sql_query.startswith("```"):
-            sql_query = re.sub(r'^```[\w]*\n?', '', sql_query)
-            sql_query = re.sub(r'\n?```$', '', sql_query)
-            sql_query = sql_query.strip()
-        
         # --------- DANGEROUS SQL CHECK ---------
-        dangerous_ops = detect_dangerous_sql(sql_query)
+        with timed_stage("postprocess"):
+            dangerous_ops = detect_dangerous_sql(sql_query)
 
         if dangerous_ops:
-            return json.dumps({
+            plan = safe_plan_batched_write(db, sql_query)
+            return sql_query, {
                 "type": "confirmation_required",
                 "sql": sql_query,
-                "table": sql_to_table_preview(sql_query)
-            })
+                "estimated_rows": plan["estimated_rows"] if plan else None,
+                "table": sql_to_table_preview(sql_query, plan)
+            }
 
         # Detect SQL type
-        sql_upper = sql_query.upper()
-        if sql_upper.startswith('SELECT'):
+        if is_select_sql(sql_query):
             sql_type = 'select'
         else:
             sql_type = 'other'
@@ -334,32 +3697,35 @@ def get_response(question, db, chat_history):
         if sql_type == 'select':
             # NEW METHOD: Execute query and get column names from cursor
             try:
-                connection = db._engine.connect()  # Store connection reference
-                result_proxy = connection.execute(text(sql_query))
-                
-                # Get actual column names from database
-                columns = list(result_proxy.keys())
-                
-                # Fetch all rows
-                rows = result_proxy.fetchall()
-                
-                # Convert to list of lists with proper string formatting
-                data = []
-                for row in rows:
-                    row_data = []
-                    for cell in row:
-                        if cell is None:
-                            row_data.append('')
-                        else:
-                            row_data.append(str(cell))
-                    data.append(row_data)
+                plan = plan_pagination(sql_query, db)
+                cached_page = result_cache.get(db, sql_query) if use_result_cache else None
+                if cached_page is not None:
+                    columns, data, next_cursor = cached_page
+                else:
+                    # fetch_page times the db and rows stages itself
+                    connection, pool_uri = open_read_connection(db)  # Replica when one qualifies
+                    verdict = check_query_cost(connection, sql_query) if cost_check else None
+                    if verdict is not None:
+                        return sql_query, cost_guard_result(sql_query, verdict)
+
+                    # Only the first page is fetched; later pages go through /api/results/{id}/page
+                    columns, data, next_cursor = fetch_page(connection, sql_query, plan, None, RESULT_PAGE_SIZE)
+                    if use_result_cache:
+                        result_cache.put(db, sql_query, (columns, data, next_cursor))
                 
                 output_data = {
                     "type": "select",
-                    "data": data,
+                    "rows": data,
                     "columns": columns,  # Real column names from database!
-                    "row_count": len(data)
+                    "row_count": len(data),
+                    "has_more": next_cursor is not None,
+                    "cached": cached_page is not None,
                 }
+                ROWS_RETURNED.inc(len(data))
+                if next_cursor is not None:
+                    output_data["result_id"] = result_handles.register(user_id, db, sql_query, columns, plan)
+                    output_data["next_cursor"] = next_cursor
+                    output_data["page_size"] = RESULT_PAGE_SIZE
                 
             except Exception as select_error:
                 # Return the actual SQL error to help debug
@@ -367,6 +3733,7 @@ def get_response(question, db, chat_history):
                 
                 # Check if it's a GROUP BY error and provide helpful message
                 if "only_full_group_by" in error_message or "1140" in error_message:
+                    CHAT_ERRORS.inc(type="group_by_1140")
                     helpful_msg = (
                         "⚠️ GROUP BY Error: When using aggregate functions like AVG(), SUM(), COUNT(), "
                         "all non-aggregated columns in SELECT must be included in the GROUP BY clause. "
@@ -378,6 +3745,7 @@ def get_response(question, db, chat_history):
                         "message": helpful_msg
                     }
                 else:
+                    CHAT_ERRORS.inc(type="query_failed")
                     output_data = {
                         "type": "error",
                         "message": f"Query execution failed: {error_message}"
@@ -389,10 +3757,16 @@ def get_response(question, db, chat_history):
                         connection.close()
                     except Exception as close_error:
                         print(f"Error closing connection: {close_error}")
+                if pool_uri is not None:
+                    replica_router.end(pool_uri)
+                    pool_uri = None
                     
         else:
             # For non-SELECT statements
-            result = db.run(sql_query)
+            with timed_stage("db"):
+                result = db.run(sql_query)
+            schema_catalog.invalidate(db)
+            result_cache.invalidate_for_write(db, sql_query)
             clean_result = result.strip()
             
             if 'Query OK' in clean_result or 'rows affected' in clean_result or 'row affected' in clean_result:
@@ -409,15 +3783,15 @@ def get_response(question, db, chat_history):
                 "affected_rows": affected_rows
             }
 
-        return f"SQL: `{sql_query}`\nOutput: {json.dumps(output_data)}"
+        return sql_query, output_data
         
     except Exception as e:
+        CHAT_ERRORS.inc(type="execution_failed")
         error_data = {
             "type": "error",
             "message": str(e)
         }
-        sql_query_placeholder = sql_query if 'sql_query' in locals() else 'N/A'
-        return f"SQL: `{sql_query_placeholder}`\nOutput: {json.dumps(error_data)}"
+        return sql_query, error_data
     finally:
         # CRITICAL: Final cleanup - ensure connection is closed
         if connection:
@@ -426,16 +3800,266 @@ def get_response(question, db, chat_history):
             except Exception as final_close_error:
                 print(f"Final connection close error: {final_close_error}")
 
+# --- Streaming SELECT Results ---
+# fetchall() + json.dumps holds the whole result in memory several times over.
+# The streaming path reads through a server-side cursor in fetchmany() chunks.
+STREAM_BATCH_SIZE = int(os.getenv("STREAM_BATCH_SIZE", "1000"))
+
+def _open_streaming_cursor(connection, sql_query, batch_size):
+    if connection.dialect.driver == "mysqlconnector":
+        # SQLAlchemy's mysqlconnector dialect uses buffered cursors, which read
+        # the whole result client-side; an unbuffered DBAPI cursor streams it.
+        cursor = connection.connection.cursor(buffered=False)
+        cursor.execute(sql_query)
+        return [column[0] for column in cursor.description], cursor
+    result = connection.execution_options(stream_results=True, max_row_buffer=batch_size).execute(text(sql_query))
+    return list(result.keys()), result
+
+class SelectBatchStream:
+    """Iterator over the column names, then lists of rows (formatted, or native when raw), batch_size at a time.
+
+    close() may be called from any thread. If another thread is inside a fetch
+    (e.g. run_blocking gave up waiting on it), the running statement is killed
+    and that thread releases the connection once its fetch returns, so the
+    cursor is never touched by two threads at once.
+    """
+
+    def __init__(self, db, sql_query, batch_size, raw=False, replica_uris=None):
+        self.db = db
+        self.sql_query = sql_query
+        self.batch_size = batch_size
+        self.raw = raw
+        self.replica_uris = replica_uris
+        self.connection = None
+        self.pool_uri = None
+        self.cursor = None
+        self.thread_id = None
+        self._lock = threading.Lock()  # Held for the duration of each fetch
+        self._closed = False
+        self._close_requested = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        with self._lock:
+            if self._closed or self._close_requested:
+                self._release(exhausted=False)
+                raise StopIteration
+            try:
+                if self.connection is None:
+                    self.connection, self.pool_uri = open_read_connection(self.db, self.replica_uris)
+                    self.thread_id = getattr(self.connection.connection.dbapi_connection, "connection_id", None)
+                    columns, self.cursor = _open_streaming_cursor(self.connection, self.sql_query, self.batch_size)
+                    batch = columns
+                else:
+                    rows = self.cursor.fetchmany(self.batch_size)
+                    if not rows:
+                        self._release(exhausted=True)
+                        raise StopIteration
+                    batch = [list(row) for row in rows] if self.raw else [[format_cell(cell) for cell in row] for row in rows]
+            except StopIteration:
+                raise
+            except BaseException:
+                self._release(exhausted=False)
+                raise
+            if self._close_requested:
+                # close() arrived while we were fetching; the caller has stopped listening
+                self._release(exhausted=False)
+                raise StopIteration
+            return batch
+
+    def close(self):
+        self._close_requested = True
+        if self._lock.acquire(blocking=False):
+            try:
+                self._release(exhausted=False)
+            finally:
+                self._lock.release()
+        elif self.thread_id is not None:
+            # A fetch is running on another thread: stop the statement so it returns promptly
+            try:
+                kill_query(self.connection.engine, self.thread_id)
+            except Exception as e:
+                print(f"Failed to cancel streaming query: {e}")
+
+    def _release(self, exhausted):
+        """Return the connection; callers hold self._lock."""
+        if self._closed:
+            return
+        self._closed = True
+        if self.connection is None:
+            return
+        if not exhausted:
+            # The client went away: stop the statement server-side, then drop the
+            # connection, since unread rows are still on the wire
+            try:
+                kill_query(self.connection.engine, self.thread_id)
+            except Exception as e:
+                print(f"Failed to cancel streaming query: {e}")
+            self.connection.invalidate()
+        elif self.cursor is not None:
+            self.cursor.close()
+        self.connection.close()
+        replica_router.end(self.pool_uri)
+
+def iter_select_batches(db, sql_query, batch_size=STREAM_BATCH_SIZE, raw=False, replica_uris=None):
+    """Yield the column names, then lists of rows (formatted, or native when raw), batch_size at a time."""
+    return SelectBatchStream(db, sql_query, batch_size, raw, replica_uris)
+
+def encode_stream_event(event: dict, stream_format: str) -> str:
+    if stream_format == "sse":
+        return f"event: {event['type']}\ndata: {json.dumps(event)}\n\n"
+    return json.dumps(event) + "\n"
+
+def stream_select_events(db, sql_query, stream_format, batch_size=STREAM_BATCH_SIZE, replica_uris=None):
+    """Header with columns, then row batches, then a trailer with count and timing."""
+    started = time.perf_counter()
+    row_count = 0
+    sql_query, limited = apply_auto_limit(sql_query)
+    batches = iter_select_batches(db, sql_query, batch_size, replica_uris=replica_uris)
+    try:
+        columns = next(batches)
+        yield encode_stream_event({
+            "type": "header",
+            "sql": sql_query,
+            "columns": columns,
+            "row_limit": QUERY_AUTO_LIMIT if limited else None,
+        }, stream_format)
+        for rows in batches:
+            row_count += len(rows)
+            ROWS_RETURNED.inc(len(rows))
+            yield encode_stream_event({"type": "rows", "rows": rows}, stream_format)
+    except Exception as e:
+        yield encode_stream_event({"type": "error", "message": f"Query execution failed: {e}"}, stream_format)
+        return
+    finally:
+        batches.close()
+    yield encode_stream_event({
+        "type": "trailer",
+        "row_count": row_count,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }, stream_format)
+
+# --- Token Streaming Chat ---
+async def iter_with_deadline(async_iterable, timeout):
+    """Iterate async_iterable, raising asyncio.TimeoutError once timeout seconds have passed."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    iterator = async_iterable.__aiter__()
+    while True:
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise asyncio.TimeoutError
+        try:
+            item = await asyncio.wait_for(iterator.__anext__(), remaining)
+        except StopAsyncIteration:
+            return
+        yield item
+
+async def chat_event_stream(request, db, batch_size=STREAM_BATCH_SIZE):
+    """SSE events: token*, sql, check, then columns/rows*/done for SELECTs."""
+    started = time.perf_counter()
+    formatted_chat_history = format_chat_history(parse_chat_history(request.chat_history))
+    batches = None
+    try:
+        cache_key, sql_query = await alookup_generated_sql(
+            request.question, db, formatted_chat_history, request.use_sql_cache
+        )
+        if sql_query is not None:
+            yield encode_stream_event({"type": "token", "text": sql_query, "cached": True}, "sse")
+        else:
+            schema = await run_blocking(
+                get_prompt_schema, db, request.question, formatted_chat_history, stage="schema fetch"
+            )
+            chunks = []
+            prompt_value = build_sql_prompt(schema, request.question, formatted_chat_history)
+            token_stream = get_sql_completion_chain().astream(prompt_value)
+            with timed_stage("llm"):
+                async for chunk in iter_with_deadline(token_stream, LLM_TIMEOUT_SECONDS):
+                    chunks.append(chunk)
+                    yield encode_stream_event({"type": "token", "text": chunk}, "sse")
+            with timed_stage("postprocess"):
+                sql_query = clean_generated_sql("".join(chunks))
+            sql_query = await arepair_sql(db, request.question, schema, sql_query)
+            if cache_key and sql_query:
+                await run_blocking(sql_generation_cache.set, cache_key, sql_query, stage="SQL cache store")
+        yield encode_stream_event({"type": "sql", "sql": sql_query}, "sse")
+
+        dangerous_ops = detect_dangerous_sql(sql_query)
+        is_select = is_select_sql(sql_query)
+        yield encode_stream_event({
+            "type": "check",
+            "dangerous": bool(dangerous_ops),
+            "keywords": dangerous_ops,
+            "statement": "select" if is_select else "other",
+        }, "sse")
+
+        verdict = None
+        if is_select and not dangerous_ops:
+            verdict = await run_blocking(check_db_query_cost, db, sql_query, stage="query cost check")
+
+        if dangerous_ops or not is_select or verdict is not None:
+            # Confirmation prompts and DML/DDL results keep the /api/chat response format
+            if verdict is not None:
+                response = cost_guard_output(sql_query, verdict)
+            else:
+                response = await run_blocking(
+                    execute_generated_sql, sql_query, db, user_id=request.user_id, stage="query execution"
+                )
+            yield encode_stream_event({"type": "result", "response": response}, "sse")
+            yield encode_stream_event({
+                "type": "done",
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+                "prompt_tokens": request_prompt_tokens.get(),
+            }, "sse")
+            return
+
+        sql_query, limited = apply_auto_limit(sql_query)
+        batches = iter_select_batches(db, sql_query, batch_size)
+        columns = await run_blocking(next, batches, stage="query execution")
+        yield encode_stream_event({
+            "type": "columns",
+            "columns": columns,
+            "row_limit": QUERY_AUTO_LIMIT if limited else None,
+        }, "sse")
+        row_count = 0
+        while True:
+            rows = await run_blocking(next, batches, None, stage="row fetch")
+            if rows is None:
+                break
+            row_count += len(rows)
+            ROWS_RETURNED.inc(len(rows))
+            yield encode_stream_event({"type": "rows", "rows": rows}, "sse")
+        yield encode_stream_event({
+            "type": "done",
+            "row_count": row_count,
+            "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+            "prompt_tokens": request_prompt_tokens.get(),  # Headers are sent before the prompt is built
+        }, "sse")
+    except asyncio.TimeoutError:
+        yield encode_stream_event({
+            "type": "error",
+            "message": f"SQL generation timed out after {LLM_TIMEOUT_SECONDS}s",
+        }, "sse")
+    except HTTPException as e:
+        yield encode_stream_event({"type": "error", "message": e.detail}, "sse")
+    except Exception as e:
+        yield encode_stream_event({"type": "error", "message": str(e)}, "sse")
+    finally:
+        if batches is not None:
+            # Don't await here: the stream may be finalizing because the client went away
+            db_executor.submit(batches.close)
+
 #                 >>>>> /api/send-otp <<<<<
 @app.post("/api/send-otp")
 async def send_otp_for_signup(request: OtpRequest):
     otp = generate_otp()
-    expires_at = datetime.now(timezone.utc) + timedelta(minutes=5)
-    
-    # Store the OTP and its expiration time
-    otp_storage[request.email] = {"otp": otp, "expires_at": expires_at}
-    
-    # Send the OTP via email
+
+    # Store the OTP; it expires after OTP_TTL_SECONDS
+    otp_storage.put(request.email, otp)
+
+    # Queue the OTP email; the dispatcher thread delivers it
     send_otp_email(request.email, otp)
     
     print(f"OTP for {request.email}: {otp}") # For debugging
@@ -443,7 +4067,7 @@ async def send_otp_for_signup(request: OtpRequest):
 
 #            >>>>> /api/signup Endpoint <<<<<
 @app.post("/api/signup", status_code=201)
-async def signup_user(user: UserCreate, db: Session = Depends(get_db)):
+async def signup_user(user: UserCreate, db: Session = Depends(get_read_db)):
     # --- OTP Verification ---
     stored_otp_data = otp_storage.get(user.email)
     if not stored_otp_data:
@@ -451,17 +4075,17 @@ async def signup_user(user: UserCreate, db: Session = Depends(get_db)):
 
     if datetime.now(timezone.utc) > stored_otp_data["expires_at"]:
         # Clean up expired OTP
-        del otp_storage[user.email]
+        otp_storage.discard(user.email)
         raise HTTPException(status_code=400, detail="OTP has expired. Please request a new one.")
         
     if stored_otp_data["otp"] != user.otp:
         raise HTTPException(status_code=400, detail="Invalid OTP provided.")
     
     # --- User Creation ---
-    if get_user(user.email, db):
+    if await run_blocking(get_user, user.email, db):
         raise HTTPException(status_code=400, detail="Email already registered")
 
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await hashing_pool.run(password_hashing.hash_password, user.password)
     
     db_user = User(
         email=user.email,
@@ -471,20 +4095,27 @@ async def signup_user(user: UserCreate, db: Session = Depends(get_db)):
         username=user.username,
         hashed_password=hashed_password
     )
-    db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+
+    def write(db_session):
+        # Checked again on the writer: another signup may have won while we were hashing
+        if get_user(user.email, db_session):
+            raise HTTPException(status_code=400, detail="Email already registered")
+        db_session.add(db_user)
+
+    await session_writer.run(write)
     
     # Clean up OTP after successful verification
-    del otp_storage[user.email]
+    otp_storage.discard(user.email)
 
     return {"success": True, "message": "User created successfully"}
 
 # --- Login Endpoint ---
 @app.post("/api/login")
-async def login_for_access_token(form_data: UserLogin, db: Session = Depends(get_db)):
-    user = get_user(form_data.identifier, db)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login_for_access_token(form_data: UserLogin, db: Session = Depends(get_read_db)):
+    user = await run_blocking(get_user, form_data.identifier, db)
+    if not user or not await hashing_pool.run(
+        password_hashing.verify_password, form_data.password, user.hashed_password
+    ):
         raise HTTPException(
             status_code=401,
             detail="Incorrect email or password",
@@ -509,20 +4140,43 @@ async def connect_db(config: DBConfig):
     print(f"Received connect request with config: host={config.host}, port={config.port}, user={config.user}, database={config.database}")
     try:
         db_uri = f"mysql+mysqlconnector://{config.user}:{config.password}@{config.host}:{config.port}/{config.database}"
-        app.state.db_uri = db_uri
-        app.state.db_name = config.database
-
-        chat_history = [AIMessage(content="Hello! I'm your database assistant.")]
+        replica_uris = tuple(
+            f"mysql+mysqlconnector://{replica.user or config.user}:"
+            f"{config.password if replica.password is None else replica.password}@"
+            f"{replica.host}:{replica.port or config.port}/{config.database}"
+            for replica in config.replicas
+        )
+        connection_id = None
+        if config.user_id is not None:
+            # Profiles are per user and never become the process-wide fallback,
+            # so requests without a connection_id can't reach another user's database
+            connection_id = await connection_profiles.create(db_uri, config.database, config.user_id, replica_uris)
+        else:
+            # Kept for clients that don't send user_id yet (single worker only)
+            app.state.db_uri = db_uri
+            app.state.replica_uris = replica_uris
+            app.state.db_name = config.database
+            chat_history = [AIMessage(content="Hello! I'm your database assistant.")]
         print("Database connection successful")
-        return {"success": True, "database": config.database}
+        return {"success": True, "database": config.database, "connection_id": connection_id}
     except Exception as e:
         print(f"Database connection failed: {str(e)}")
         return {"success": False, "error": str(e)}
 
 @app.post("/api/disconnect")
-async def disconnect_db():
+async def disconnect_db(request: Optional[DisconnectRequest] = None):
     try:
+        if request is not None and request.connection_id:
+            db_uri = await connection_profiles.delete(request.connection_id, request.user_id)
+            if db_uri is None:
+                return {"success": False, "error": "Unknown connection_id"}
+            db_registry.dispose(db_uri)
+            if getattr(app.state, "db_uri", None) == db_uri:
+                delattr(app.state, "db_uri")
+            print("Database disconnected successfully")
+            return {"success": True, "message": "Database disconnected successfully"}
         if hasattr(app.state, "db_uri"):
+            db_registry.dispose(app.state.db_uri)
             delattr(app.state, "db_uri")
         if hasattr(app.state, "db_name"):
             delattr(app.state, "db_name")
@@ -533,85 +4187,572 @@ async def disconnect_db():
         return {"success": False, "error": str(e)}
 
 @app.post("/api/chat")
-async def chat_endpoint(request: ChatRequest):
-    if not hasattr(app.state, "db_uri"):
-        raise HTTPException(status_code=400, detail="Database not connected")
-    
+async def chat_endpoint(request: ChatRequest, http_request: Request):
     try:
         # ✅ Convert chat history to LangChain message objects with validation
-        chat_history = []
-        for msg in request.chat_history:
-            if isinstance(msg, dict):
-                role = msg.get("role", "").lower()
-                content = msg.get("content", "")
-                
-                if role == "ai" or role == "assistant":
-                    chat_history.append(AIMessage(content=content))
-                elif role == "human" or role == "user":
-                    chat_history.append(HumanMessage(content=content))
-            else:
-                print(f"Warning: Skipping invalid message format: {msg}")
-        
-        db = SQLDatabase.from_uri(app.state.db_uri)
-        response = get_response(request.question, db, chat_history)
-        return {"success": True, "response": response}
-    except HTTPException as e:
-        raise e
+        chat_history = parse_chat_history(request.chat_history)
+        db = await resolve_db(request.connection_id, user_id=request.user_id)
+        sql_query, output_data = await run_cancellable(http_request, db, aget_result(
+            request.question, db, chat_history,
+            use_sql_cache=request.use_sql_cache, user_id=request.user_id, use_result_cache=request.use_result_cache
+        ))
+        return encode_result_response(sql_query, output_data, http_request.headers.get("accept"))
+    except (HTTPException, ClientDisconnected):
+        raise
     except Exception as e:
         print(f"Chat endpoint error: {str(e)}")
         print(f"Request data: question={request.question}, chat_history={request.chat_history}")
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
+@app.post("/api/chat/stream")
+async def chat_stream_endpoint(request: ChatRequest):
+    """Server-Sent Events variant of /api/chat that streams SQL tokens and result rows."""
+    db = await resolve_db(request.connection_id, user_id=request.user_id)
+    return StreamingResponse(
+        chat_event_stream(request, db),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/cache/stats")
+async def cache_stats():
+    return {"sql_generation": sql_generation_cache.stats(), "results": result_cache.stats()}
+
+@app.get("/api/results/{result_id}/page")
+async def get_result_page(
+    http_request: Request, result_id: str, cursor: str, user_id: Optional[int] = None,
+    page_size: int = RESULT_PAGE_SIZE, connection_id: Optional[str] = None,
+):
+    db = await resolve_db(connection_id, user_id=user_id)
+    handle = result_handles.get(result_id, user_id, db)
+    page_size = max(1, min(page_size, RESULT_PAGE_SIZE))
+    try:
+        columns, data, next_cursor = await run_blocking(
+            fetch_handle_page, db, handle, decode_page_cursor(cursor, handle["plan"]), page_size, stage="page fetch"
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Query execution failed: {str(e)}")
+
+    output_data = {
+        "type": "select",
+        "result_id": result_id,
+        "columns": columns,
+        "rows": data,
+        "row_count": len(data),
+        "has_more": next_cursor is not None,
+        "next_cursor": next_cursor,
+    }
+    ROWS_RETURNED.inc(len(data))
+    media_type = negotiate_result_media_type(http_request.headers.get("accept"))
+    if media_type is not None:
+        return encode_structured_response(handle["sql"], output_data, media_type)
+    page = legacy_output(output_data)
+    del page["type"]
+    return JSONResponse(page, headers={"Vary": "Accept"})
+
+class StreamChatRequest(ChatRequest):
+    format: str = "ndjson"  # "ndjson" or "sse"
+    batch_size: int = STREAM_BATCH_SIZE
+
+@app.post("/api/chat/stream-results")
+async def stream_chat_results(request: StreamChatRequest):
+    """Like /api/chat, but SELECT results are streamed as NDJSON or SSE."""
+    if request.format not in ("ndjson", "sse"):
+        raise HTTPException(status_code=400, detail="format must be 'ndjson' or 'sse'")
+
+    db = await resolve_db(request.connection_id, user_id=request.user_id)
+    chat_history = parse_chat_history(request.chat_history)
+    try:
+        sql_query = await agenerate_sql(
+            request.question, db, format_chat_history(chat_history), use_cache=request.use_sql_cache
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
+
+    # Confirmations and non-SELECT statements keep the regular response shape
+    if detect_dangerous_sql(sql_query) or not is_select_sql(sql_query):
+        response = await run_blocking(
+            execute_generated_sql, sql_query, db, user_id=request.user_id, stage="query execution"
+        )
+        return {"success": True, "response": response}
+    verdict = await run_blocking(check_db_query_cost, db, sql_query, stage="query cost check")
+    if verdict is not None:
+        return {"success": True, "response": cost_guard_output(sql_query, verdict)}
+
+    media_type = "text/event-stream" if request.format == "sse" else "application/x-ndjson"
+    return StreamingResponse(
+        # Iterated on Starlette's thread pool, which may not see this request's contextvars
+        stream_select_events(db, sql_query, request.format, max(1, request.batch_size), read_replicas.get()),
+        media_type=media_type,
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Batch Questions ---
+# /api/chat/batch answers many questions against one connection, e.g. for
+# nightly reports. Up to BATCH_CONCURRENCY questions are in flight at once.
+# Their LLM calls wait on llm_rate_limiter, so a large batch slows down to the
+# Groq plan limits instead of failing with 429s. The schema catalog is read
+# once per batch and each question is pruned against that snapshot. SELECTs
+# run through the usual pooled (and replica-routed) connections. Results are
+# streamed as NDJSON in completion order, tagged with the question's index.
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "100"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "4"))
+
+class BatchChatRequest(BaseModel):
+    questions: list[str]
+    use_sql_cache: bool = True
+    use_result_cache: bool = True
+    user_id: Optional[int] = None
+    connection_id: Optional[str] = None
+    concurrency: Optional[int] = None  # Capped at BATCH_CONCURRENCY
+
+async def answer_batch_question(index, question, db, snapshot, request):
+    started = time.perf_counter()
+    sql_query = None
+    try:
+        sql_query = await agenerate_sql(
+            question, db, "", use_cache=request.use_sql_cache, snapshot=snapshot, rate_limiter=llm_rate_limiter
+        )
+        if is_select_sql(sql_query) or detect_dangerous_sql(sql_query):
+            # Dangerous statements come back as confirmation_required without running
+            sql_query, output = await run_blocking(
+                run_generated_sql, sql_query, db,
+                user_id=request.user_id, use_result_cache=request.use_result_cache, stage="query execution"
+            )
+        else:
+            output = {"type": "error", "message": "Batches only run SELECT statements; ask this question in the chat"}
+    except HTTPException as e:
+        output = {"type": "error", "message": e.detail}
+    except Exception as e:
+        CHAT_ERRORS.inc(type="generation_failed")
+        output = {"type": "error", "message": str(e)}
+    return {
+        "type": "result",
+        "index": index,
+        "question": question,
+        "sql": sql_query,
+        "output": structured_output(output),
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }
+
+async def iter_batch_results(request, db, snapshot, concurrency, replica_uris):
+    read_replicas.set(replica_uris)
+    started = time.perf_counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer(index, question):
+        async with semaphore:
+            return await answer_batch_question(index, question, db, snapshot, request)
+
+    tasks = [asyncio.ensure_future(answer(index, question)) for index, question in enumerate(request.questions)]
+    errors = 0
+    try:
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            errors += result["output"].get("type") == "error"
+            yield encode_stream_event(result, "ndjson")
+    finally:
+        for task in tasks:
+            task.cancel()  # Only still-pending questions are affected, e.g. after a client disconnect
+    yield encode_stream_event({
+        "type": "done",
+        "questions": len(tasks),
+        "errors": errors,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+    }, "ndjson")
+
+@app.post("/api/chat/batch")
+async def chat_batch(request: BatchChatRequest):
+    """Answer several questions against one connection, streaming typed results as each one finishes."""
+    if not request.questions:
+        raise HTTPException(status_code=400, detail="questions must not be empty")
+    if len(request.questions) > BATCH_MAX_QUESTIONS:
+        raise HTTPException(status_code=400, detail=f"At most {BATCH_MAX_QUESTIONS} questions per batch")
+
+    db = await resolve_db(request.connection_id, user_id=request.user_id)
+    snapshot = await run_blocking(schema_catalog.snapshot, db, stage="schema fetch")
+    concurrency = max(1, min(request.concurrency or BATCH_CONCURRENCY, BATCH_CONCURRENCY))
+    return StreamingResponse(
+        iter_batch_results(request, db, snapshot, concurrency, read_replicas.get()),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# --- Result Export ---
+# Exports re-run the SELECT through the same server-side cursor as the
+# streaming endpoints and write each batch straight to the response, so memory
+# stays bounded by EXPORT_BATCH_SIZE rows whatever the result size.
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "5000"))
+EXPORT_MAX_EXECUTION_MS = int(os.getenv("EXPORT_MAX_EXECUTION_MS", "600000"))  # Replaces QUERY_MAX_EXECUTION_MS
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+try:
+    import pyarrow.parquet as pyarrow_parquet
+except ImportError:
+    pyarrow_parquet = None
+
+class ExportRequest(BaseModel):
+    sql: str
+    format: str = "csv"  # "csv", "jsonl" or "parquet"
+    gzip: bool = False
+    confirmed: bool = False  # Set after the user accepted a cost-guard confirmation
+    user_id: Optional[int] = None
+    connection_id: Optional[str] = None
+
+def with_execution_time_hint(db, sql_query, max_ms):
+    """Give a long-running export its own MySQL time limit instead of the session default."""
+    if not max_ms or db.dialect != "mysql":
+        return sql_query
+    return re.sub(r"^\s*SELECT\b", f"SELECT /*+ MAX_EXECUTION_TIME({int(max_ms)}) */", sql_query, count=1, flags=re.IGNORECASE)
+
+def iter_csv_chunks(columns, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in batches:
+        writer.writerows([format_cell(cell) for cell in row] for row in rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode("utf-8")
+
+def iter_jsonl_chunks(columns, batches):
+    for rows in batches:
+        yield "".join(
+            json.dumps(dict(zip(columns, (wire_value(cell) for cell in row)))) + "\n" for row in rows
+        ).encode("utf-8")
+
+class ExportChunkSink:
+    """Write-only file object that hands back whatever was written since the last drain()."""
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def parquet_array(values, field_type):
+    if pyarrow.types.is_string(field_type):
+        values = [value if value is None or isinstance(value, str) else str(value) for value in values]
+    return pyarrow.array(values, type=field_type)
+
+def parquet_field_type(values):
+    """Column type fixed from the first batch, wide enough for the batches after it.
+
+    Decimals get all 38 digits at the scale seen (drivers return every value of
+    a DECIMAL column at its declared scale), and a column with no typed value
+    yet, e.g. all NULL, is a string column that later values are written into.
+    """
+    field_type = arrow_column(values).type
+    if pyarrow.types.is_null(field_type):
+        return pyarrow.string()
+    if pyarrow.types.is_decimal(field_type):
+        return pyarrow.decimal128(38, field_type.scale)
+    return field_type
+
+def iter_parquet_chunks(columns, batches):
+    """One Parquet row group per batch, all written with the schema fixed by the first batch."""
+    sink = ExportChunkSink()
+    writer = None
+    schema = None
+    for rows in batches:
+        arrays = [list(values) for values in zip(*rows)]
+        if writer is None:
+            schema = pyarrow.schema(
+                [pyarrow.field(name, parquet_field_type(values)) for name, values in zip(columns, arrays)]
+            )
+            writer = pyarrow_parquet.ParquetWriter(sink, schema)
+        table = pyarrow.Table.from_arrays(
+            [parquet_array(values, field.type) for values, field in zip(arrays, schema)], schema=schema
+        )
+        writer.write_table(table)
+        yield sink.drain()
+    if writer is None:
+        writer = pyarrow_parquet.ParquetWriter(sink, pyarrow.schema([(name, pyarrow.string()) for name in columns]))
+    writer.close()
+    yield sink.drain()
+
+EXPORT_WRITERS = {"csv": iter_csv_chunks, "jsonl": iter_jsonl_chunks, "parquet": iter_parquet_chunks}
+
+def gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits=31: gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def iter_export_body(chunks, batches):
+    try:
+        for chunk in chunks:
+            if chunk:
+                yield chunk
+    finally:
+        batches.close()
+
+async def start_export(db, sql_query, export_format, compress):
+    if export_format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"format must be one of: {', '.join(EXPORT_FORMATS)}")
+    if export_format == "parquet" and pyarrow_parquet is None:
+        raise HTTPException(status_code=400, detail="Parquet export requires pyarrow")
+
+    batches = iter_select_batches(
+        db, with_execution_time_hint(db, sql_query, EXPORT_MAX_EXECUTION_MS), EXPORT_BATCH_SIZE, raw=True
+    )
+    try:
+        # Open the cursor before responding so SQL errors still get a proper status code
+        columns = await run_blocking(next, batches, stage="query execution")
+    except HTTPException:
+        db_executor.submit(batches.close)
+        raise
+    except Exception as e:
+        db_executor.submit(batches.close)
+        raise HTTPException(status_code=400, detail=f"Query execution failed: {str(e)}")
+
+    chunks = EXPORT_WRITERS[export_format](columns, batches)
+    filename = f"query-genie-export-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{export_format}"
+    media_type = EXPORT_FORMATS[export_format]
+    if compress:
+        chunks = gzip_chunks(chunks)
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        iter_export_body(chunks, batches),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"', "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/api/export")
+async def export_sql(request: ExportRequest):
+    """Stream the full result of a SELECT as CSV, JSONL or Parquet, optionally gzipped."""
+    sql_query = strip_statement_terminator(request.sql)
+    if detect_dangerous_sql(sql_query) or not is_select_sql(sql_query):
+        raise HTTPException(status_code=400, detail="Only SELECT statements can be exported")
+
+    db = await resolve_db(request.connection_id, user_id=request.user_id)
+    verdict = await run_blocking(check_db_query_cost, db, sql_query, stage="query cost check")
+    if verdict is not None and (verdict["action"] == "reject" or not request.confirmed):
+        raise HTTPException(status_code=400 if verdict["action"] == "reject" else 409, detail=verdict["message"])
+    return await start_export(db, sql_query, request.format, request.gzip)
+
+@app.get("/api/results/{result_id}/export")
+async def export_result(
+    result_id: str, format: str = "csv", gzip: bool = False,
+    user_id: Optional[int] = None, connection_id: Optional[str] = None,
+):
+    """Export every row of a paged chat result (re-runs its SQL)."""
+    db = await resolve_db(connection_id, user_id=user_id)
+    handle = result_handles.get(result_id, user_id, db)
+    return await start_export(db, handle["sql"], format, gzip)
+
 # --- Chat Session Endpoints ---
 
 from fastapi import Path
 import json
 
+def load_session_messages(db_session, session_ids):
+    """Return {session_id: [message, ...]} in seq order with a single query."""
+    messages = {session_id: [] for session_id in session_ids}
+    if not session_ids:
+        return messages
+    rows = (
+        db_session.query(ChatMessage.session_id, ChatMessage.payload)
+        .filter(ChatMessage.session_id.in_(session_ids))
+        .order_by(ChatMessage.session_id, ChatMessage.seq)
+    )
+    for session_id, payload in rows:
+        messages[session_id].append(json.loads(payload))
+    return messages
+
+def stored_messages_digest(chat_session):
+    """Digest of the session's stored messages, or None for sessions stored before digests were kept."""
+    if chat_session.messages_digest is None and not chat_session.message_count:
+        return ""
+    return chat_session.messages_digest
+
+def append_session_messages(db_session, chat_session, messages):
+    now = datetime.utcnow()
+    rows = [
+        message_row(chat_session.id, chat_session.message_count + i, message, now)
+        for i, message in enumerate(messages)
+    ]
+    if rows:
+        db_session.execute(ChatMessage.__table__.insert(), rows)
+    chat_session.messages_digest = chain_messages_digest(
+        stored_messages_digest(chat_session), [row["payload"] for row in rows]
+    )
+    chat_session.message_count += len(messages)
+    chat_session.updated_at = now
+
+def replace_session_messages(db_session, chat_session, messages):
+    db_session.query(ChatMessage).filter(ChatMessage.session_id == chat_session.id).delete()
+    chat_session.message_count = 0
+    chat_session.messages_digest = None
+    append_session_messages(db_session, chat_session, messages)
+
+def session_timestamp(chat_session):
+    return (chat_session.updated_at or datetime.utcnow()).isoformat()
+
+def get_owned_session(db_session, session_id, user_id):
+    chat_session = db_session.query(ChatSession).filter(ChatSession.id == session_id).first()
+    if not chat_session:
+        raise HTTPException(status_code=404, detail="Chat session not found")
+    if chat_session.user_id != user_id:
+        raise HTTPException(status_code=403, detail="Unauthorized to access this session")
+    return chat_session
+
 @app.get("/api/chat-sessions")
 async def get_chat_sessions(user_id: int):
-    db_session = SessionLocal()
+    db_session = ReadSessionLocal()
     try:
         sessions = db_session.query(ChatSession).filter(ChatSession.user_id == user_id).all()
+        messages = load_session_messages(db_session, [session.id for session in sessions])
         result = []
         for session in sessions:
             result.append({
                 "id": session.id,
                 "title": session.title,
-                "messages": json.loads(session.messages),
-                "timestamp": datetime.utcnow().isoformat()
+                "messages": messages[session.id],
+                "timestamp": session_timestamp(session)
             })
         return result
     finally:
         db_session.close()
 
+@app.get("/api/chat-sessions/summaries")
+async def get_chat_session_summaries(user_id: int, limit: int = 50, offset: int = 0):
+    """Sidebar listing: session metadata only, newest first, without loading any messages."""
+    limit = max(1, min(limit, 200))
+    offset = max(0, offset)
+    db_session = ReadSessionLocal()
+    try:
+        query = db_session.query(ChatSession).filter(ChatSession.user_id == user_id)
+        total = query.count()
+        sessions = (
+            query.order_by(ChatSession.updated_at.desc(), ChatSession.id.desc())
+            .offset(offset)
+            .limit(limit)
+            .all()
+        )
+        return {
+            "sessions": [{
+                "id": session.id,
+                "title": session.title,
+                "message_count": session.message_count,
+                "timestamp": session_timestamp(session)
+            } for session in sessions],
+            "total": total,
+            "limit": limit,
+            "offset": offset
+        }
+    finally:
+        db_session.close()
+
+@app.get("/api/chat-sessions/{session_id}/messages")
+async def get_chat_session_messages(session_id: int, user_id: int, after_seq: int = -1, limit: int = 100):
+    limit = max(1, min(limit, 500))
+    db_session = ReadSessionLocal()
+    try:
+        get_owned_session(db_session, session_id, user_id)
+        rows = (
+            db_session.query(ChatMessage.seq, ChatMessage.payload)
+            .filter(ChatMessage.session_id == session_id, ChatMessage.seq > after_seq)
+            .order_by(ChatMessage.seq)
+            .limit(limit + 1)
+            .all()
+        )
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            "session_id": session_id,
+            "messages": [{"seq": seq, "message": json.loads(payload)} for seq, payload in rows],
+            "has_more": has_more,
+            "next_after_seq": rows[-1][0] if has_more else None
+        }
+    finally:
+        db_session.close()
+
+class AppendMessagesRequest(BaseModel):
+    user_id: int
+    messages: list
+
+@app.post("/api/chat-sessions/{session_id}/messages")
+async def append_chat_session_messages(session_id: int, request: AppendMessagesRequest):
+    def write(db_session):
+        chat_session = get_owned_session(db_session, session_id, request.user_id)
+        append_session_messages(db_session, chat_session, request.messages)
+        return {
+            "id": chat_session.id,
+            "message_count": chat_session.message_count,
+            "appended": len(request.messages),
+            "timestamp": session_timestamp(chat_session)
+        }
+
+    try:
+        return await session_writer.run(write)
+    except HTTPException as e:
+        raise e
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to append messages: {str(e)}")
+
 @app.post("/api/chat-sessions")
 async def create_chat_session(session: dict):
-    db_session = SessionLocal()
-    try:
+    messages = session.get("messages", [])
+
+    def write(db_session):
+        now = datetime.utcnow()
         new_session = ChatSession(
             user_id=session.get("user_id"),
             title=session.get("title", "Untitled Chat"),
-            messages=json.dumps(session.get("messages", []))
+            messages="[]",
+            message_count=0,
+            created_at=now,
+            updated_at=now
         )
         db_session.add(new_session)
-        db_session.commit()
-        db_session.refresh(new_session)
+        db_session.flush()
+        append_session_messages(db_session, new_session, messages)
         return {
             "id": new_session.id,
             "title": new_session.title,
-            "messages": json.loads(new_session.messages),
-            "timestamp": datetime.utcnow().isoformat()
+            "messages": messages,
+            "timestamp": session_timestamp(new_session)
         }
+
+    try:
+        return await session_writer.run(write)
     except Exception as e:
-        db_session.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to create chat session: {str(e)}")
-    finally:
-        db_session.close()
 
 @app.put("/api/chat-sessions/{session_id}")
 async def update_chat_session(session_id: int, session: dict):
-    db_session = SessionLocal()
-    try:
+    def write(db_session):
         existing_session = db_session.query(ChatSession).filter(ChatSession.id == session_id).first()
         if not existing_session:
             raise HTTPException(status_code=404, detail="Chat session not found")
@@ -621,52 +4762,75 @@ async def update_chat_session(session_id: int, session: dict):
         # Update title if provided
         if "title" in session:
             existing_session.title = session["title"]
+            existing_session.updated_at = datetime.utcnow()
 
-        # Update messages if provided
+        # Update messages if provided. Clients resend the whole conversation; when every
+        # stored message is still its prefix (same digest), only the new tail is inserted.
+        # Any earlier edit or deletion changes the digest and rewrites the session.
         if "messages" in session:
-            existing_session.messages = json.dumps(session["messages"])
+            messages = session["messages"]
+            stored = existing_session.message_count
+            digest = stored_messages_digest(existing_session)
+            if (
+                digest is not None and stored <= len(messages)
+                and chain_messages_digest("", [json.dumps(message) for message in messages[:stored]]) == digest
+            ):
+                append_session_messages(db_session, existing_session, messages[stored:])
+            else:
+                replace_session_messages(db_session, existing_session, messages)
+        else:
+            messages = load_session_messages(db_session, [session_id])[session_id]
 
-        db_session.commit()
         return {
             "id": existing_session.id,
             "title": existing_session.title,
-            "messages": json.loads(existing_session.messages),
-            "timestamp": datetime.utcnow().isoformat()
+            "messages": messages,
+            "timestamp": session_timestamp(existing_session)
         }
+
+    try:
+        return await session_writer.run(write)
+    except HTTPException as e:
+        raise e
     except Exception as e:
-        db_session.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to update chat session: {str(e)}")
-    finally:
-        db_session.close()
 
 @app.delete("/api/chat-sessions/{session_id}")
 async def delete_chat_session(session_id: int = Path(..., description="The ID of the chat session to delete"), user_id: int = None):
     if user_id is None:
         raise HTTPException(status_code=400, detail="user_id is required")
-    db_session = SessionLocal()
-    try:
+
+    def write(db_session):
         session = db_session.query(ChatSession).filter(ChatSession.id == session_id).first()
         if not session:
             raise HTTPException(status_code=404, detail="Chat session not found")
         if session.user_id != user_id:
             raise HTTPException(status_code=403, detail="Unauthorized to delete this session")
+        db_session.query(ChatMessage).filter(ChatMessage.session_id == session_id).delete()
         db_session.delete(session)
-        db_session.commit()
         return {"success": True, "message": "Chat session deleted"}
+
+    try:
+        return await session_writer.run(write)
     except HTTPException as e:
         raise e
     except Exception as e:
-        db_session.rollback()
         raise HTTPException(status_code=500, detail=f"Failed to delete chat session: {str(e)}")
-    finally:
-        db_session.close()
 
 from pydantic import BaseModel
 
+def run_confirmed_sql(db, sql):
+    db.run(sql)
+    schema_catalog.invalidate(db)
+    result_cache.invalidate_for_write(db, sql)
+
 class ConfirmSQLRequest(BaseModel):
     user_id: int
     confirm: bool
     sql: str
+    connection_id: Optional[str] = None
+    batch_size: Optional[int] = None  # Rows per chunk for batched DELETE/UPDATE jobs
+    pause_ms: Optional[float] = None  # Pause between chunks
 
 @app.post("/api/confirm-sql")
 async def confirm_sql_action(req: ConfirmSQLRequest):
@@ -678,11 +4842,36 @@ async def confirm_sql_action(req: ConfirmSQLRequest):
         }
 
     try:
-        if not hasattr(app.state, "db_uri"):
-            raise HTTPException(status_code=400, detail="Database not connected")
+        db = await resolve_db(req.connection_id, route_reads=False, user_id=req.user_id)  # Confirmed statements always run on the primary
+        if is_select_sql(req.sql):
+            # A SELECT held back by the cost guard; run it and answer like /api/chat
+            response = await run_blocking(
+                execute_generated_sql, req.sql, db, user_id=req.user_id, cost_check=False, stage="query execution"
+            )
+            return {"type": "result", "success": True, "response": response}
 
-        db = SQLDatabase.from_uri(app.state.db_uri)
-        db.run(req.sql)
+        batch_size = req.batch_size or WRITE_JOB_BATCH_SIZE
+        if batch_size < 1:
+            raise ValueError("batch_size must be positive")
+        plan = await run_blocking(safe_plan_batched_write, db, req.sql, stage="write planning")
+        if plan is not None and plan["key_column"] and plan["estimated_rows"] > batch_size:
+            if not req.connection_id:
+                # A job outlives the request, so it needs a database this user owns, not the process-wide one
+                raise ValueError(
+                    f"{plan['action']} on {plan['table']} touches about {plan['estimated_rows']:,} rows and runs as "
+                    "a batched job, which needs the connection_id returned by /api/connect"
+                )
+            pause_ms = WRITE_JOB_PAUSE_MS if req.pause_ms is None else max(0.0, req.pause_ms)
+            job = await write_jobs.create(req.connection_id, db, req.sql, plan, req.user_id, batch_size, pause_ms)
+            return {
+                "type": "job",
+                "job": job,
+                "message": (
+                    f"{plan['action']} on {plan['table']} is running in batches of {batch_size:,} rows "
+                    f"(about {plan['estimated_rows']:,} rows). Job ID: {job['job_id']}"
+                ),
+            }
+        await run_blocking(run_confirmed_sql, db, req.sql, stage="query execution")
 
         return {
             "type": "status",
@@ -694,10 +4883,108 @@ async def confirm_sql_action(req: ConfirmSQLRequest):
             "message": str(e)
         }
 
+@app.get("/api/write-jobs")
+async def list_write_jobs(user_id: int):
+    return await run_blocking(write_jobs.for_user, user_id, stage="write job lookup")
+
+@app.get("/api/write-jobs/{job_id}")
+async def get_write_job(job_id: str, user_id: int):
+    job = await run_blocking(write_jobs.get, job_id, user_id, stage="write job lookup")
+    if job is None:
+        raise HTTPException(status_code=404, detail="Write job not found")
+    return job
+
+@app.post("/api/write-jobs/{job_id}/cancel")
+async def cancel_write_job(job_id: str, user_id: int):
+    """Stop a job after its current chunk; rows already changed stay changed."""
+    return await write_jobs.cancel(job_id, user_id)
+
+@app.post("/api/write-jobs/{job_id}/resume")
+async def resume_write_job(job_id: str, user_id: int):
+    """Continue an interrupted, cancelled or failed job after its last committed chunk."""
+    return await write_jobs.resume(job_id, user_id)
+
+# --- Metrics Endpoint ---
+def collect_component_metrics():
+    sql_cache = sql_generation_cache.stats()
+    results = result_cache.stats()
+    hashing = hashing_pool.stats()
+    return [
+        ("querygenie_cache_hits_total", "counter", "Cache hits by cache.", [
+            ({"cache": "sql_generation"}, sql_cache["hits"]),
+            ({"cache": "sql_generation_persistent"}, sql_cache["persistent_hits"]),
+            ({"cache": "results"}, results["hits"]),
+        ]),
+        ("querygenie_cache_misses_total", "counter", "Cache misses by cache.", [
+            ({"cache": "sql_generation"}, sql_cache["misses"]),
+            ({"cache": "results"}, results["misses"]),
+        ]),
+        ("querygenie_result_cache_bytes", "gauge", "Bytes held by the result cache.", [({}, results["bytes"])]),
+        ("querygenie_bcrypt_pending", "gauge", "Password hashes queued or running.", [({}, hashing["pending"])]),
+        ("querygenie_bcrypt_completed_total", "counter", "Password hashes completed.", [({}, hashing["completed"])]),
+        ("querygenie_bcrypt_failed_total", "counter", "Password hashes that raised or were cancelled.", [({}, hashing["failed"])]),
+        ("querygenie_bcrypt_rejected_total", "counter", "Password hashes shed with 503.", [({}, hashing["rejected"])]),
+        ("querygenie_sqlite_write_batches_total", "counter", "users.db write transactions.", [({}, session_writer.batches)]),
+        ("querygenie_sqlite_writes_total", "counter", "users.db writes applied.", [({}, session_writer.writes)]),
+        ("querygenie_llm_rate_limit_wait_seconds_total", "counter", "Time batch LLM calls waited on the Groq rate limits.", [
+            ({}, round(llm_rate_limiter.waited_seconds, 3))
+        ]),
+        ("querygenie_emails_sent_total", "counter", "Emails delivered.", [({}, email_dispatcher.sent)]),
+        ("querygenie_emails_failed_total", "counter", "Emails dropped after retries.", [({}, email_dispatcher.failed)]),
+        ("querygenie_target_engines", "gauge", "Cached target database engines.", [({}, db_registry.stats()["entries"])]),
+        ("querygenie_write_jobs_running", "gauge", "Batched write jobs running in this process.", [({}, write_jobs.stats()["running"])]),
+    ]
+
+metrics.collectors.append(collect_component_metrics)
+metrics.collectors.append(collect_pool_metrics)
+
+@app.middleware("http")
+async def record_request_timings(request: Request, call_next):
+    timings = {}
+    prompt_sizes = {}
+    token = request_timings.set(timings)
+    prompt_token = request_prompt_tokens.set(prompt_sizes)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = "client_closed" if getattr(request.state, "client_disconnected", False) else response.status_code
+        # Streaming responses send headers before the body, so they only carry the stages run so far
+        response.headers["Server-Timing"] = server_timing_header(timings, time.perf_counter() - started)
+        if prompt_sizes:
+            response.headers["X-Prompt-Tokens"] = prompt_tokens_header(prompt_sizes)
+        return response
+    finally:
+        route = request.scope.get("route")
+        HTTP_REQUEST_SECONDS.observe(
+            time.perf_counter() - started,
+            method=request.method, route=route.path if route else "unmatched", status=status,
+        )
+        request_timings.reset(token)
+        request_prompt_tokens.reset(prompt_token)
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+# --- Warm shared clients on startup ---
+@app.on_event("startup")
+async def startup_event():
+    get_sql_generation_chain()
+    otp_storage.start_sweeper()
+
 # --- Cleanup on shutdown ---
 @app.on_event("shutdown")
 async def shutdown_event():
     """Clean up resources on application shutdown"""
+    write_jobs.stop()  # Before the write queue: interrupted jobs record their state through it
+    session_writer.stop()
+    email_dispatcher.stop()
+    otp_storage.stop_sweeper()
+    hashing_pool.shutdown()
+    db_executor.shutdown(wait=False, cancel_futures=True)
+    await close_groq_http_clients()
+    db_registry.dispose_all()
     if hasattr(app.state, "db_uri"):
         delattr(app.state, "db_uri")
     print("Application shutdown - resources cleaned up")
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""Concurrent-request throughput for /api/chat against a running backend.
+
+Run it against the build before and after a change and compare the two
+result files:
+
+    python benchmarks/bench_chat_concurrency.py --url http://localhost:8000 \
+        --concurrency 1 4 16 --requests 64 --output after.json
+    python benchmarks/bench_chat_concurrency.py --compare before.json after.json
+
+The backend must already be connected to a database (POST /api/connect).
+While the chat load runs, a probe thread keeps requesting a cheap endpoint;
+its latency shows whether the event loop is being blocked by chat requests.
+"""
+import argparse
+import json
+import statistics
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+
+def percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index] * 1000, 1)
+
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 50),
+        "p95_ms": percentile(latencies, 95),
+        "p99_ms": percentile(latencies, 99),
+        "mean_ms": round(statistics.mean(latencies) * 1000, 1) if latencies else None,
+    }
+
+
+def timed_request(url, payload=None, timeout=300, method=None):
+    data = json.dumps(payload).encode("utf-8") if payload is not None else None
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"}, method=method)
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+def run_level(base_url, question, concurrency, total_requests, probe_path):
+    chat_latencies, probe_latencies, errors = [], [], []
+    stop_probe = threading.Event()
+
+    def probe():
+        while not stop_probe.is_set():
+            try:
+                probe_latencies.append(timed_request(base_url + probe_path))
+            except Exception as e:
+                errors.append(f"probe: {e}")
+            stop_probe.wait(0.05)
+
+    def chat(_):
+        try:
+            chat_latencies.append(timed_request(base_url + "/api/chat", {
+                "question": question,
+                "chat_history": [],
+                "use_sql_cache": False,
+            }))
+        except Exception as e:
+            errors.append(f"chat: {e}")
+
+    probe_thread = threading.Thread(target=probe, daemon=True)
+    probe_thread.start()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(chat, range(total_requests)))
+    elapsed = time.perf_counter() - started
+    stop_probe.set()
+    probe_thread.join()
+
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(chat_latencies) / elapsed, 2) if elapsed else None,
+        "chat": summarize(chat_latencies),
+        "probe": summarize(probe_latencies),
+        "errors": len(errors),
+        "sample_errors": errors[:5],
+    }
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {level["concurrency"]: level for level in json.load(f)["levels"]}
+    with open(after_path) as f:
+        after = {level["concurrency"]: level for level in json.load(f)["levels"]}
+    print(f"{'conc':>5} {'rps before':>11} {'rps after':>10} {'probe p95 before':>17} {'probe p95 after':>16}")
+    for concurrency in sorted(set(before) & set(after)):
+        b, a = before[concurrency], after[concurrency]
+        print(
+            f"{concurrency:>5} {b['throughput_rps']:>11} {a['throughput_rps']:>10} "
+            f"{b['probe']['p95_ms']!s:>17} {a['probe']['p95_ms']!s:>16}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--question", default="How many rows are in each table?")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--requests", type=int, default=32, help="chat requests per concurrency level")
+    parser.add_argument("--probe-path", default="/openapi.json")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    levels = []
+    for concurrency in args.concurrency:
+        level = run_level(args.url.rstrip("/"), args.question, concurrency, args.requests, args.probe_path)
+        print(json.dumps(level))
+        levels.append(level)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"url": args.url, "question": args.question, "levels": levels}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
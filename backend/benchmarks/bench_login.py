@@ -0,0 +1,97 @@
+"""Login throughput and latency at several concurrency levels.
+
+Uses an existing account (sign-up needs an emailed OTP, so create one by
+hand first). 503 responses are load being shed by the bcrypt pool and are
+counted separately from errors:
+
+    python benchmarks/bench_login.py --email me@example.com --password secret \
+        --concurrency 1 8 32 128 --output after.json
+    python benchmarks/bench_login.py --compare before.json after.json
+"""
+import argparse
+import json
+import time
+import urllib.error
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_chat_concurrency import summarize, timed_request
+
+
+def run_level(base_url, email, password, concurrency, total_requests):
+    latencies, shed, errors = [], [], []
+
+    def login(_):
+        started = time.perf_counter()
+        try:
+            latencies.append(timed_request(base_url + "/api/login", {"identifier": email, "password": password}))
+        except urllib.error.HTTPError as e:
+            if e.code == 503:
+                shed.append(time.perf_counter() - started)
+            else:
+                errors.append(f"HTTP {e.code}")
+        except Exception as e:
+            errors.append(str(e))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(login, range(total_requests)))
+    elapsed = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "elapsed_s": round(elapsed, 3),
+        "logins_per_s": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency": summarize(latencies),
+        "shed_503": len(shed),
+        "shed_latency": summarize(shed),
+        "errors": len(errors),
+        "sample_errors": errors[:5],
+    }
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {level["concurrency"]: level for level in json.load(f)["levels"]}
+    with open(after_path) as f:
+        after = {level["concurrency"]: level for level in json.load(f)["levels"]}
+    print(f"{'conc':>5} {'login/s before':>15} {'login/s after':>14} {'p95 before':>11} {'p95 after':>10}")
+    for concurrency in sorted(set(before) & set(after)):
+        b, a = before[concurrency], after[concurrency]
+        print(
+            f"{concurrency:>5} {b['logins_per_s']:>15} {a['logins_per_s']:>14} "
+            f"{b['latency']['p95_ms']!s:>11} {a['latency']['p95_ms']!s:>10}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--email")
+    parser.add_argument("--password")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 128])
+    parser.add_argument("--requests", type=int, default=None, help="logins per level (default: 4x concurrency)")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if not args.email or not args.password:
+        parser.error("--email and --password are required")
+
+    levels = []
+    for concurrency in args.concurrency:
+        total = args.requests or concurrency * 4
+        level = run_level(args.url.rstrip("/"), args.email, args.password, concurrency, total)
+        print(json.dumps(level))
+        levels.append(level)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"url": args.url, "levels": levels}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""Chat-session write throughput against a running backend.
+
+Each worker owns a chat session and keeps saving it the way the frontend
+does: a PUT with the whole conversation after every new message. Compare
+SQLITE_STORAGE_MODE=legacy (one pooled transaction per PUT) with the
+default WAL + batched single-writer mode:
+
+    SQLITE_STORAGE_MODE=legacy uvicorn backend:app --port 8000
+    python benchmarks/bench_session_writes.py --output before.json
+    uvicorn backend:app --port 8000
+    python benchmarks/bench_session_writes.py --output after.json
+    python benchmarks/bench_session_writes.py --compare before.json after.json
+"""
+import argparse
+import json
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from bench_chat_concurrency import summarize, timed_request
+
+
+def create_session(base_url, user_id):
+    request = urllib.request.Request(
+        base_url + "/api/chat-sessions",
+        data=json.dumps({"user_id": user_id, "title": "bench", "messages": []}).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())["id"]
+
+
+def delete_session(base_url, session_id, user_id):
+    request = urllib.request.Request(
+        f"{base_url}/api/chat-sessions/{session_id}?user_id={user_id}", method="DELETE"
+    )
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+
+def run_level(base_url, user_id, concurrency, writes_per_worker):
+    session_ids = [create_session(base_url, user_id) for _ in range(concurrency)]
+    latencies, errors = [], []
+
+    def worker(session_id):
+        messages = []
+        for i in range(writes_per_worker):
+            messages.append({"role": "user" if i % 2 == 0 else "ai", "content": f"message {i} " + "x" * 200})
+            try:
+                latencies.append(timed_request(
+                    f"{base_url}/api/chat-sessions/{session_id}",
+                    {"user_id": user_id, "messages": messages},
+                    method="PUT",
+                ))
+            except Exception as e:
+                errors.append(str(e))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(worker, session_ids))
+    elapsed = time.perf_counter() - started
+
+    for session_id in session_ids:
+        delete_session(base_url, session_id, user_id)
+
+    return {
+        "concurrency": concurrency,
+        "writes": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "writes_per_s": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency": summarize(latencies),
+        "errors": len(errors),
+        "sample_errors": errors[:5],
+    }
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = {level["concurrency"]: level for level in json.load(f)["levels"]}
+    with open(after_path) as f:
+        after = {level["concurrency"]: level for level in json.load(f)["levels"]}
+    print(f"{'conc':>5} {'w/s before':>11} {'w/s after':>10} {'errors before':>14} {'errors after':>13}")
+    for concurrency in sorted(set(before) & set(after)):
+        b, a = before[concurrency], after[concurrency]
+        print(f"{concurrency:>5} {b['writes_per_s']:>11} {a['writes_per_s']:>10} {b['errors']:>14} {a['errors']:>13}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--user-id", type=int, default=999999)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--writes", type=int, default=50, help="PUTs per worker")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    levels = []
+    for concurrency in args.concurrency:
+        level = run_level(args.url.rstrip("/"), args.user_id, concurrency, args.writes)
+        print(json.dumps(level))
+        levels.append(level)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"url": args.url, "levels": levels}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
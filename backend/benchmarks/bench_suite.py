@@ -0,0 +1,219 @@
+"""End-to-end benchmarks for /api/chat, chat-session CRUD and login, in process.
+
+The app is driven through httpx's ASGI transport, with no network and no
+external services:
+- users.db and the connection secret key are fresh temporary files.
+- Emails go to the in-memory backend.
+- The SQL chain uses FakeSQLChatModel, which answers instantly or after
+  --llm-latency-ms.
+- Chat runs against a seeded SQLite database (see seed_databases.py).
+
+    python benchmarks/bench_suite.py --size medium --concurrency 1 8 32 \
+        --requests 200 --output after.json
+    python benchmarks/bench_suite.py --compare before.json after.json
+
+Caches are bypassed by default so every chat request does the full pipeline.
+Pass --use-caches to measure the warm path instead.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix="qg-bench-")
+
+# The backend reads its configuration at import time. Storage and email are
+# always redirected, so a run never touches the real users.db, key or inbox.
+os.environ["SQLITE_DB_FILE"] = os.path.join(WORK_DIR, "users.db")
+os.environ["CONNECTION_SECRET_KEY_FILE"] = os.path.join(WORK_DIR, "connection_secret.key")
+os.environ["EMAIL_BACKEND"] = "memory"
+os.environ.setdefault("GROQ_API_KEY", "benchmark")
+sys.path.insert(0, BACKEND_DIR)
+
+import httpx  # noqa: E402
+
+import backend  # noqa: E402
+from bench_chat_concurrency import summarize  # noqa: E402
+from fake_llm import FakeSQLChatModel  # noqa: E402
+from seed_databases import CANNED_SQL, QUESTIONS, seed  # noqa: E402
+
+SCENARIOS = ("chat", "sessions", "login")
+LOGIN_EMAIL = "bench@example.com"
+LOGIN_PASSWORD = "bench-password"
+
+
+async def run_level(operation, concurrency, total_requests):
+    """Run operation(i) total_requests times with at most `concurrency` in flight."""
+    latencies, errors = [], []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i):
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                await operation(i)
+                latencies.append(time.perf_counter() - started)
+            except Exception as e:
+                errors.append(f"{type(e).__name__}: {e}")
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(total_requests)))
+    elapsed = time.perf_counter() - started
+    return {
+        "concurrency": concurrency,
+        "requests": total_requests,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency": summarize(latencies),
+        "errors": len(errors),
+        "sample_errors": errors[:5],
+    }
+
+
+def checked(response):
+    response.raise_for_status()
+    return response.json()
+
+
+def create_login_user():
+    """The benchmark login user's id, creating the user through the app's single writer."""
+    hashed_password = backend.get_password_hash(LOGIN_PASSWORD)
+
+    def write(db_session):
+        user = backend.get_user(LOGIN_EMAIL, db_session)
+        if user is None:
+            user = backend.User(
+                email=LOGIN_EMAIL, firstName="Bench", lastName="User", gender="other", username="bench",
+                hashed_password=hashed_password,
+            )
+            db_session.add(user)
+            db_session.flush()
+        return user.id
+
+    return backend.session_writer.submit(write).result()
+
+
+def build_operations(client, connection_id, owner_id, questions, use_caches):
+    async def chat(i):
+        checked(await client.post("/api/chat", json={
+            "question": questions[i % len(questions)],
+            "chat_history": [],
+            "use_sql_cache": use_caches,
+            "use_result_cache": use_caches,
+            "connection_id": connection_id,
+            "user_id": owner_id,
+        }))
+
+    async def sessions(i):
+        user_id = 1 + i % 16
+        created = checked(await client.post("/api/chat-sessions", json={
+            "user_id": user_id,
+            "title": f"Bench {i}",
+            "messages": [{"role": "user", "content": "hello"}],
+        }))
+        checked(await client.put(f"/api/chat-sessions/{created['id']}", json={
+            "user_id": user_id,
+            "messages": [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "hi"}],
+        }))
+        checked(await client.get("/api/chat-sessions", params={"user_id": user_id}))
+        checked(await client.delete(f"/api/chat-sessions/{created['id']}", params={"user_id": user_id}))
+
+    async def login(_):
+        checked(await client.post("/api/login", json={"identifier": LOGIN_EMAIL, "password": LOGIN_PASSWORD}))
+
+    return {"chat": chat, "sessions": sessions, "login": login}
+
+
+async def run_suite(args):
+    db_path = seed(os.path.join(WORK_DIR, f"target-{args.size}.db"), args.size)
+    llm = FakeSQLChatModel(responses=CANNED_SQL, latency_s=args.llm_latency_ms / 1000)
+    backend.set_sql_llm(llm)
+    owner_id = create_login_user()
+    connection_id = await backend.connection_profiles.create(f"sqlite:///{db_path}", f"target-{args.size}", owner_id)
+    questions = [QUESTIONS[name] for name in args.questions]
+
+    results = {}
+    transport = httpx.ASGITransport(app=backend.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=300) as client:
+        operations = build_operations(client, connection_id, owner_id, questions, args.use_caches)
+        for scenario in args.scenarios:
+            await run_level(operations[scenario], 1, min(3, args.requests))  # warm-up
+            results[scenario] = []
+            for concurrency in args.concurrency:
+                level = await run_level(operations[scenario], concurrency, args.requests)
+                print(json.dumps({"scenario": scenario, **level}))
+                results[scenario].append(level)
+    return {"meta": run_metadata(args, llm), "results": results}
+
+
+def run_metadata(args, llm):
+    try:
+        revision = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        revision = None
+    return {
+        "revision": revision,
+        "python": platform.python_version(),
+        "size": args.size,
+        "questions": args.questions,
+        "llm_latency_ms": args.llm_latency_ms,
+        "llm_calls": llm.calls,
+        "use_caches": args.use_caches,
+        "storage_mode": backend.SQLITE_STORAGE_MODE,
+    }
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)["results"]
+    with open(after_path) as f:
+        after = json.load(f)["results"]
+    print(f"{'scenario':>9} {'conc':>5} {'rps before':>11} {'rps after':>10} {'p95 before':>11} {'p95 after':>10}")
+    for scenario in SCENARIOS:
+        b_levels = {level["concurrency"]: level for level in before.get(scenario, [])}
+        a_levels = {level["concurrency"]: level for level in after.get(scenario, [])}
+        for concurrency in sorted(set(b_levels) & set(a_levels)):
+            b, a = b_levels[concurrency], a_levels[concurrency]
+            print(
+                f"{scenario:>9} {concurrency:>5} {b['throughput_rps']!s:>11} {a['throughput_rps']!s:>10} "
+                f"{b['latency']['p95_ms']!s:>11} {a['latency']['p95_ms']!s:>10}"
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=("small", "medium", "large"), default="small")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--questions", nargs="+", choices=sorted(QUESTIONS), default=["count", "group", "recent", "join"])
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=100, help="operations per concurrency level")
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--use-caches", action="store_true")
+    parser.add_argument("--output", help="write results as JSON to this file")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    try:
+        report = asyncio.run(run_suite(args))
+    finally:
+        backend.session_writer.stop()
+        backend.hashing_pool.shutdown()
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
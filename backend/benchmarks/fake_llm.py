@@ -0,0 +1,49 @@
+"""Deterministic stand-in for ChatGroq used by the benchmark suite.
+
+Plug it into the backend's SQL chain with backend.set_sql_llm(). It answers
+from a table of canned SQL keyed by a lowercase phrase in the question and
+sleeps for a configurable latency, so a run measures the backend rather than
+the LLM provider.
+"""
+import asyncio
+import re
+import time
+
+from langchain_core.language_models.chat_models import SimpleChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+QUESTION_PATTERN = re.compile(r"User Question:\s*(.*?)\s*Your response must", re.S)
+
+
+class FakeSQLChatModel(SimpleChatModel):
+    responses: dict = {}  # lowercase phrase in the question -> SQL
+    default_sql: str = "SELECT 1"
+    latency_s: float = 0.0
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+        return "fake-sql"
+
+    def pick_sql(self, messages):
+        prompt = messages[-1].content
+        match = QUESTION_PATTERN.search(prompt)
+        question = (match.group(1) if match else prompt).lower()
+        for phrase, sql in self.responses.items():
+            if phrase in question:
+                return sql
+        return self.default_sql
+
+    def _call(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        if self.latency_s:
+            time.sleep(self.latency_s)
+        return self.pick_sql(messages)
+
+    async def _agenerate(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        if self.latency_s:
+            await asyncio.sleep(self.latency_s)
+        message = AIMessage(content=self.pick_sql(messages))
+        return ChatResult(generations=[ChatGeneration(message=message)])
@@ -0,0 +1,141 @@
+"""Seeded SQLite databases with small, medium and large synthetic schemas.
+
+Every size has the same four core tables (customers, products, orders,
+order_items) that the canned benchmark questions query, plus filler tables
+that make the schema itself large, which is what schema fetch and pruning
+pay for:
+
+    python benchmarks/seed_databases.py --size medium --path /tmp/qg-medium.db
+"""
+import argparse
+import os
+import random
+import sqlite3
+
+SIZES = {
+    # filler tables, columns per filler table, customers, products, orders
+    "small": {"filler_tables": 5, "filler_columns": 6, "customers": 500, "products": 100, "orders": 2_000},
+    "medium": {"filler_tables": 40, "filler_columns": 12, "customers": 5_000, "products": 1_000, "orders": 50_000},
+    "large": {"filler_tables": 200, "filler_columns": 20, "customers": 50_000, "products": 5_000, "orders": 500_000},
+}
+
+CORE_SCHEMA = """
+CREATE TABLE customers (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    email TEXT NOT NULL,
+    country TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE TABLE products (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    category TEXT NOT NULL,
+    price REAL NOT NULL
+);
+CREATE TABLE orders (
+    id INTEGER PRIMARY KEY,
+    customer_id INTEGER NOT NULL REFERENCES customers(id),
+    status TEXT NOT NULL,
+    ordered_at TEXT NOT NULL
+);
+CREATE TABLE order_items (
+    id INTEGER PRIMARY KEY,
+    order_id INTEGER NOT NULL REFERENCES orders(id),
+    product_id INTEGER NOT NULL REFERENCES products(id),
+    quantity INTEGER NOT NULL
+);
+"""
+
+# Questions the fake model knows, keyed by a phrase that appears in them
+CANNED_SQL = {
+    "how many customers": "SELECT COUNT(*) AS customer_count FROM customers",
+    "customers by country": "SELECT country, COUNT(*) AS customers FROM customers GROUP BY country ORDER BY customers DESC",
+    "recent orders": "SELECT id, customer_id, status, ordered_at FROM orders ORDER BY id DESC LIMIT 50",
+    "all orders": "SELECT id, customer_id, status, ordered_at FROM orders",
+    "revenue by category": (
+        "SELECT p.category, SUM(p.price * oi.quantity) AS revenue FROM order_items oi "
+        "JOIN products p ON p.id = oi.product_id GROUP BY p.category ORDER BY revenue DESC"
+    ),
+}
+
+QUESTIONS = {
+    "count": "How many customers do we have?",
+    "group": "Show customers by country",
+    "recent": "List the 50 most recent orders",
+    "scan": "Show all orders",
+    "join": "What is the revenue by category?",
+}
+
+COUNTRIES = ["IN", "US", "DE", "BR", "JP", "FR", "GB", "NG", "AU", "CA"]
+CATEGORIES = ["books", "games", "garden", "kitchen", "music", "sports", "tools", "toys"]
+STATUSES = ["new", "paid", "shipped", "delivered", "returned"]
+
+
+def seed(path, size, seed_value=42):
+    """Create (or replace) the database at path; returns the path."""
+    spec = SIZES[size]
+    rng = random.Random(seed_value)
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    try:
+        connection.executescript(CORE_SCHEMA)
+        connection.executemany(
+            "INSERT INTO customers VALUES (?, ?, ?, ?, ?)",
+            (
+                (i, f"Customer {i}", f"customer{i}@example.com", rng.choice(COUNTRIES), f"2023-{rng.randint(1, 12):02d}-01")
+                for i in range(1, spec["customers"] + 1)
+            ),
+        )
+        connection.executemany(
+            "INSERT INTO products VALUES (?, ?, ?, ?)",
+            (
+                (i, f"Product {i}", rng.choice(CATEGORIES), round(rng.uniform(1, 500), 2))
+                for i in range(1, spec["products"] + 1)
+            ),
+        )
+        connection.executemany(
+            "INSERT INTO orders VALUES (?, ?, ?, ?)",
+            (
+                (i, rng.randint(1, spec["customers"]), rng.choice(STATUSES), f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}")
+                for i in range(1, spec["orders"] + 1)
+            ),
+        )
+        connection.executemany(
+            "INSERT INTO order_items (order_id, product_id, quantity) VALUES (?, ?, ?)",
+            (
+                (order_id, rng.randint(1, spec["products"]), rng.randint(1, 5))
+                for order_id in range(1, spec["orders"] + 1)
+                for _ in range(rng.randint(1, 3))
+            ),
+        )
+        for t in range(spec["filler_tables"]):
+            columns = ", ".join(f"attr_{c} TEXT" for c in range(spec["filler_columns"]))
+            connection.execute(
+                f"CREATE TABLE filler_{t} (id INTEGER PRIMARY KEY, customer_id INTEGER REFERENCES customers(id), {columns})"
+            )
+            connection.executemany(
+                f"INSERT INTO filler_{t} VALUES ({', '.join('?' * (spec['filler_columns'] + 2))})",
+                (
+                    (i, rng.randint(1, spec["customers"]), *(f"v{rng.randint(0, 999)}" for _ in range(spec["filler_columns"])))
+                    for i in range(1, 21)
+                ),
+            )
+        connection.commit()
+    finally:
+        connection.close()
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", choices=sorted(SIZES), default="small")
+    parser.add_argument("--path", required=True)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+    print(seed(args.path, args.size, args.seed))
+
+
+if __name__ == "__main__":
+    main()
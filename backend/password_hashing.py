@@ -0,0 +1,16 @@
+"""bcrypt hashing used by the auth endpoints.
+
+This lives in its own small module so the worker processes that run it
+(spawned, not forked) only import passlib instead of the whole app.
+"""
+from passlib.context import CryptContext
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+
+def hash_password(password):
+    return pwd_context.hash(password)
+
+
+def verify_password(plain_password, hashed_password):
+    return pwd_context.verify(plain_password, hashed_password)
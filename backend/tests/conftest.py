@@ -0,0 +1,96 @@
+"""Shared setup for the backend tests.
+
+The backend reads its configuration at import time, so it is imported here
+once:
+- users.db and the connection secret key are fresh temporary files.
+- Emails go to the in-memory backend.
+- SQL generation uses the benchmarks' FakeSQLChatModel.
+
+Each test gets its own seeded target database, so the process-wide caches
+never share entries between tests.
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORK_DIR = tempfile.mkdtemp(prefix="qg-tests-")
+
+os.environ.setdefault("SQLITE_DB_FILE", os.path.join(WORK_DIR, "users.db"))
+os.environ.setdefault("CONNECTION_SECRET_KEY_FILE", os.path.join(WORK_DIR, "connection_secret.key"))
+os.environ.setdefault("EMAIL_BACKEND", "memory")
+os.environ.setdefault("GROQ_API_KEY", "test")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, "benchmarks"))
+
+import httpx  # noqa: E402
+
+import backend  # noqa: E402
+from fake_llm import FakeSQLChatModel  # noqa: E402
+from seed_databases import CANNED_SQL, seed  # noqa: E402
+
+USER_ID = 1
+
+
+@pytest.fixture
+def target_db_path(tmp_path):
+    """A small seeded SQLite database: customers (500), products, orders (2,000), order_items."""
+    return seed(str(tmp_path / "target.db"), "small")
+
+
+@pytest.fixture
+def target_db(target_db_path):
+    return backend.db_registry.get(f"sqlite:///{target_db_path}")
+
+
+@pytest.fixture
+def connection_id(target_db_path):
+    """A connection profile for the target database, owned by USER_ID."""
+    return asyncio.run(backend.connection_profiles.create(f"sqlite:///{target_db_path}", "target", USER_ID))
+
+
+@pytest.fixture
+def fake_llm():
+    """The fake model behind the SQL chain; tests may add entries to fake_llm.responses."""
+    llm = FakeSQLChatModel(responses=dict(CANNED_SQL))
+    backend.set_sql_llm(llm)
+    return llm
+
+
+@pytest.fixture
+def api():
+    """api(method, url, **kwargs): one request through the ASGI app, returning the httpx response."""
+    def call(method, url, **kwargs):
+        async def send():
+            transport = httpx.ASGITransport(app=backend.app)
+            async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+                return await client.request(method, url, **kwargs)
+        return asyncio.run(send())
+    return call
+
+
+@pytest.fixture
+def ask(api, connection_id, fake_llm):
+    """ask(question, **fields): POST /api/chat for USER_ID; returns (sql, output) from the legacy response."""
+    def call(question, **fields):
+        body = {"question": question, "chat_history": [], "connection_id": connection_id, "user_id": USER_ID, **fields}
+        response = api("POST", "/api/chat", json=body)
+        assert response.status_code == 200, response.text
+        match = backend.LEGACY_RESULT.match(response.json()["response"])
+        return match.group("sql"), json.loads(match.group("output"))
+    return call
+
+
+@pytest.fixture
+def confirm(api, connection_id):
+    """confirm(sql, **fields): POST /api/confirm-sql for USER_ID; returns the JSON body."""
+    def call(sql, **fields):
+        body = {"user_id": USER_ID, "confirm": True, "sql": sql, "connection_id": connection_id, **fields}
+        response = api("POST", "/api/confirm-sql", json=body)
+        assert response.status_code == 200, response.text
+        return response.json()
+    return call
@@ -0,0 +1,63 @@
+import json
+
+from langchain_core.messages import AIMessage, HumanMessage
+
+import backend
+
+
+def result_message(sql_query, rows):
+    output = {"type": "select", "data": rows, "columns": ["id", "name"], "row_count": len(rows), "has_more": False}
+    return AIMessage(content=f"SQL: `{sql_query}`\nOutput: {json.dumps(output)}")
+
+
+def test_results_are_reduced_to_sql_columns_and_row_count():
+    rows = [[str(i), f"Customer {i}"] for i in range(1000)]
+    history = [HumanMessage(content="List customers"), result_message("SELECT id, name FROM customers", rows)]
+    assert backend.format_chat_history(history) == (
+        "Human: List customers\n"
+        "AI: SQL: `SELECT id, name FROM customers`\nResult: 1000 row(s); columns: id, name"
+    )
+
+
+def test_compaction_cache_keeps_only_the_compacted_text():
+    content = result_message("SELECT id, name FROM customers", [[str(i), "x" * 100] for i in range(5000)]).content
+    compacted = backend.compact_result_content(content)
+    key = backend.hashlib.sha1(content.encode("utf-8")).hexdigest()
+    assert backend.compacted_results.get(key) == compacted
+    assert len(compacted) < 100 and content not in backend.compacted_results._entries
+
+
+def test_repeated_turns_are_kept_once():
+    turn = [HumanMessage(content="How many customers?"), AIMessage(content="SQL: `SELECT COUNT(*) FROM customers`")]
+    formatted = backend.format_chat_history(turn * 3)
+    assert formatted.count("How many customers?") == 1
+
+
+def test_most_recent_turns_fill_the_budget():
+    history = []
+    for i in range(50):
+        history += [HumanMessage(content=f"Question {i}"), AIMessage(content=f"SQL: `SELECT {i}`")]
+    formatted = backend.format_chat_history(history, token_budget=40)
+    assert backend.estimate_tokens(formatted) <= 40
+    assert formatted.endswith("AI: SQL: `SELECT 49`")
+    assert "Question 0\n" not in formatted
+
+
+def test_long_messages_are_truncated():
+    formatted = backend.format_chat_history([HumanMessage(content="x" * 10_000)])
+    assert len(formatted) <= backend.HISTORY_MESSAGE_MAX_TOKENS * 4 + len(" ...")
+
+
+def test_chat_reports_compacted_prompt_size(api, connection_id, fake_llm):
+    rows = [[str(i), f"Customer {i}"] for i in range(5000)]
+    chat_history = [
+        {"role": "user", "content": "List customers"},
+        {"role": "ai", "content": result_message("SELECT id, name FROM customers", rows).content},
+    ]
+    response = api("POST", "/api/chat", json={
+        "question": "How many customers are there?", "chat_history": chat_history,
+        "connection_id": connection_id, "user_id": 1,
+    })
+    assert response.status_code == 200
+    sizes = dict(part.split("=") for part in response.headers["X-Prompt-Tokens"].split(", "))
+    assert 0 < int(sizes["history"]) <= backend.HISTORY_TOKEN_BUDGET
@@ -0,0 +1,52 @@
+import backend
+from conftest import USER_ID
+
+
+def message(role, content):
+    return {"role": role, "content": content}
+
+
+def stored_messages(api, session_id):
+    response = api("GET", f"/api/chat-sessions/{session_id}/messages", params={"user_id": USER_ID})
+    return [row["message"] for row in response.json()["messages"]]
+
+
+def new_session(api, messages):
+    body = {"title": "Orders", "messages": messages, "user_id": USER_ID}
+    return api("POST", "/api/chat-sessions", json=body).json()["id"]
+
+
+def put_messages(api, session_id, messages):
+    response = api("PUT", f"/api/chat-sessions/{session_id}", json={"messages": messages, "user_id": USER_ID})
+    assert response.status_code == 200, response.text
+
+
+def row_ids(session_id):
+    db_session = backend.ReadSessionLocal()
+    try:
+        return [row.id for row in db_session.query(backend.ChatMessage).filter(
+            backend.ChatMessage.session_id == session_id
+        ).order_by(backend.ChatMessage.seq)]
+    finally:
+        db_session.close()
+
+
+def test_resent_conversation_only_inserts_the_new_tail(api):
+    history = [message("user", "How many orders?"), message("ai", "SQL: `SELECT COUNT(*) FROM orders`")]
+    session_id = new_session(api, history)
+    before = row_ids(session_id)
+    put_messages(api, session_id, history + [message("user", "And customers?")])
+    assert row_ids(session_id)[:2] == before
+    assert stored_messages(api, session_id) == history + [message("user", "And customers?")]
+
+
+def test_edits_before_the_last_stored_message_are_kept(api):
+    history = [message("user", "How many orders?"), message("ai", "12"), message("user", "Thanks")]
+    session_id = new_session(api, history)
+    edited = [message("user", "How many customers?")] + history[1:] + [message("ai", "You're welcome")]
+    put_messages(api, session_id, edited)
+    assert stored_messages(api, session_id) == edited
+
+    shortened = edited[1:]  # deleting the first message keeps the last one in place
+    put_messages(api, session_id, shortened)
+    assert stored_messages(api, session_id) == shortened
@@ -0,0 +1,18 @@
+import backend
+from seed_databases import seed
+
+
+def test_cost_check_explains_on_the_routed_replica(target_db, tmp_path, monkeypatch):
+    replica_uri = f"sqlite:///{seed(str(tmp_path / 'replica.db'), 'small')}"
+    explained_on = []
+
+    def check_query_cost(connection, sql_query):
+        explained_on.append(connection.engine.url.render_as_string(hide_password=False))
+
+    monkeypatch.setattr(backend, "check_query_cost", check_query_cost)
+    token = backend.read_replicas.set((replica_uri,))
+    try:
+        backend.check_db_query_cost(target_db, "SELECT COUNT(*) FROM orders")
+    finally:
+        backend.read_replicas.reset(token)
+    assert explained_on == [replica_uri]
@@ -0,0 +1,23 @@
+def test_result_cache_is_invalidated_by_a_confirmed_write(ask, confirm):
+    _, first = ask("How many customers are there?")
+    _, second = ask("How many customers are there?")
+    assert (first["cached"], second["cached"]) == (False, True)
+    assert second["data"] == [["500"]]
+
+    assert confirm("DELETE FROM customers WHERE id = 1")["type"] == "status"
+    _, after = ask("How many customers are there?")
+    assert after["cached"] is False
+    assert after["data"] == [["499"]]
+
+
+def test_result_cache_keeps_entries_for_other_tables(ask, confirm):
+    ask("How many customers are there?")
+    confirm("DELETE FROM orders WHERE id = 1")
+    _, output = ask("How many customers are there?")
+    assert output["cached"] is True
+
+
+def test_result_cache_can_be_bypassed(ask):
+    ask("How many customers are there?")
+    _, output = ask("How many customers are there?", use_result_cache=False)
+    assert output["cached"] is False
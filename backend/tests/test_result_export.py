@@ -0,0 +1,35 @@
+import io
+from decimal import Decimal
+
+import pytest
+
+import backend
+from conftest import USER_ID
+
+pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+
+
+def read_parquet(chunks):
+    return pyarrow_parquet.read_table(io.BytesIO(b"".join(chunks)))
+
+
+def test_later_batches_fit_the_schema_of_the_first():
+    batches = iter([
+        [[1, Decimal("1.50"), None], [2, Decimal("2.25"), None]],
+        [[3, Decimal("12345678.90"), 7], [4, None, "seven"]],  # wider decimal, first values in the NULL column
+    ])
+    table = read_parquet(backend.iter_parquet_chunks(["id", "amount", "note"], batches))
+    assert str(table.schema.field("amount").type) == "decimal128(38, 2)"
+    assert table.column("amount").to_pylist() == [Decimal("1.50"), Decimal("2.25"), Decimal("12345678.90"), None]
+    assert table.column("note").to_pylist() == [None, None, "7", "seven"]
+
+
+def test_parquet_export_streams_every_row(api, connection_id, monkeypatch):
+    monkeypatch.setattr(backend, "EXPORT_BATCH_SIZE", 300)
+    response = api("POST", "/api/export", json={
+        "sql": "SELECT id, status FROM orders ORDER BY id", "format": "parquet",
+        "user_id": USER_ID, "connection_id": connection_id,
+    })
+    assert response.status_code == 200, response.text
+    table = read_parquet([response.content])
+    assert table.column("id").to_pylist() == list(range(1, 2001))
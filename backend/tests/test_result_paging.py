@@ -0,0 +1,84 @@
+import backend
+from conftest import USER_ID
+
+
+def fetch_page(api, connection_id, result_id, cursor, user_id=USER_ID):
+    return api("GET", f"/api/results/{result_id}/page", params={
+        "cursor": cursor, "user_id": user_id, "connection_id": connection_id,
+    })
+
+
+def walk_pages(api, connection_id, output):
+    rows, cursor = list(output["data"]), output.get("next_cursor")
+    while cursor:
+        response = fetch_page(api, connection_id, output["result_id"], cursor)
+        assert response.status_code == 200, response.text
+        page = response.json()
+        rows += page["data"]
+        cursor = page["next_cursor"]
+    return rows
+
+
+def test_pages_walk_every_row_once_in_key_order(api, ask, connection_id):
+    _, output = ask("Show all orders")
+    assert output["has_more"] and output["row_count"] == backend.RESULT_PAGE_SIZE
+    ids = [int(row[0]) for row in output["data"]]
+    cursor, pages = output["next_cursor"], 1
+    while cursor:
+        response = fetch_page(api, connection_id, output["result_id"], cursor)
+        assert response.status_code == 200, response.text
+        page = response.json()
+        ids += [int(row[0]) for row in page["data"]]
+        cursor, pages = page["next_cursor"], pages + 1
+    assert pages == 4
+    assert ids == list(range(1, 2001))
+
+
+def test_unordered_results_are_paged_in_column_order(api, ask, connection_id, fake_llm):
+    fake_llm.responses["who ordered"] = "SELECT c.name, o.id FROM orders o JOIN customers c ON c.id = o.customer_id"
+    _, output = ask("Who ordered what?")
+    rows = [(name, int(order_id)) for name, order_id in walk_pages(api, connection_id, output)]
+    assert rows == sorted(rows)
+    assert sorted(order_id for _, order_id in rows) == list(range(1, 2001))
+
+
+def test_paging_a_limited_query_keeps_its_order(api, ask, connection_id, fake_llm, target_db):
+    sql = "SELECT o.id, c.name FROM orders o JOIN customers c ON c.id = o.customer_id ORDER BY o.id DESC LIMIT 1200"
+    fake_llm.responses["latest orders"] = sql
+    _, output = ask("Latest orders with customer")
+    assert [int(row[0]) for row in walk_pages(api, connection_id, output)] == list(range(2000, 800, -1))
+
+    plan = backend.plan_pagination(sql, target_db)
+    with target_db._engine.connect() as connection:
+        statement, params = backend.build_page_query(connection, sql, plan, {"o": 1000}, 500)
+    assert "_qg_page" not in str(statement)  # not wrapped in a derived table
+    assert (params["_qg_limit"], params["_qg_offset"]) == (200, 1000)
+
+
+def test_deleting_seen_rows_does_not_shift_the_next_page(api, ask, confirm, connection_id):
+    _, output = ask("Show all orders")
+    confirm("DELETE FROM orders WHERE id <= 100")
+    page = fetch_page(api, connection_id, output["result_id"], output["next_cursor"]).json()
+    assert int(page["data"][0][0]) == backend.RESULT_PAGE_SIZE + 1
+
+
+def test_malformed_cursors_are_rejected(api, ask, connection_id):
+    _, output = ask("Show all orders")
+    malformed = [[500], {"k": [True]}, {"k": [500, 2]}, {"o": 500}]
+    for cursor in ["not base64!"] + [backend.encode_page_cursor(value) for value in malformed]:
+        response = fetch_page(api, connection_id, output["result_id"], cursor)
+        assert response.status_code == 400, cursor
+
+
+def test_results_and_connections_belong_to_their_user(api, ask, connection_id):
+    _, output = ask("Show all orders")
+    response = fetch_page(api, connection_id, output["result_id"], output["next_cursor"], user_id=USER_ID + 1)
+    assert response.status_code == 404  # someone else's connection_id doesn't resolve
+
+
+def test_owned_connections_never_become_the_fallback(api):
+    config = {"host": "db.example", "port": 3306, "user": "app", "password": "pw", "database": "shop", "user_id": USER_ID}
+    result = api("POST", "/api/connect", json=config).json()
+    assert result["success"] and result["connection_id"]
+    assert not hasattr(backend.app.state, "db_uri")
+    assert api("POST", "/api/chat", json={"question": "Show all orders", "user_id": USER_ID + 1}).status_code == 400
@@ -0,0 +1,15 @@
+import backend
+
+
+def test_schema_catalog_sees_ddl_run_through_confirm_sql(target_db, confirm):
+    assert "widgets" not in backend.schema_catalog.tables(target_db)
+    confirm("CREATE TABLE widgets (id INTEGER PRIMARY KEY, name TEXT)")
+    assert "widgets" in backend.schema_catalog.tables(target_db)
+    assert "CREATE TABLE widgets" in backend.schema_catalog.get_table_info(target_db, ["widgets"])
+
+
+def test_unpruned_schema_reports_no_negative_savings(target_db, monkeypatch):
+    monkeypatch.setattr(backend, "SCHEMA_PRUNE_TOP_K", 100)
+    _, stats = backend.prune_schema(target_db, "How many orders?", "")
+    assert stats["tables_selected"] == stats["tables_total"]
+    assert stats["schema_tokens_saved"] == 0
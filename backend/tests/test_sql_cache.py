@@ -0,0 +1,14 @@
+def test_generated_sql_is_reused_until_the_schema_changes(ask, confirm, fake_llm):
+    ask("How many customers are there?")
+    ask("how many customers are there")  # same question once normalized
+    assert fake_llm.calls == 1
+
+    confirm("CREATE TABLE widgets (id INTEGER PRIMARY KEY, name TEXT)")
+    ask("How many customers are there?")
+    assert fake_llm.calls == 2
+
+
+def test_sql_cache_can_be_bypassed(ask, fake_llm):
+    ask("How many customers are there?")
+    ask("How many customers are there?", use_sql_cache=False)
+    assert fake_llm.calls == 2
@@ -0,0 +1,80 @@
+import pytest
+
+import backend
+
+pytest.importorskip("sqlglot")  # without it validate_sql checks nothing, and startup warns about it
+
+
+@pytest.mark.parametrize("sql", [
+    "CREATE TABLE widgets (id INTEGER PRIMARY KEY, name TEXT)",
+    "DROP TABLE IF EXISTS tmp",
+    "CREATE TABLE big_orders AS SELECT * FROM orders WHERE id > 100",
+    "ALTER TABLE orders RENAME TO orders_archive",
+])
+def test_ddl_targets_need_not_exist(target_db, sql):
+    assert backend.validate_sql(target_db, sql) == []
+
+
+@pytest.mark.parametrize("sql", [
+    "DROP TABLE tmp",
+    "CREATE TABLE big_orders AS SELECT * FROM missing_orders",
+    "SELECT * FROM widgets",
+])
+def test_unknown_tables_read_or_dropped_are_reported(target_db, sql):
+    errors = backend.validate_sql(target_db, sql)
+    assert len(errors) == 1 and errors[0].startswith("Unknown table")
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT id FROM customers UNION SELECT customer_id FROM orders",
+    "SELECT id FROM customers EXCEPT SELECT customer_id FROM orders",
+    "SELECT id FROM customers INTERSECT SELECT customer_id FROM orders",
+    "(SELECT id FROM customers)",
+])
+def test_set_operations_are_selects(sql):
+    assert backend.is_select_sql(sql)
+    assert backend.detect_dangerous_sql(sql) == []
+
+
+def test_set_operation_branches_are_bound(target_db):
+    errors = backend.validate_sql(target_db, "SELECT id FROM customers EXCEPT SELECT nope FROM orders")
+    assert errors == ["Unknown column 'nope' in tables orders"]
+
+
+def test_select_errors(target_db):
+    assert backend.validate_sql(target_db, "SELECT c.name, COUNT(o.id) FROM customers c JOIN orders o ON o.customer_id = c.id GROUP BY c.id") == []
+    assert backend.validate_sql(target_db, "SELECT c.nme FROM customers c")[0].startswith("Unknown column 'c.nme'")
+    assert "only_full_group_by" in backend.validate_sql(target_db, "SELECT country, name FROM customers GROUP BY country")[0]
+
+
+def validations(outcome):
+    return backend.SQL_VALIDATIONS._values.get((outcome,), 0)
+
+
+def test_invalid_sql_is_repaired_before_it_runs(ask, fake_llm):
+    # The repair prompt says the SQL "fails validation"; the first attempt misspells a column
+    fake_llm.responses = {
+        "fails validation": "SELECT name FROM customers WHERE id = 1",
+        "first customer": "SELECT nme FROM customers WHERE id = 1",
+    }
+    repaired = validations("repaired")
+    sql_query, output = ask("Who is the first customer?")
+    assert sql_query == "SELECT name FROM customers WHERE id = 1"
+    assert output["data"] == [["Customer 1"]]
+    assert fake_llm.calls == 2
+    assert validations("repaired") == repaired + 1
+
+
+def test_repair_gives_up_after_max_attempts(ask, fake_llm):
+    fake_llm.responses = {"first customer": "SELECT nme FROM customers WHERE id = 1"}
+    fake_llm.default_sql = "SELECT nme FROM customers WHERE id = 1"
+    unrepaired = validations("unrepaired")
+    sql_query, output = ask("Who is the first customer?")
+    assert fake_llm.calls == 1 + backend.SQL_REPAIR_MAX_ATTEMPTS
+    assert output["type"] == "error"  # the database has the final word
+    assert validations("unrepaired") == unrepaired + 1
+
+
+def test_valid_sql_skips_repair(ask, fake_llm):
+    ask("How many customers are there?")
+    assert fake_llm.calls == 1
@@ -0,0 +1,76 @@
+import sqlite3
+import time
+
+import backend
+from conftest import USER_ID
+
+NEW_ORDERS = "SELECT COUNT(*) FROM orders WHERE status = 'new'"
+
+
+def count(target_db_path, sql):
+    connection = sqlite3.connect(target_db_path)
+    try:
+        return connection.execute(sql).fetchone()[0]
+    finally:
+        connection.close()
+
+
+def wait_for_job(api, job_id, done, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = api("GET", f"/api/write-jobs/{job_id}", params={"user_id": USER_ID}).json()
+        if done(job):
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"write job {job_id} did not get there: {job}")
+
+
+def test_large_delete_runs_as_a_job_in_key_chunks(api, confirm, target_db_path):
+    new_orders = count(target_db_path, NEW_ORDERS)
+    started = confirm("DELETE FROM orders WHERE status = 'new'", batch_size=100, pause_ms=0)
+    assert started["type"] == "job"
+
+    job = wait_for_job(api, started["job"]["job_id"], lambda job: job["state"] != "running")
+    assert job["state"] == "completed"
+    assert (job["rows_affected"], job["batches"]) == (new_orders, 20)  # 2,000 keys in chunks of 100
+    assert count(target_db_path, NEW_ORDERS) == 0
+    assert count(target_db_path, "SELECT COUNT(*) FROM orders") == 2000 - new_orders
+
+
+def test_interrupted_job_resumes_after_its_last_chunk(api, confirm, target_db_path):
+    new_orders = count(target_db_path, NEW_ORDERS)
+    started = confirm("DELETE FROM orders WHERE status = 'new'", batch_size=100, pause_ms=50)
+    job_id = started["job"]["job_id"]
+
+    wait_for_job(api, job_id, lambda job: job["batches"] >= 2)
+    backend.write_jobs.stop()
+    interrupted = api("GET", f"/api/write-jobs/{job_id}", params={"user_id": USER_ID}).json()
+    assert interrupted["state"] == "interrupted"
+    assert 2 <= interrupted["batches"] < 20
+    assert count(target_db_path, NEW_ORDERS) == new_orders - interrupted["rows_affected"]
+
+    resumed = api("POST", f"/api/write-jobs/{job_id}/resume", params={"user_id": USER_ID})
+    assert resumed.status_code == 200, resumed.text
+    job = wait_for_job(api, job_id, lambda job: job["state"] != "running")
+    assert job["state"] == "completed"
+    assert (job["rows_affected"], job["batches"]) == (new_orders, 20)
+    assert count(target_db_path, NEW_ORDERS) == 0
+
+
+def test_jobs_belong_to_their_user(api, confirm):
+    started = confirm("DELETE FROM orders WHERE status = 'new'", batch_size=100, pause_ms=0)
+    job_id = started["job"]["job_id"]
+    assert api("GET", f"/api/write-jobs/{job_id}", params={"user_id": USER_ID + 1}).status_code == 404
+    assert api("POST", f"/api/write-jobs/{job_id}/resume", params={"user_id": USER_ID + 1}).status_code == 404
+    wait_for_job(api, job_id, lambda job: job["state"] != "running")
+
+
+def test_jobs_need_an_owned_connection(api, target_db_path):
+    body = {"user_id": USER_ID, "confirm": True, "sql": "DELETE FROM orders WHERE status = 'new'", "batch_size": 100}
+    backend.app.state.db_uri = f"sqlite:///{target_db_path}"  # an anonymous client's connection
+    try:
+        result = api("POST", "/api/confirm-sql", json=body).json()
+    finally:
+        del backend.app.state.db_uri
+    assert result["type"] == "error" and "connection_id" in result["message"]
+    assert count(target_db_path, NEW_ORDERS) > 0
@@ -0,0 +1,113 @@
+import contextlib
+import threading
+import uuid
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+
+import backend
+
+
+@pytest.fixture
+def writer():
+    # Its own writer connection, so it never waits on the app's session_writer
+    session_factory = backend.sessionmaker(bind=backend.create_sqlite_engine(pool_size=1, max_overflow=0))
+    queue = backend.SQLiteWriteQueue(session_factory, batch_window_ms=200, max_batch=10)
+    yield queue
+    queue.stop()
+
+
+@contextlib.contextmanager
+def writer_busy(writer):
+    """Hold the writer inside a write, so everything submitted meanwhile is queued for the next batch."""
+    started, release = threading.Event(), threading.Event()
+
+    def block(db_session):
+        started.set()
+        release.wait(5)
+
+    blocker = writer.submit(block)
+    started.wait(5)
+    yield
+    release.set()
+    blocker.result(timeout=5)
+
+
+def add_cached_sql():
+    key = uuid.uuid4().hex
+
+    def write(db_session):
+        db_session.add(backend.GeneratedSQL(cache_key=key, sql="SELECT 1", created_at=datetime.utcnow()))
+        db_session.flush()
+        return key
+
+    return write
+
+
+def stored(key):
+    db_session = backend.ReadSessionLocal()
+    try:
+        return db_session.get(backend.GeneratedSQL, key) is not None
+    finally:
+        db_session.close()
+
+
+def test_lone_write_commits_without_waiting_for_the_window(writer):
+    key = writer.submit(add_cached_sql()).result(timeout=0.1)  # well under the 200 ms window
+    assert stored(key)
+
+
+def test_queued_writes_share_a_transaction(writer):
+    with writer_busy(writer):
+        futures = [writer.submit(add_cached_sql()) for _ in range(5)]
+    keys = [future.result(timeout=5) for future in futures]
+    assert (writer.batches, writer.writes) == (2, 6)  # the blocking write, then the five queued behind it
+    assert all(stored(key) for key in keys)
+
+
+def test_failed_batch_is_replayed_one_write_at_a_time(writer):
+    def broken(db_session):
+        add_cached_sql()(db_session)
+        raise ValueError("boom")
+
+    with writer_busy(writer):
+        first, failing, last = writer.submit(add_cached_sql()), writer.submit(broken), writer.submit(add_cached_sql())
+    first_key, last_key = first.result(timeout=5), last.result(timeout=5)
+    with pytest.raises(ValueError):
+        failing.result(timeout=5)
+    assert writer.batches == 3  # the blocking write, then each good write in its own replayed transaction
+    assert stored(first_key) and stored(last_key)
+
+
+def test_rejected_write_does_not_abort_its_batch(writer):
+    def rejected(db_session):
+        raise HTTPException(status_code=404, detail="Chat session not found")
+
+    with writer_busy(writer):
+        first, failing, last = writer.submit(add_cached_sql()), writer.submit(rejected), writer.submit(add_cached_sql())
+    with pytest.raises(HTTPException):
+        failing.result(timeout=5)
+    assert stored(first.result(timeout=5)) and stored(last.result(timeout=5))
+    assert writer.batches == 2
+
+
+def test_signup_writes_through_the_single_writer(api):
+    email = f"{uuid.uuid4().hex}@example.com"
+    user = {
+        "firstName": "Test", "lastName": "User", "email": email, "password": "secret-password",
+        "otp": "123456", "gender": "other", "username": email.split("@")[0],
+    }
+    backend.otp_storage.put(email, "123456")
+    assert api("POST", "/api/signup", json=user).status_code == 201
+    backend.otp_storage.put(email, "123456")
+    assert api("POST", "/api/signup", json=user).json()["detail"] == "Email already registered"
+
+
+def test_persistent_sql_cache_uses_the_writer_and_read_pool():
+    key = uuid.uuid4().hex
+    backend.SQLGenerationCache(8, 60, persist=True).set(key, "SELECT 42")
+    backend.session_writer.submit(lambda db_session: None).result(timeout=5)  # queued after the store
+    fresh = backend.SQLGenerationCache(8, 60, persist=True)
+    assert fresh.get(key) == "SELECT 42"
+    assert fresh.persistent_hits == 1